@@ -1 +1,36 @@
-from pytaq.taq_daily import *
\ No newline at end of file
+# Public names are imported on first access, so that 'import pytaq' does not
+# load pandas, NumPy or any optional backend dependency.
+import importlib
+
+from pytaq.backends import register_backend, register_engine
+
+lazy_attributes = {'TaqDaily': 'pytaq.taq_daily',
+                   'StageCache': 'pytaq.taq_cache',
+                   'TaqStore': 'pytaq.taq_store',
+                   'TaqDuckDB': 'pytaq.taq_duckdb',
+                   'TaqMmapStore': 'pytaq.taq_mmap',
+                   'TaqConnectionPool': 'pytaq.taq_connection',
+                   'NbboIndex': 'pytaq.taq_nbbo_index',
+                   'TaqServer': 'pytaq.taq_server',
+                   'TaqServerClient': 'pytaq.taq_server',
+                   'TaqDistributed': 'pytaq.taq_distributed',
+                   'TaqMirror': 'pytaq.taq_mirror',
+                   'ReplayPlugin': 'pytaq.taq_replay',
+                   'replay': 'pytaq.taq_replay'}
+
+# Note: 'from pytaq import *' only imports the names that do not need an
+# optional dependency (the other ones are still available as attributes).
+__all__ = ['register_backend', 'register_engine', 'TaqDaily', 'StageCache',
+           'TaqConnectionPool', 'NbboIndex']
+
+
+def __getattr__(name):
+    if name in lazy_attributes:
+        value = getattr(importlib.import_module(lazy_attributes[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'pytaq' has no attribute '" + name + "'")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(lazy_attributes))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Registry of data backends (TaqDaily method) and execution engines
+(TaqDaily engine).
+
+Backends are registered by name with either an object or a
+'module:attribute' string, which is only imported the first time the backend
+is used. This keeps 'import pytaq' free of wrds, saspy, duckdb, pyarrow,
+polars or numba imports.
+
+A backend provides get_nbbo_table, get_quote_table, get_trade_table,
+get_official_complete_nbbo and get_nbbo_symbols, taking the TaqDaily object
+as first argument and returning the raw table (with date and time_m
+columns), plus table_source(taq, table) for SQL-based backends.
+"""
+
+import importlib
+import threading
+
+backends = {}
+engines = {}
+loaded = {}
+lock = threading.Lock()
+
+
+def register_backend(name, target):
+    backends[name] = target
+    loaded.pop(('backend', name), None)
+
+
+def register_engine(name, target):
+    engines[name] = target
+    loaded.pop(('engine', name), None)
+
+
+def load(kind, name, registry):
+    key = (kind, name)
+    if key in loaded:
+        return loaded[key]
+    if name not in registry:
+        raise Exception('Unknown ' + kind + ' for TaqDaily: ' + str(name))
+    with lock:
+        if key not in loaded:
+            target = registry[name]
+            if isinstance(target, str):
+                module_name, _, attr = target.partition(':')
+                target = importlib.import_module(module_name)
+                if attr != '':
+                    target = getattr(target, attr)
+                # Backend classes are instantiated once
+                if isinstance(target, type):
+                    target = target()
+            loaded[key] = target
+    return loaded[key]
+
+
+def get_backend(name):
+    return load('backend', name, backends)
+
+
+def get_engine(name):
+    return load('engine', name, engines)
+
+
+#%% Built-in backends
+
+class PostgreSQLBackend():
+    def table_source(self, taq, table):
+        return taq.taq_library + '.' + table
+
+    def get_nbbo_symbols(self, taq, date):
+        # TODO
+        raise Exception('Method PostgreSQL not supported for get_nbbo_symbols()')
+
+    def get_nbbo_table(self, taq, date, symbols=None):
+        return taq.get_nbbo_table_postgresql(date, symbols)
+
+    def get_quote_table(self, taq, date, symbols=None):
+        return taq.get_quote_table_postgresql(date, symbols)
+
+    def get_trade_table(self, taq, date, symbols=None, get_cond=False):
+        return taq.get_trade_table_postgresql(date, symbols, get_cond)
+
+    def get_official_complete_nbbo(self, taq, date, symbols=None):
+        return taq.get_official_complete_nbbo_postgresql(date, symbols)
+
+
+class SASPyBackend():
+    def table_source(self, taq, table):
+        return taq.taq_library + '.' + table
+
+    def get_nbbo_symbols(self, taq, date):
+        return taq.get_nbbo_symbols_saspy(date)
+
+    def get_nbbo_table(self, taq, date, symbols=None):
+        return taq.get_nbbo_table_saspy(date, symbols)
+
+    def get_quote_table(self, taq, date, symbols=None):
+        return taq.get_quote_table_saspy(date, symbols)
+
+    def get_trade_table(self, taq, date, symbols=None, get_cond=False):
+        return taq.get_trade_table_saspy(date, symbols, get_cond)
+
+    def get_official_complete_nbbo(self, taq, date, symbols=None):
+        return taq.get_official_complete_nbbo_saspy(date, symbols)
+
+
+register_backend('PostgreSQL', PostgreSQLBackend())
+register_backend('SASPy', SASPyBackend())
+register_backend('DuckDB', 'pytaq.taq_duckdb:DuckDBBackend')
+register_backend('Server', 'pytaq.taq_server:ServerBackend')
+
+register_engine('polars', 'pytaq.taq_polars')
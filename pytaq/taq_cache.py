@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memoization of TaqDaily stage outputs (NBBO, quotes, trades, complete NBBO,
+merged trades) with an LRU memory budget and optional spill to disk.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from pytaq import backends
+
+
+class StageCache():
+    def __init__(self, max_bytes=4 * 2**30, spill_path=None):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        if spill_path is not None:
+            os.makedirs(spill_path, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def spill_file(self, key):
+        return os.path.join(self.spill_path, key + '.pkl')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+        if (self.spill_path is not None) and os.path.exists(self.spill_file(key)):
+            with open(self.spill_file(key), 'rb') as f:
+                df = pickle.load(f)
+            # Note: the file already exists, entries evicted by this put
+            # are spilled
+            self.put(key, df)
+            with self.lock:
+                self.hits += 1
+            return df
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, df):
+        if hasattr(df, 'estimated_size'):
+            # Polars output (TaqDaily.polars_output)
+            nbytes = int(df.estimated_size())
+        else:
+            nbytes = int(df.memory_usage(deep=True).sum())
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            if nbytes <= self.max_bytes:
+                self.entries[key] = (df, nbytes)
+                self.nbytes += nbytes
+            else:
+                # Larger than the whole budget, only keep it on disk
+                evicted.append((key, df))
+            while self.nbytes > self.max_bytes:
+                old_key, (old_df, old_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= old_nbytes
+                evicted.append((old_key, old_df))
+
+        if self.spill_path is not None:
+            for old_key, old_df in evicted:
+                if not os.path.exists(self.spill_file(old_key)):
+                    tmp_file = self.spill_file(old_key) + '.tmp'
+                    with open(tmp_file, 'wb') as f:
+                        pickle.dump(old_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp_file, self.spill_file(old_key))
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+        if disk and (self.spill_path is not None):
+            for f in os.listdir(self.spill_path):
+                if f.endswith('.pkl'):
+                    os.remove(os.path.join(self.spill_path, f))
+
+
+def copy_frame(df):
+    # Polars frames are immutable, clone() does not copy the data
+    return df.clone() if hasattr(df, 'clone') else df.copy()
+
+
+def stage_key(stage, date, symbols, params, config):
+    key = {'stage': stage,
+           'date': None if date is None else date.strftime('%Y%m%d'),
+           'symbols': None if symbols is None else sorted(symbols),
+           'params': params,
+           'config': config}
+    key = json.dumps(key, sort_keys=True, default=str)
+    return stage + '_' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+# Decorator for TaqDaily stages. The output is memoized only when the stage
+# fetches its own data (date given and none of the input frames provided);
+# the key includes every other argument and the TaqDaily attributes the
+# stage depends on, so changing e.g. keep_qu_cond gives a new key.
+# Backends with a get_stage method (e.g. method='Server') return the output
+# of the stage directly instead of the raw table to be cleaned.
+def cached_stage(stage, attributes, frames=()):
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            del params['self']
+            date = params.pop('date')
+            symbols = params.pop('symbols')
+            if (date is None) or any(params[f] is not None for f in frames):
+                return func(self, *args, **kwargs)
+            for f in frames:
+                del params[f]
+
+            backend = None
+            if self.method is not None:
+                backend = backends.get_backend(self.method)
+            if hasattr(backend, 'get_stage'):
+                run = lambda: backend.get_stage(self, func.__name__, date,
+                                                symbols, params)
+            else:
+                run = lambda: func(self, *args, **kwargs)
+            if self.cache is None:
+                return run()
+
+            config = {a: getattr(self, a) for a in attributes}
+            config['method'] = self.method
+            config['engine'] = self.engine
+            config['polars_output'] = self.polars_output
+            key = stage_key(stage, date, symbols, params, config)
+
+            # Callers get a copy, so that modifying the output in place
+            # never changes the cached frame
+            df = self.cache.get(key)
+            if df is None:
+                df = run()
+                if df is None:
+                    return None
+                self.cache.put(key, df)
+            return copy_frame(df)
+        return wrapper
+    return decorator
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Integer bitmask encoding of trade (tr_scond) and quote (qu_cond) condition
+codes.
+
+Each condition is a single character, and a tr_scond value holds up to four
+of them (e.g. '@ TI' or 'F  I'). A value is encoded as an int64 with one bit
+per condition it contains. Values are encoded once per distinct string (there
+are only a few hundred of them in a day), and filters on condition sets are
+then vectorized bitwise operations instead of string scans.
+"""
+
+import numpy as np
+import pandas as pd
+
+# One bit per condition code. Characters outside this list set the 'other'
+# bit.
+codes = '@ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+bits = {c: 1 << i for i, c in enumerate(codes)}
+other_bit = 1 << 62
+
+# Named sets of sale conditions (see the Daily TAQ client specification)
+condition_sets = {
+    'regular': '@',
+    'intermarket_sweep': 'F',
+    'odd_lot': 'I',
+    'opening': 'OQ5',
+    'closing': '6M',
+    'average_price': 'W',
+    'extended_hours': 'TU',
+    'out_of_sequence': 'LZ',
+    'derivatively_priced': '4',
+    'qualified_contingent': '7',
+    'contingent': 'V',
+    'cross': 'X'}
+
+
+def string_mask(value):
+    mask = 0
+    for c in value:
+        if c == ' ':
+            continue
+        mask |= bits.get(c, other_bit)
+    return mask
+
+
+def condition_mask(conditions):
+    # conditions: a string of condition codes, the name of a condition set,
+    # or a list of either
+    if isinstance(conditions, str):
+        conditions = [conditions]
+    mask = 0
+    for c in conditions:
+        if c in condition_sets:
+            c = condition_sets[c]
+        for x in c:
+            if x == ' ':
+                continue
+            if x not in bits:
+                raise Exception('Unknown condition code: ' + str(x))
+            mask |= bits[x]
+    return np.int64(mask)
+
+
+def encode_conditions(values):
+    # int64 bitmask of each value (0 if missing)
+    index, uniques = pd.factorize(np.asarray(values, dtype=object))
+    masks = np.array([string_mask(str(u)) for u in uniques] + [0],
+                     dtype='int64')
+    # Missing values have index -1, i.e. the last mask (0)
+    return masks[index]
+
+
+#%% Filters
+
+def has_any(condition_bits, conditions):
+    return (condition_bits & condition_mask(conditions)) != 0
+
+
+def has_all(condition_bits, conditions):
+    mask = condition_mask(conditions)
+    return (condition_bits & mask) == mask
+
+
+def has_none(condition_bits, conditions):
+    return (condition_bits & condition_mask(conditions)) == 0
+
+
+def select(condition_bits, any_of=None, all_of=None, none_of=None):
+    sel = np.ones(len(condition_bits), dtype=bool)
+    if any_of is not None:
+        sel &= has_any(condition_bits, any_of)
+    if all_of is not None:
+        sel &= has_all(condition_bits, all_of)
+    if none_of is not None:
+        sel &= has_none(condition_bits, none_of)
+    return sel
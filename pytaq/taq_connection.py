@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pool of database connections with retries and resumable chunked pulls.
+
+A TaqConnectionPool can be used as the db of TaqDaily(method='PostgreSQL')
+(or any backend running its queries with db.raw_sql). Connections are
+created with the connect function, kept open between queries and replaced
+when a query fails. Failed queries are retried with exponential backoff.
+
+With chunk_by ('sym_root' or 'time_m') and chunks, each query is split into
+key ranges pulled in parallel on the pooled connections. With
+checkpoint_path, each chunk is saved as soon as it is pulled, so that if the
+query still fails after the retries, running it again only pulls the missing
+chunks.
+"""
+
+import hashlib
+import importlib
+import os
+import pickle
+import queue
+import string
+import threading
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time
+
+import pandas as pd
+
+
+#%% Chunks
+
+def sym_root_chunks(n):
+    # Boundaries splitting sym_root in n ranges on the first letter
+    letters = string.ascii_uppercase
+    return [letters[int(round(i * len(letters) / n))] for i in range(1, n)]
+
+
+def time_chunks(start, end, step):
+    # Boundaries splitting [start, end] in windows of length step
+    # (timedelta)
+    day = datetime(2000, 1, 1)
+    t = datetime.combine(day, start) + step
+    bounds = []
+    while t < datetime.combine(day, end):
+        bounds.append(t.time())
+        t = t + step
+    return bounds
+
+
+def chunk_conditions(column, bounds):
+    # Half-open ranges between consecutive boundaries, the first and last
+    # ranges are unbounded so that the chunks cover the whole query.
+    def literal(x):
+        if isinstance(x, time):
+            x = x.strftime('%H:%M:%S.%f')
+        return "'" + str(x) + "'"
+    conds = []
+    for i in range(len(bounds) + 1):
+        cond = []
+        if i > 0:
+            cond.append(column + ' >= ' + literal(bounds[i - 1]))
+        if i < len(bounds):
+            cond.append(column + ' < ' + literal(bounds[i]))
+        conds.append('(' + ' AND '.join(cond) + ')')
+    return conds
+
+
+#%% Pool
+
+def connection_errors():
+    # Errors of a lost or unavailable connection, retried by default (SQL and
+    # programming errors are raised at once)
+    errors = [ConnectionError, TimeoutError]
+    for module, names in [('sqlalchemy.exc', ['OperationalError',
+                                              'InterfaceError',
+                                              'DisconnectionError',
+                                              'TimeoutError']),
+                          ('psycopg2', ['OperationalError', 'InterfaceError'])]:
+        try:
+            m = importlib.import_module(module)
+        except ImportError:
+            continue
+        errors += [getattr(m, n) for n in names if hasattr(m, n)]
+    return tuple(errors)
+
+
+class TaqConnectionPool():
+    def __init__(self, connect, size=4, retries=5, backoff=1, max_backoff=60,
+                 retry_on=None, chunk_by=None, chunks=None,
+                 checkpoint_path=None):
+        # connect() returns a new connection, e.g.
+        # lambda: wrds.Connection(wrds_username='...')
+        self.connect = connect
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if retry_on is None:
+            retry_on = connection_errors()
+        self.retry_on = retry_on
+
+        if chunk_by not in [None, 'sym_root', 'time_m']:
+            raise Exception('Unknown chunk_by for TaqConnectionPool: ' +
+                            str(chunk_by))
+        self.chunk_by = chunk_by
+        self.chunks = chunks
+        self.checkpoint_path = checkpoint_path
+        if checkpoint_path is not None:
+            os.makedirs(checkpoint_path, exist_ok=True)
+
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.queries = 0
+        self.retried = 0
+        self.rows = 0
+        self.seconds = 0.0
+
+    #%% Connections
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.connect()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            # Do not reuse a connection that failed
+            try:
+                conn.close()
+            except Exception:
+                pass
+        else:
+            self.idle.put(conn)
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    # Call func(connection) on a pooled connection, retrying on a new
+    # connection with exponential backoff if it fails with one of retry_on.
+    def run(self, func):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            conn = None
+            try:
+                conn = self.acquire()
+                out = func(conn)
+            except BaseException as e:
+                # The connection is released whatever the error
+                if conn is not None:
+                    self.release(conn, broken=True)
+                if (attempt == self.retries) or not isinstance(e, self.retry_on):
+                    raise
+                with self.lock:
+                    self.retried += 1
+                time_module.sleep(min(delay, self.max_backoff))
+                delay = delay * 2
+                continue
+            self.release(conn)
+            return out
+
+    #%% Queries
+
+    def query(self, sql):
+        start = time_module.time()
+        df = self.run(lambda conn: conn.raw_sql(sql))
+        with self.lock:
+            self.queries += 1
+            self.rows += len(df)
+            self.seconds += time_module.time() - start
+        return df
+
+    def checkpoint_file(self, key, i):
+        return os.path.join(self.checkpoint_path, key, 'chunk-' +
+                            str(i).zfill(4) + '.pkl')
+
+    def pull_chunk(self, key, i, sql):
+        if self.checkpoint_path is None:
+            return self.query(sql)
+        path = self.checkpoint_file(key, i)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        df = self.query(sql)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return df
+
+    def raw_sql(self, sql, chunk_by=None, chunks=None):
+        if chunk_by is None:
+            chunk_by = self.chunk_by
+        if chunks is None:
+            chunks = self.chunks
+        if (chunk_by is None) or (chunks is None):
+            return self.query(sql)
+
+        # Note: the TaqDaily queries end with a WHERE clause, to which the
+        # chunk condition is added.
+        if ' WHERE ' not in sql.upper():
+            raise Exception('Chunked query needs a WHERE clause: ' + sql)
+        if isinstance(chunks, int):
+            if chunk_by != 'sym_root':
+                raise Exception('Number of chunks only supported for sym_root')
+            chunks = sym_root_chunks(chunks)
+        if len(chunks) == 0:
+            # A single chunk
+            return self.query(sql)
+        queries = [sql + ' AND ' + c for c in chunk_conditions(chunk_by, chunks)]
+
+        key = hashlib.sha1('\n'.join(queries).encode('utf-8')).hexdigest()
+        with ThreadPoolExecutor(self.size) as executor:
+            dfs = list(executor.map(lambda i: self.pull_chunk(key, i, queries[i]),
+                                    range(len(queries))))
+        df = pd.concat(dfs, ignore_index=True)
+
+        # All chunks were pulled, checkpoints are no longer needed
+        if self.checkpoint_path is not None:
+            for i in range(len(queries)):
+                os.remove(self.checkpoint_file(key, i))
+            os.rmdir(os.path.join(self.checkpoint_path, key))
+        return df
+
+    def throughput(self):
+        # Rows per second of query time (summed over connections)
+        return self.rows / self.seconds if self.seconds > 0 else None
@@ -8,12 +8,92 @@ Created on Mon Jul  6 17:32:02 2020
 
 import pandas as pd
 import numpy as np
-from datetime import datetime, time, timedelta
+import copy
+import hashlib
+import json
+from datetime import time, timedelta
+
+from pytaq import backends
+from pytaq import taq_conditions
+from pytaq import taq_time
+from pytaq.taq_cache import cached_stage
+from pytaq.taq_nbbo_index import NbboIndex
+
+
+#%% Copy helpers
+# Chained filters (df = df[sel]) copy every column of the frame at each step,
+# and so does sort_values(). These helpers let each stage make a single copy
+# of the rows and columns it needs, or none at all.
+
+def take_rows(df, rows=None, columns=None, copy=True):
+    # Rows (boolean mask or positions) and columns of df as a new frame, with
+    # one copy of the selected data. Without rows and with copy=False, the
+    # new frame holds views of the columns of df.
+    if columns is None:
+        columns = df.columns
+    if rows is None:
+        return pd.DataFrame({c: df[c] for c in columns}, copy=copy)
+    return pd.DataFrame({c: df[c].array[rows] for c in columns},
+                        index=df.index[rows], copy=False)
+
+
+def merge_symbol(df, rows=None):
+    # sym_root + ' ' + sym_suffix, for the selected rows
+    sym_root = df['sym_root'].values
+    sym_suffix = df['sym_suffix'].values
+    if rows is not None:
+        sym_root, sym_suffix = sym_root[rows], sym_suffix[rows]
+    symbol = sym_root.astype(object)
+    sel = pd.notnull(sym_suffix)
+    symbol[sel] = symbol[sel] + ' ' + sym_suffix[sel]
+    return symbol
+
+
+def is_sorted(df, by):
+    # True if df is already sorted by the columns in by, in which case
+    # sort_values() (stable) would only return a copy.
+    n = len(df)
+    if n < 2:
+        return True
+    ties = np.ones(n - 1, dtype=bool)
+    for c in by:
+        values = df[c].values
+        if pd.isnull(values).any():
+            return False
+        if (ties & (values[1:] < values[:-1])).any():
+            return False
+        ties &= (values[1:] == values[:-1])
+        if not ties.any():
+            break
+    return True
+
+
+def check_pandas(df, method):
+    # Stages without a Polars implementation run in pandas, also with
+    # engine='polars' (on pandas frames)
+    if (df is not None) and not isinstance(df, pd.DataFrame):
+        raise Exception(method + ' has no Polars implementation and needs a ' +
+                        'pandas DataFrame (polars_output=False)')
+
+
+#%% Fixed-point prices
+
+def to_ticks(values, price_scale):
+    # Prices as int64 ticks of 1/price_scale dollar. Missing prices are kept
+    # as NaN in float64 ticks, which still compare exactly (integers are
+    # exact in float64).
+    ticks = np.round(np.asarray(values, dtype='float64') * price_scale)
+    if np.isnan(ticks).any():
+        return ticks
+    return ticks.astype('int64')
 
 
 class TaqDaily():
-    def __init__(self, method=None, db=None, track_retail=False):
-        if (method == 'PostgreSQL') | (method == 'SASPy'):
+    def __init__(self, method=None, db=None, track_retail=False, cache=None,
+                 engine='pandas'):
+        # Backends are registered in pytaq.backends and only loaded (with
+        # their dependencies) when first used.
+        if method in backends.backends:
             self.method = method
             self.db = db
         elif method is None:
@@ -45,12 +125,205 @@ class TaqDaily():
         
         # Should we compute trade sign for retail trades
         self.track_retail = track_retail
-    
+
+        # Optional StageCache to memoize the outputs of the get_* stages
+        self.cache = cache
+
+        # Execution engine for the cleaning, merge and compute_* steps.
+        # With 'polars', results are converted back to pandas unless
+        # polars_output is True.
+        self.engine = engine
+        self.polars_output = False
+
+        # With zero_copy, compute_effective_spreads and compute_rs_and_pi
+        # return new frames holding views of the input columns plus the
+        # derived ones, instead of a filtered copy of the input. Locked and
+        # crossed quotes are then kept with missing measures (they are still
+        # excluded from the averages).
+        self.zero_copy = False
+
+        # Measures to be computed (see measure_columns). If set, the queries
+        # only retrieve the columns these measures need (see plan_columns).
+        self.measures = None
+
+        # With price_scale (e.g. 10000), prices (bid, ask, best_bid,
+        # best_ask, price) are stored as int64 ticks of 1/price_scale dollar
+        # from cleaning on, so that locks, crosses and trade signs are exact
+        # comparisons. Dollar measures are converted back to dollars, percent
+        # measures do not depend on the unit. Only for the pandas engine.
+        self.price_scale = None
+
+    # Note: price_scale is only implemented by the pandas engine, the Polars
+    # engine works in dollars. Both attributes are checked when set.
+    @property
+    def engine(self):
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine):
+        if (engine != 'pandas') & (engine not in backends.engines):
+            raise Exception('Unknown engine for TaqDaily: ' + str(engine))
+        if (engine != 'pandas') and (getattr(self, '_price_scale', None)
+                                     is not None):
+            raise Exception('price_scale is only supported by the pandas engine')
+        self._engine = engine
+
+    @property
+    def price_scale(self):
+        return self._price_scale
+
+    @price_scale.setter
+    def price_scale(self, price_scale):
+        if (price_scale is not None) and (self.engine != 'pandas'):
+            raise Exception('price_scale is only supported by the pandas engine')
+        self._price_scale = price_scale
+
+    # Attributes that change the output of the cleaning and compute_* steps
+    config_attributes = ['taq_library', 'keep_qu_cond', 'max_spread',
+                         'max_quote_change', 'delete_canceled_quotes',
+                         'delete_empty_quotes', 'delete_crossed_markets',
+                         'delete_withdrawned_quotes',
+                         'delete_abnormal_spreads', 'keep_changes_only',
+                         'start_time_quotes', 'end_time_quotes',
+                         'start_time_trades', 'end_time_trades',
+                         'track_retail', 'measures', 'price_scale']
+
+    # Attributes each cached stage depends on (the columns retrieved depend
+    # on measures, see plan_columns)
+    nbbo_attributes = ['taq_library', 'keep_qu_cond', 'max_spread',
+                       'max_quote_change', 'delete_canceled_quotes',
+                       'delete_empty_quotes', 'delete_abnormal_spreads',
+                       'keep_changes_only', 'start_time_quotes',
+                       'end_time_quotes', 'measures', 'price_scale']
+    quote_attributes = ['taq_library', 'keep_qu_cond', 'max_spread',
+                        'delete_canceled_quotes', 'delete_crossed_markets',
+                        'delete_withdrawned_quotes', 'delete_abnormal_spreads',
+                        'start_time_quotes', 'end_time_quotes', 'measures',
+                        'price_scale']
+    trade_attributes = ['taq_library', 'start_time_trades', 'end_time_trades',
+                        'measures', 'track_retail', 'price_scale']
+    off_nbbo_attributes = ['taq_library', 'keep_changes_only',
+                           'start_time_quotes', 'end_time_quotes',
+                           'measures', 'price_scale']
+    merge_attributes = sorted(set(trade_attributes + off_nbbo_attributes +
+                                  ['track_retail']))
+
+    # Columns retrieved from each table
+    nbbo_columns = ['date', 'time_m', 'sym_root', 'sym_suffix', 'best_bid',
+                    'best_bidsiz', 'best_ask', 'best_asksiz', 'qu_cond',
+                    'qu_seqnum', 'best_askex', 'best_bidex', 'qu_cancel']
+    quote_columns = ['date', 'time_m', 'ex', 'sym_root', 'sym_suffix', 'bid',
+                     'bidsiz', 'ask', 'asksiz', 'qu_cond','qu_seqnum',
+                     'natbbo_ind', 'qu_source', 'qu_cancel']
+    trade_columns = ['date', 'time_m', 'ex', 'sym_root', 'sym_suffix',
+                     'size', 'price', 'tr_seqnum']
+    complete_nbbo_columns = ['date', 'time_m', 'sym_root', 'sym_suffix',
+                             'best_bid', 'best_bidsizeshares', 'best_ask',
+                             'best_asksizeshares']
+
+    # Columns each measure needs, on top of date, time_m, sym_root and
+    # sym_suffix. Exchanges and sequence numbers are not needed by any
+    # measure.
+    measure_columns = {
+        'quoted_spreads': {'complete_nbbo': ['best_bid', 'best_ask']},
+        'depth': {'complete_nbbo': ['best_bid', 'best_bidsizeshares',
+                                    'best_ask', 'best_asksizeshares']},
+        'spreads': {'complete_nbbo': ['best_bid', 'best_bidsizeshares',
+                                      'best_ask', 'best_asksizeshares']},
+        'effective_spreads': {'complete_nbbo': ['best_bid', 'best_ask'],
+                              'trade': ['size', 'price']},
+        'rs_pi': {'complete_nbbo': ['best_bid', 'best_ask'],
+                  'trade': ['size', 'price']},
+        'retail_signs': {'trade': ['ex', 'size', 'price']}}
+
+    def get_config(self, **kwargs):
+        config = {a: getattr(self, a) for a in self.config_attributes}
+        # Extra parameters of the computation (e.g. delay for RS and PI)
+        config.update(kwargs)
+        return config
+
+    def config_hash(self, **kwargs):
+        config = json.dumps(self.get_config(**kwargs), sort_keys=True,
+                            default=str)
+        return hashlib.sha1(config.encode('utf-8')).hexdigest()[:16]
+
+    # Minimum set of columns to retrieve from each table to compute the
+    # measures (all columns if measures is None). Tables that are not needed
+    # are left out.
+    def plan_columns(self, measures=None):
+        if measures is None:
+            measures = self.measures
+        tables = ['nbbo', 'quote', 'trade', 'complete_nbbo']
+        if measures is None:
+            return {t: list(getattr(self, t + '_columns')) for t in tables}
+
+        needed = {t: {'date', 'time_m', 'sym_root', 'sym_suffix'}
+                  for t in tables}
+        used = set()
+        for m in measures:
+            if m not in self.measure_columns:
+                raise Exception('Unknown measure for plan_columns(): ' + str(m))
+            for t, cols in self.measure_columns[m].items():
+                needed[t].update(cols)
+                used.add(t)
+
+        if ('trade' in used) & self.track_retail:
+            needed['trade'].add('ex')
+
+        if 'complete_nbbo' in used:
+            # The complete NBBO can also be built from the NBBO and quotes.
+            # Their cleanup needs the sizes and the flags it filters on, and
+            # qu_seqnum to order quotes at the same timestamp.
+            used.update(['nbbo', 'quote'])
+            needed['nbbo'].update(['best_bid', 'best_bidsiz', 'best_ask',
+                                   'best_asksiz', 'qu_seqnum'])
+            needed['quote'].update(['bid', 'bidsiz', 'ask', 'asksiz',
+                                    'qu_seqnum', 'natbbo_ind', 'qu_source'])
+            for t in ['nbbo', 'quote']:
+                if self.keep_qu_cond is not None:
+                    needed[t].add('qu_cond')
+                if self.delete_canceled_quotes:
+                    needed[t].add('qu_cancel')
+
+        return {t: [c for c in getattr(self, t + '_columns') if c in needed[t]]
+                for t in tables if t in used}
+
+    def get_columns(self, table):
+        return self.plan_columns().get(table,
+                                       list(getattr(self, table + '_columns')))
+
+    # Dollar amounts in the unit of the price columns (ticks with
+    # price_scale), and back to dollars
+    def to_price_units(self, x):
+        if self.price_scale is None:
+            return x
+        return x * self.price_scale
+
+    def to_dollars(self, x):
+        if self.price_scale is None:
+            return x
+        return x / self.price_scale
+
     def time_to_sql(self, x, quote='"'):
-        out =  (str(x.hour).zfill(2) + ':' + str(x.minute).zfill(2) + ':' +
-                str(x.second).zfill(2) + '.' +
-                str(int(np.round(x.microsecond/1000))).zfill(3))
+        # Rounded to the millisecond, e.g. "09:30:00.000"
+        ms = int(np.round(taq_time.time_to_ns(x) / 10**6))
+        seconds, ms = divmod(ms, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        out = '%02d:%02d:%02d.%03d' % (hours, minutes, seconds, ms)
         return quote + out + quote
+
+    def get_backend(self, caller):
+        if self.method is None:
+            raise Exception('Method needed for ' + caller + '()')
+        return backends.get_backend(self.method)
+
+    # Table name in SQL queries. With DuckDB, db is a TaqDuckDB object and
+    # the table is read from local Parquet files.
+    def table_source(self, table):
+        if self.method is None:
+            return self.taq_library + '.' + table
+        return self.get_backend('table_source').table_source(self, table)
     
 
 #%%  Symbols SASPy query
@@ -66,29 +339,19 @@ class TaqDaily():
 
 #%%  Get symbol list from nbbo table
     def get_nbbo_symbols(self, date):
-        if self.method == 'PostgreSQL':
-            # TODO
-            raise Exception('Method PostgreSQL not supported for get_nbbo_symbols()')     
-        elif self.method == 'SASPy':
-            return self.get_nbbo_symbols_saspy(date)
-        elif self.method is None:
-            raise Exception('Method needed for get_nbbo_symbols()')
-        else:
-            raise Exception('Unknown method for TaqDaily: ' + str(self.method))       
+        return self.get_backend('get_nbbo_symbols').get_nbbo_symbols(self, date)
 
     
     
 #%%  NBBO PostgreSQL query
-    def get_nbbo_table_postgresql(self, date, symbols=None):
+    def get_nbbo_table_sql(self, date, symbols=None, columns=None):
         nbbo_table = 'nbbom_' + date.strftime('%Y%m%d')
 
         # Columns to retreive from database
-        nbbo_cols = ['date', 'time_m', 'sym_root', 'sym_suffix', 'best_bid',
-                     'best_bidsiz', 'best_ask', 'best_asksiz', 'qu_cond',
-                     'qu_seqnum', 'best_askex', 'best_bidex', 'qu_cancel']
+        nbbo_cols = columns if columns is not None else self.get_columns('nbbo')
 
         select_cond = ('SELECT ' + ', '.join(nbbo_cols) + ' FROM ' +
-                       self.taq_library + '.' + nbbo_table)
+                       self.table_source(nbbo_table))
 
         # This is for common stocks only, can tweak to have other symbols
         if symbols is not None:
@@ -104,7 +367,10 @@ class TaqDaily():
                      self.time_to_sql(self.end_time_quotes, "'") + ')')
 
         sql_query = select_cond + symbol_cond + time_cond
-        return self.db.raw_sql(sql_query)
+        return sql_query
+
+    def get_nbbo_table_postgresql(self, date, symbols=None):
+        return self.db.raw_sql(self.get_nbbo_table_sql(date, symbols))
     
 #%%  NBBO sas query
 
@@ -112,9 +378,7 @@ class TaqDaily():
         nbbo_table = 'nbbom_' + date.strftime('%Y%m%d')
 
         # Columns to retreive from database
-        nbbo_cols = ['date', 'time_m', 'sym_root', 'sym_suffix', 'best_bid',
-                     'best_bidsiz', 'best_ask', 'best_asksiz', 'qu_cond',
-                     'qu_seqnum', 'best_askex', 'best_bidex', 'qu_cancel']
+        nbbo_cols = self.get_columns('nbbo')
 
 
         sas_proc = ('data DailyNBBO;\n set taqmsec.' + nbbo_table +
@@ -139,41 +403,36 @@ class TaqDaily():
 #%%  NBBO
     # TODO: add support for other than common stocks
     #       Add step 4 (changes only)
+    @cached_stage('nbbo', nbbo_attributes)
     def get_nbbo_table(self, date, symbols=None, output_flags=False):
-        if self.method == 'PostgreSQL':
-            df = self.get_nbbo_table_postgresql(date, symbols)  
-        elif self.method == 'SASPy':
-            df = self.get_nbbo_table_saspy(date, symbols)
-        elif self.method is None:
-            raise Exception('Method needed for get_nbbo_table()')
-        else:
-            raise Exception('Unknown method for TaqDaily: ' + str(self.method))       
+        df = self.get_backend('get_nbbo_table').get_nbbo_table(self, date, symbols)
 
         # Merge date and time
-        df['timestamp'] = df[['date', 'time_m']].apply(
-            lambda x: datetime.combine(x['date'], x['time_m']), axis=1)
+        df['timestamp'] = taq_time.combine_date_time(df['date'], df['time_m'])
         
         return self.clean_nbbo_table(df, output_flags=output_flags)
 
 #%% NBBO cleanup
     def clean_nbbo_table(self, df, output_flags=False):
+        if self.engine == 'polars':
+            taq_polars = backends.get_engine('polars')
+            return taq_polars.collect(
+                taq_polars.clean_nbbo_table(self, df, output_flags=output_flags),
+                to_pandas=not self.polars_output)
+
         # Post-SQL query cleanup
-        
-        # Merge symbol
-        df['symbol'] = df['sym_root']
-        sel = df.sym_suffix.notnull()
-        df.loc[sel, 'symbol'] = (df.loc[sel, 'sym_root'] + ' ' + 
-                                 df.loc[sel, 'sym_suffix'])
-        
+        # Note: the filters are combined in a single mask, and the selected
+        # rows (sorted if needed) are copied once. The input is not modified.
+        keep = np.ones(len(df), dtype=bool)
+
         if self.keep_qu_cond is not None:
             # Quote condition must be normal
-            df = df[df.qu_cond.isin(self.keep_qu_cond)]
-            
+            keep &= self.keep_qu_cond_mask(df)
+
         if self.delete_canceled_quotes:
             # Delete if canceled
-            df = df[df.qu_cancel != 'B']
-            
-            
+            keep &= (df.qu_cancel != 'B').values
+
         if self.delete_empty_quotes:
             # TODO: double-check, it seems this steps is actually wrong, you
             # should keep empty quotes. (step from H&J)
@@ -182,9 +441,32 @@ class TaqDaily():
                     ((df.best_asksiz <= 0) & (df.best_bidsiz <= 0)) |
                     (df.best_ask.isnull() & df.best_bid.isnull()) |
                     (df.best_asksiz.isnull() & df.best_bidsiz.isnull()))
-            
-            df = df[~del_sel]
-        
+            keep &= ~del_sel.values
+
+        rows = np.flatnonzero(keep)
+
+        # Merge symbol
+        symbol = merge_symbol(df, rows)
+
+        if self.delete_abnormal_spreads:
+            # Note: H&J only sorts on sym_root, not sym_suffix.
+            #       They also sort on date, not timestamps (this is weird)
+            order = np.lexsort((df['timestamp'].values[rows],
+                                pd.factorize(symbol, sort=True)[0]))
+            rows, symbol = rows[order], symbol[order]
+
+        cols = ['timestamp', 'best_bid', 'best_bidsiz', 'best_bidex',
+                'best_ask', 'best_asksiz', 'best_askex', 'qu_seqnum']
+        if output_flags:
+            cols += ['qu_cond', 'qu_cancel']
+        # Only the columns retrieved (see plan_columns) are carried
+        cols = [c for c in cols if c in df.columns]
+        df = take_rows(df, rows, cols)
+        df['symbol'] = symbol
+        if self.price_scale is not None:
+            for c in ['best_bid', 'best_ask']:
+                df[c] = to_ticks(df[c].values, self.price_scale)
+
         df['spread'] = df.best_ask - df.best_bid
         df['midpoint'] = (df.best_ask + df.best_bid) / 2
         
@@ -201,17 +483,9 @@ class TaqDaily():
         # Bid/ask size are in round lots
         df['best_bidsizeshares'] = df.best_bidsiz * 100
         df['best_asksizeshares'] = df.best_asksiz * 100
-        
-        del df['best_bidsiz']
-        del df['best_asksiz']
-        
 
         if self.delete_abnormal_spreads:
-            # Get previous midpoint
-            # Note: H&J only sorts on sym_root, not sym_suffix.
-            #       They also sort on date, not timestamps (this is weird)
-            df = df.sort_values(['symbol', 'timestamp'])
-            
+            # Get previous midpoint (rows are sorted by symbol, timestamp)
             df['lmid'] = df.groupby(['symbol'])['midpoint'].shift()
             
             # If quoted spread > $5 and bid (ask) has decreased (increased) by
@@ -224,11 +498,13 @@ class TaqDaily():
             # So if first row has spread greater than max spread, best_bid
             # will be set to missing by SAS but not best_ask. Python
             # won't set any to null.
-            bid_sel = ((df.spread > self.max_spread) &
-                    (df.best_bid < df.lmid - self.max_quote_change))
+            max_spread = self.to_price_units(self.max_spread)
+            max_quote_change = self.to_price_units(self.max_quote_change)
+            bid_sel = ((df.spread > max_spread) &
+                    (df.best_bid < df.lmid - max_quote_change))
             df.loc[bid_sel, ['best_bid', 'best_bidsizeshares']] = np.nan
-            ask_sel = ((df.spread > self.max_spread) & 
-                    (df.best_ask > df.lmid + self.max_quote_change))
+            ask_sel = ((df.spread > max_spread) & 
+                    (df.best_ask > df.lmid + max_quote_change))
             df.loc[ask_sel, ['best_ask', 'best_asksizeshares']] = np.nan
             
         if self.keep_changes_only:
@@ -244,7 +520,8 @@ class TaqDaily():
                     grp['best_bidsizeshares'].shift()) |
                 (df['best_asksizeshares'] !=
                     grp['best_asksizeshares'].shift()))
-            df = df[sel]
+        else:
+            sel = None
         
         # Keep only relevant columns
         # Columns to output
@@ -254,21 +531,28 @@ class TaqDaily():
         
         if output_flags:
             nbbo_out_cols += ['qu_cond', 'qu_cancel']
-            
-        return df[nbbo_out_cols]
+        nbbo_out_cols = [c for c in nbbo_out_cols if c in df.columns]
+
+        if sel is None:
+            df = take_rows(df, columns=nbbo_out_cols, copy=False)
+        else:
+            df = take_rows(df, sel.values, nbbo_out_cols)
+        if self.price_scale is not None:
+            # Back to int64 ticks if no price was set to missing
+            for c in ['best_bid', 'best_ask']:
+                df[c] = to_ticks(df[c].values, 1)
+        return df
  
     
     #%% Quotes PostgreSQL
     
-    def get_quote_table_postgresql(self, date, symbols=None):
+    def get_quote_table_sql(self, date, symbols=None, columns=None):
         quote_table = 'cqm_' + date.strftime('%Y%m%d')
         
-        quote_cols = ['date', 'time_m', 'ex', 'sym_root', 'sym_suffix', 'bid',
-                      'bidsiz', 'ask', 'asksiz', 'qu_cond','qu_seqnum',
-                      'natbbo_ind', 'qu_source', 'qu_cancel']
+        quote_cols = columns if columns is not None else self.get_columns('quote')
         
         select_cond = ('SELECT ' + ', '.join(quote_cols) + ' FROM ' +
-                       self.taq_library + '.' + quote_table)
+                       self.table_source(quote_table))
         
         # This is for common stocks only, can tweak to have other symbols
         if symbols is not None:
@@ -284,17 +568,17 @@ class TaqDaily():
                      self.time_to_sql(self.end_time_quotes, "'") + ')')
             
         sql_query = select_cond + symbol_cond + time_cond
-        df = self.db.raw_sql(sql_query)    
-        return df
+        return sql_query
+
+    def get_quote_table_postgresql(self, date, symbols=None):
+        return self.db.raw_sql(self.get_quote_table_sql(date, symbols))
 
     #%% Quotes saspy
     
     def get_quote_table_saspy(self, date, symbols=None):
         quote_table = 'cqm_' + date.strftime('%Y%m%d')
         
-        quote_cols = ['date', 'time_m', 'ex', 'sym_root', 'sym_suffix', 'bid',
-                      'bidsiz', 'ask', 'asksiz', 'qu_cond','qu_seqnum',
-                      'natbbo_ind', 'qu_source', 'qu_cancel']
+        quote_cols = self.get_columns('quote')
 
 
         sas_proc = ('data DailyQuote;\n set taqmsec.' + quote_table +
@@ -318,95 +602,109 @@ class TaqDaily():
     
     #%% Quotes
     
+    @cached_stage('quote', quote_attributes)
     def get_quote_table(self, date, symbols=None, nbbo_only=True, output_flags=False):
-        if self.method == 'PostgreSQL':
-            df = self.get_quote_table_postgresql(date, symbols)  
-        elif self.method == 'SASPy':
-            df = self.get_quote_table_saspy(date, symbols)
-        elif self.method is None:
-            raise Exception('Method needed for get_quote_table()')
-        else:
-            raise Exception('Unknown method for TaqDaily: ' + str(self.method))       
+        df = self.get_backend('get_quote_table').get_quote_table(self, date, symbols)
 
         
         # Merge date and time
-        df['timestamp'] = df[['date', 'time_m']].apply(
-            lambda x: datetime.combine(x['date'], x['time_m']), axis=1)
+        df['timestamp'] = taq_time.combine_date_time(df['date'], df['time_m'])
         
         return self.clean_quote_table(df, nbbo_only=nbbo_only,
                                       output_flags=output_flags)
         
     def clean_quote_table(self, df, nbbo_only=True, output_flags=False):
-        # Merge symbol
-        df['symbol'] = df['sym_root']
-        sel = df.sym_suffix.notnull()
-        df.loc[sel, 'symbol'] = (df.loc[sel, 'sym_root'] + ' ' +
-                                 df.loc[sel, 'sym_suffix'])
-        
-        df['spread'] = df.ask - df.bid
-        
+        if self.engine == 'polars':
+            taq_polars = backends.get_engine('polars')
+            return taq_polars.collect(
+                taq_polars.clean_quote_table(self, df, nbbo_only=nbbo_only,
+                                             output_flags=output_flags),
+                to_pandas=not self.polars_output)
+
+        # Note: all the filters only depend on the raw columns, so they are
+        # combined in a single mask and the output is built from one copy of
+        # the selected rows. The input is not modified.
+        bid, ask = df.bid.values, df.ask.values
+        if self.price_scale is not None:
+            bid = to_ticks(bid, self.price_scale)
+            ask = to_ticks(ask, self.price_scale)
+        spread = ask - bid
+        keep = np.ones(len(df), dtype=bool)
+
         if self.keep_qu_cond is not None:
             # Quote condition must be normal
-            df = df[df.qu_cond.isin(self.keep_qu_cond)]
-            
+            keep &= self.keep_qu_cond_mask(df)
+
         if self.delete_canceled_quotes:
             # Delete if canceled
-            df = df[df.qu_cancel != 'B']
+            keep &= (df.qu_cancel != 'B').values
 
         if self.delete_crossed_markets:
             # Delete abnormal crossed markets
-            df = df[df.bid <= df.ask]
-            
+            keep &= (bid <= ask)
+
         if self.delete_abnormal_spreads:
             # Delete abnormal spreads
-            df = df[df.spread <= self.max_spread]
-            
+            keep &= (spread <= self.to_price_units(self.max_spread))
+
         if self.delete_withdrawned_quotes:
             # Delete withdrawn quotes (see H&J (2014) page 11 for details)
             del_sel = (df.ask.isnull() | (df.ask <= 0) |
                     df.asksiz.isnull() | (df.asksiz <=0) |
                     df.bid.isnull() | (df.bid <= 0) |
                     df.bidsiz.isnull() | (df.bidsiz <=0))
-            df = df[~del_sel]
-        
-        df = df.rename(columns={'ask': 'best_ask', 'bid': 'best_bid',
-                                'ex': 'best_bidex'})
-        df['best_askex'] = df['best_bidex']  
-          
-        # Bid/ask size are in round lots
-        df['best_bidsizeshares'] = df.bidsiz * 100
-        df['best_asksizeshares'] = df.asksiz * 100
-        
-        del df['bidsiz']
-        del df['asksiz']
-        
+            keep &= ~del_sel.values
+
         # Keep only those to be merged with NBBO file
         if nbbo_only:
             sel = (((df.qu_source == 'C') & (df.natbbo_ind == '1')) |
                 ((df.qu_source == 'N') & (df.natbbo_ind == '4')))
-            df = df[sel]
-        
-        quote_out_cols = ['timestamp', 'symbol', 'best_bid',
-                          'best_bidsizeshares', 'best_bidex', 'best_ask',
-                          'best_asksizeshares', 'best_askex', 'qu_seqnum']
-        
+            keep &= sel.values
+
+        rows = np.flatnonzero(keep)
+        flag_cols = ['qu_cond', 'natbbo_ind', 'qu_source', 'qu_cancel']
+        cols = ['timestamp', 'bid', 'bidsiz', 'ex', 'ask', 'asksiz',
+                'qu_seqnum']
         if output_flags:
-            quote_out_cols += ['qu_cond', 'natbbo_ind', 'qu_source',
-                               'qu_cancel']
-        return df[quote_out_cols]
+            cols += flag_cols
+        # Only the columns retrieved (see plan_columns) are carried
+        cols = [c for c in cols if c in df.columns]
+        if self.price_scale is not None:
+            # Prices are taken from the ticks
+            cols = [c for c in cols if c not in ['bid', 'ask']]
+        src = take_rows(df, rows, cols)
+        if self.price_scale is not None:
+            src['bid'] = bid[rows]
+            src['ask'] = ask[rows]
+
+        # Bid/ask size are in round lots
+        out = {'timestamp': src['timestamp'],
+               'symbol': pd.Series(merge_symbol(df, rows), index=src.index),
+               'best_bid': src['bid'],
+               'best_bidsizeshares': src['bidsiz'] * 100}
+        if 'ex' in src.columns:
+            out['best_bidex'] = src['ex']
+        out['best_ask'] = src['ask']
+        out['best_asksizeshares'] = src['asksiz'] * 100
+        if 'ex' in src.columns:
+            out['best_askex'] = src['ex'].copy()
+        for c in ['qu_seqnum'] + flag_cols:
+            if c in src.columns:
+                out[c] = src[c]
+        return pd.DataFrame(out, copy=False)
     
     #%% Trades PostgreSQL
     
-    def get_trade_table_postgresql(self, date, symbols=None, get_cond=False):
+    def get_trade_table_sql(self, date, symbols=None, get_cond=False,
+                            columns=None):
         trade_table = 'ctm_' + date.strftime('%Y%m%d')
         
-        trade_cols = ['date', 'time_m', 'ex', 'sym_root', 'sym_suffix',
-                      'size', 'price', 'tr_seqnum']
+        trade_cols = columns if columns is not None else self.get_columns('trade')
         if get_cond:
-            trade_cols += ['tr_scond']
+            trade_cols = trade_cols + ['tr_scond']
         
         select_cond = ('SELECT ' + ', '.join(trade_cols) + ' FROM ' +
-                       self.taq_library + '.' + trade_table)
+                       self.table_source(trade_table))
         
         # This is for common stocks only, can tweak to have other symbols
         if symbols is not None:
@@ -425,16 +723,17 @@ class TaqDaily():
         trade_cond = " AND tr_corr = '00' AND price > 0"
             
         sql_query = select_cond + symbol_cond + trade_cond + time_cond
-        df = self.db.raw_sql(sql_query)
-        return df
+        return sql_query
+
+    def get_trade_table_postgresql(self, date, symbols=None, get_cond=False):
+        return self.db.raw_sql(self.get_trade_table_sql(date, symbols, get_cond))
 
     #%% Trades SASPy
     
     def get_trade_table_saspy(self, date, symbols=None, get_cond=False):
         trade_table = 'ctm_' + date.strftime('%Y%m%d')
         
-        trade_cols = ['date', 'time_m', 'ex', 'sym_root', 'sym_suffix',
-                      'size', 'price', 'tr_seqnum', 'tr_corr']
+        trade_cols = self.get_columns('trade') + ['tr_corr']
         if get_cond:
             trade_cols += ['tr_scond']
 
@@ -458,47 +757,70 @@ class TaqDaily():
 
     #%% Trades
      
+    @cached_stage('trade', trade_attributes)
     def get_trade_table(self, date, symbols=None, get_cond=False):
-        if self.method == 'PostgreSQL':
-            df = self.get_trade_table_postgresql(date, symbols, get_cond)  
-        elif self.method == 'SASPy':
-            df = self.get_trade_table_saspy(date, symbols, get_cond)
-        elif self.method is None:
-            raise Exception('Method needed for get_trade_table()')
-        else:
-            raise Exception('Unknown method for TaqDaily: ' + str(self.method))    
+        df = self.get_backend('get_trade_table').get_trade_table(self, date, symbols, get_cond)
         
         # Merge date and time
-        df['timestamp'] = df[['date', 'time_m']].apply(
-            lambda x: datetime.combine(x['date'], x['time_m']), axis=1)
+        df['timestamp'] = taq_time.combine_date_time(df['date'], df['time_m'])
         
         return self.clean_trade_table(df, get_cond=get_cond)
 
 
     def clean_trade_table(self, df, get_cond=False):
-        # Merge symbol
-        df['symbol'] = df['sym_root']
-        sel = df.sym_suffix.notnull()
-        df.loc[sel, 'symbol'] = (df.loc[sel, 'sym_root'] + ' ' +
-                                 df.loc[sel, 'sym_suffix'])
-        trade_out_cols = ['timestamp', 'symbol', 'ex', 'size', 'price',
-                      'tr_seqnum']
+        check_pandas(df, 'clean_trade_table')
+        trade_out_cols = ['timestamp', 'ex', 'size', 'price', 'tr_seqnum']
         if get_cond:
             trade_out_cols += ['tr_scond']
-        
-        return df[trade_out_cols]
+        trade_out_cols = [c for c in trade_out_cols if c in df.columns]
+
+        out = take_rows(df, columns=trade_out_cols, copy=not self.zero_copy)
+        if self.price_scale is not None:
+            out['price'] = to_ticks(out['price'].values, self.price_scale)
+        # Merge symbol
+        out.insert(1, 'symbol', merge_symbol(df))
+        if get_cond:
+            # Sale conditions decoded once as bitmasks (see
+            # select_conditions)
+            out['tr_scond_bits'] = taq_conditions.encode_conditions(df['tr_scond'])
+        return out
     
+    #%% Condition codes
+
+    def keep_qu_cond_mask(self, df):
+        # Same as df.qu_cond.isin(self.keep_qu_cond), evaluated once per
+        # distinct quote condition (whole values are compared, so that
+        # e.g. 'RL' or ' ' are only kept if listed as such)
+        index, uniques = pd.factorize(df['qu_cond'].values)
+        keep = np.append(pd.Index(uniques).isin(list(self.keep_qu_cond)), False)
+        # Missing values have index -1, i.e. the last one (False)
+        return keep[index]
+
+    # Boolean Series of the rows of df whose conditions include any of any_of,
+    # all of all_of and none of none_of. Each can be a string of condition
+    # codes (e.g. 'FI'), a name in taq_conditions.condition_sets (e.g.
+    # 'odd_lot') or a list of those. Uses the <column>_bits column if present.
+    def select_conditions(self, df, any_of=None, all_of=None, none_of=None,
+                          column='tr_scond'):
+        if column + '_bits' in df.columns:
+            condition_bits = df[column + '_bits'].values
+        else:
+            condition_bits = taq_conditions.encode_conditions(df[column])
+        sel = taq_conditions.select(condition_bits, any_of=any_of,
+                                    all_of=all_of, none_of=none_of)
+        return pd.Series(sel, index=df.index)
+
     #%% Official Complete NBBO PostgreSQL
     
-    def get_official_complete_nbbo_postgresql(self, date, symbols=None):
+    def get_official_complete_nbbo_sql(self, date, symbols=None, columns=None):
         nbbo_table = 'complete_nbbo_' + date.strftime('%Y%m%d')
 
         # Columns to retreive from database
-        nbbo_cols = ['date', 'time_m', 'sym_root', 'sym_suffix', 'best_bid',
-                     'best_bidsizeshares', 'best_ask', 'best_asksizeshares']
+        nbbo_cols = (columns if columns is not None else
+                     self.get_columns('complete_nbbo'))
 
         select_cond = ('SELECT ' + ', '.join(nbbo_cols) + ' FROM ' +
-                        self.taq_library + '.' + nbbo_table)
+                        self.table_source(nbbo_table))
 
         # This is for common stocks only, can tweak to have other symbols
         if symbols is not None:
@@ -514,7 +836,10 @@ class TaqDaily():
                         self.time_to_sql(self.end_time_quotes, "'") + ')')
 
         sql_query = select_cond + symbol_cond + time_cond
-        return self.db.raw_sql(sql_query)
+        return sql_query
+
+    def get_official_complete_nbbo_postgresql(self, date, symbols=None):
+        return self.db.raw_sql(self.get_official_complete_nbbo_sql(date, symbols))
     
     #%% Official Complete NBBO SASPy
     
@@ -522,8 +847,7 @@ class TaqDaily():
         nbbo_table = 'complete_nbbo_' + date.strftime('%Y%m%d')
 
         # Columns to retreive from database
-        nbbo_cols = ['date', 'time_m', 'sym_root', 'sym_suffix', 'best_bid',
-                     'best_bidsizeshares', 'best_ask', 'best_asksizeshares']
+        nbbo_cols = self.get_columns('complete_nbbo')
 
 
         sas_proc = ('data DailyNBBO;\n set taqmsec.' + nbbo_table +
@@ -546,26 +870,31 @@ class TaqDaily():
     
     #%% Official Complete NBBO
     
+    @cached_stage('official_complete_nbbo', off_nbbo_attributes,
+                  frames=('nbbo_df', 'quote_df'))
     def get_official_complete_nbbo(self, date=None, symbols=None,
                                    nbbo_df=None, quote_df=None):
         if (nbbo_df is None) | (quote_df is None):
-            if self.method == 'PostgreSQL':
-                df = self.get_official_complete_nbbo_postgresql(date, symbols)  
-            elif self.method == 'SASPy':
-                df = self.get_official_complete_nbbo_saspy(date, symbols) 
-            elif self.method is None:
-                raise Exception('Method needed for get_official_complete_nbbo()')
-            else:
-                raise Exception('Unknown method for TaqDaily: ' + str(self.method))
+            df = self.get_backend('get_official_complete_nbbo').get_official_complete_nbbo(
+                self, date, symbols)
             # Merge date and time
-            df['timestamp'] = df[['date', 'time_m']].apply(
-            lambda x: datetime.combine(x['date'], x['time_m']), axis=1)
+            df['timestamp'] = taq_time.combine_date_time(df['date'], df['time_m'])
             df = self.clean_official_complete_nbbo(df)
+        elif self.engine == 'polars':
+            df = None
         else:
             # Note: Could use append() instead of concat()
             # df = nbbo_df.append(quote_df)
             df = pd.concat([nbbo_df, quote_df])
             df = df.sort_values(['symbol', 'timestamp', 'qu_seqnum'])
+
+        if self.engine == 'polars':
+            taq_polars = backends.get_engine('polars')
+            return taq_polars.collect(
+                taq_polars.get_official_complete_nbbo(self, df=df,
+                                                      nbbo_df=nbbo_df,
+                                                      quote_df=quote_df),
+                to_pandas=not self.polars_output)
     
         # Remove duplicate quotes at same microsecond (keep last one based
         # on sequence number)
@@ -581,23 +910,74 @@ class TaqDaily():
         return df
     
     def clean_official_complete_nbbo(self, df):
+        check_pandas(df, 'clean_official_complete_nbbo')
         # Post-SQL query cleanup
         
         # Merge symbol
-        df['symbol'] = df['sym_root']
-        sel = df.sym_suffix.notnull()
-        df.loc[sel, 'symbol'] = (df.loc[sel, 'sym_root'] + ' ' + 
-                                 df.loc[sel, 'sym_suffix'])
-        
-        # Keep only relevant columns
-        # Columns to output
-        nbbo_out_cols = ['timestamp', 'symbol', 'best_bid', 'best_bidsizeshares',
+        symbol = merge_symbol(df)
+
+        # Sort by symbol and timestamp, and keep only relevant columns (one
+        # copy)
+        rows = np.lexsort((df['timestamp'].values,
+                           pd.factorize(symbol, sort=True)[0]))
+        nbbo_out_cols = ['timestamp', 'best_bid', 'best_bidsizeshares',
                          'best_ask', 'best_asksizeshares']
-        
-        df = df.sort_values(['symbol', 'timestamp'])
-        
-        return df[nbbo_out_cols]
+        nbbo_out_cols = [c for c in nbbo_out_cols if c in df.columns]
+        df = take_rows(df, rows, nbbo_out_cols)
+        df.insert(1, 'symbol', symbol[rows])
+        if self.price_scale is not None:
+            for c in ['best_bid', 'best_ask']:
+                df[c] = to_ticks(df[c].values, self.price_scale)
+        return df
     
+    #%% NBBO from exchange quotes
+
+    # NBBO rebuilt from all the exchange quotes of cqm_ (see
+    # taq_nbbo_build) instead of the nbbom_ file, e.g. for days where it is
+    # missing, or for the BBO of a subset of exchanges. Quotes are cleaned
+    # as in clean_quote_table, except that withdrawn quotes, crossed markets
+    # and abnormal spreads are kept: they replace (or remove) the quote of
+    # their exchange.
+    def get_nbbo_from_quotes(self, date=None, symbols=None, quote_df=None,
+                             exchanges=None, changes_only=True,
+                             use_numba=None):
+        from pytaq.taq_nbbo_build import build_nbbo
+
+        if quote_df is None:
+            taq = copy.copy(self)
+            taq.measures = None
+            taq.delete_withdrawned_quotes = False
+            taq.delete_crossed_markets = False
+            taq.delete_abnormal_spreads = False
+            quote_df = taq.get_quote_table(date, symbols, nbbo_only=False)
+        if not isinstance(quote_df, pd.DataFrame):
+            quote_df = quote_df.to_pandas()
+
+        df = build_nbbo(quote_df, exchanges=exchanges,
+                        changes_only=changes_only, use_numba=use_numba)
+        if self.price_scale is not None:
+            for c in ['best_bid', 'best_ask']:
+                df[c] = to_ticks(df[c].values, 1)
+        return df
+
+    #%% Persist cleaned day (memory-mapped store)
+
+    def persist_day(self, store, date, symbols=None, tables=None):
+        # store is a TaqMmapStore. Tables can then be read back with
+        # store.get_table() or store.get_arrays() (zero-copy).
+        if tables is None:
+            tables = ['nbbo', 'complete_nbbo', 'trades']
+        for table in tables:
+            if table == 'nbbo':
+                df = self.get_nbbo_table(date, symbols)
+            elif table == 'complete_nbbo':
+                df = self.get_official_complete_nbbo(date=date, symbols=symbols)
+            elif table == 'trades':
+                df = self.get_trade_table(date, symbols)
+            else:
+                raise Exception('Unknown table for persist_day(): ' + str(table))
+            store.write(date, table, df)
+
     #%% Spreads and depths
 
     def compute_spreads(self, date, symbols=None, off_nbbo_df=None, start_time_spreads=None,
@@ -610,41 +990,66 @@ class TaqDaily():
             start_time_spreads = self.start_time_trades
         if end_time_spreads is None:
             end_time_spreads = self.end_time_trades
+
+        if self.engine == 'polars':
+            taq_polars = backends.get_engine('polars')
+            spreads_df = taq_polars.collect(
+                taq_polars.compute_spreads(self, date, off_nbbo_df,
+                                           start_time_spreads,
+                                           end_time_spreads),
+                to_pandas=not self.polars_output,
+                index='symbol')
+            return spreads_df if len(spreads_df) > 0 else None
             
-        sel = ((off_nbbo_df.timestamp.dt.time >= start_time_spreads) &
-               (off_nbbo_df.timestamp.dt.time < end_time_spreads))
-        df = off_nbbo_df[sel].copy()
+        # Note: times are int64 nanoseconds (see taq_time)
+        t = taq_time.to_ns(off_nbbo_df['timestamp'].values)
+        sel = taq_time.in_window(np.mod(t, taq_time.ns_per_day),
+                                 start_time_spreads, end_time_spreads)
+        # Depths are only computed if the sizes were retrieved (see
+        # plan_columns)
+        depth = 'best_asksizeshares' in off_nbbo_df.columns
+        cols = ['timestamp', 'symbol', 'best_bid', 'best_ask']
+        if depth:
+            cols += ['best_bidsizeshares', 'best_asksizeshares']
+        df = take_rows(off_nbbo_df, sel, cols)
         
         if len(df) == 0:
             return None
         
-        # Compute time between each quote
-        df['inforce'] = df.groupby(['symbol'])['timestamp'].diff().dt.total_seconds()
-        df['inforce'] = df.groupby(['symbol'])['inforce'].shift(-1)
-        # The entries for last quote of the day are missing.
-        sel = df.inforce.isnull()
-        df.loc[sel, 'inforce'] = np.abs(
-            (datetime.combine(date, end_time_spreads) -
-             df.loc[sel, 'timestamp']).dt.total_seconds())
+        # Compute time between each quote and the next quote of the same
+        # symbol (in row order)
+        t = t[sel]
+        codes = pd.factorize(df['symbol'])[0]
+        order = np.argsort(codes, kind='stable')
+        has_next = np.zeros(len(t), dtype=bool)
+        has_next[order[:-1]] = codes[order[1:]] == codes[order[:-1]]
+        t_next = np.empty(len(t), dtype='i8')
+        t_next[order[:-1]] = t[order[1:]]
+        # The last quote of the day is in force until the end of the window
+        end = taq_time.day_ns(date) + taq_time.time_to_ns(end_time_spreads)
+        inforce = np.where(has_next, t_next - t, np.abs(end - t))
+        df['inforce'] = inforce / taq_time.ns_per_second
     
         # Delete locked and crossed quotes
+        # Note: instead of filtering the rows (another copy), they are left
+        # out of the groups below.
         sel = ((df.best_bid == df.best_ask) |
                (df.best_bid > df.best_ask))
-        df = df[~sel]
         
         # Compute spread measures
-        df['quoted_spread_dollar'] = df.best_ask - df.best_bid
+        df['quoted_spread_dollar'] = self.to_dollars(df.best_ask - df.best_bid)
         # Note: could use dask array da.log()
         df['quoted_spread_percent'] = np.log(df.best_ask) - np.log(df.best_bid)
-        df['best_ofr_depth_dollar'] = df.best_ask * df.best_asksizeshares
-        df['best_bid_depth_dollar'] = df.best_bid * df.best_bidsizeshares
-        df['best_ofr_depth_share'] = df.best_asksizeshares
-        df['best_bid_depth_share'] = df.best_bidsizeshares
+        measures = ['quoted_spread_dollar', 'quoted_spread_percent']
+        if depth:
+            df['best_ofr_depth_dollar'] = self.to_dollars(df.best_ask * df.best_asksizeshares)
+            df['best_bid_depth_dollar'] = self.to_dollars(df.best_bid * df.best_bidsizeshares)
+            df['best_ofr_depth_share'] = df.best_asksizeshares
+            df['best_bid_depth_share'] = df.best_bidsizeshares
+            measures += ['best_ofr_depth_dollar', 'best_bid_depth_dollar',
+                         'best_ofr_depth_share', 'best_bid_depth_share']
     
         # Compute daily weighted averages 
-        measures = ['quoted_spread_dollar', 'quoted_spread_percent',
-                    'best_ofr_depth_dollar', 'best_bid_depth_dollar',
-                    'best_ofr_depth_share', 'best_bid_depth_share']
         def compute_wspreads(x):
             out = {}
             for m in measures:
@@ -655,29 +1060,195 @@ class TaqDaily():
                     out[m] = np.average(y[m], weights=y['inforce'], axis=0)
             return pd.Series(out)
         
-        spreads_df = df.groupby('symbol')[measures +
-                                          ['inforce']].apply(compute_wspreads)
+        spreads_df = df.groupby(df['symbol'].where(~sel))[
+            measures + ['inforce']].apply(compute_wspreads)
         return spreads_df
-    
+
+    #%% Intraday spreads and depths (time buckets)
+
+    def compute_intraday_spreads(self, date, symbols=None, off_nbbo_df=None,
+                                 freq='5min', start_time_spreads=None,
+                                 end_time_spreads=None):
+        if off_nbbo_df is None:
+            off_nbbo_df = self.get_official_complete_nbbo(date=date, symbols=symbols)
+        check_pandas(off_nbbo_df, 'compute_intraday_spreads')
+
+        if start_time_spreads is None:
+            start_time_spreads = self.start_time_trades
+        if end_time_spreads is None:
+            end_time_spreads = self.end_time_trades
+
+        bucket_ns = taq_time.to_ns_delta(freq)
+        day_start = (taq_time.day_ns(date) +
+                     taq_time.time_to_ns(start_time_spreads))
+        window_ns = (taq_time.time_to_ns(end_time_spreads) -
+                     taq_time.time_to_ns(start_time_spreads))
+        n_buckets = -(-window_ns // bucket_ns)
+
+        df = off_nbbo_df
+        if not is_sorted(df, ['symbol', 'timestamp']):
+            df = df.sort_values(['symbol', 'timestamp'])
+        if len(df) == 0:
+            return None
+
+        # Each quote is in force from its timestamp until the next quote for
+        # the same symbol (or the end of the window). Unlike compute_spreads,
+        # the quote in force at the start of the window is carried in, so
+        # that the first bucket is fully covered.
+        t = taq_time.to_ns(df['timestamp'].values) - day_start
+        sym_codes, sym_names = pd.factorize(df['symbol'], sort=True)
+        t_next = np.full(t.shape, window_ns, dtype='i8')
+        same_sym = sym_codes[1:] == sym_codes[:-1]
+        t_next[:-1][same_sym] = t[1:][same_sym]
+        begin = np.clip(t, 0, window_ns)
+        finish = np.clip(t_next, 0, window_ns)
+
+        # Delete locked and crossed quotes (after computing the time in
+        # force, as in compute_spreads)
+        keep = ((finish > begin) &
+                ~(df['best_bid'].values >= df['best_ask'].values))
+        begin, finish, sym_codes = begin[keep], finish[keep], sym_codes[keep]
+        best_bid = df['best_bid'].values[keep]
+        best_ask = df['best_ask'].values[keep]
+
+        measures = {
+            'quoted_spread_dollar': self.to_dollars(best_ask - best_bid),
+            'quoted_spread_percent': np.log(best_ask) - np.log(best_bid)}
+        # Depths only if the sizes were retrieved (see plan_columns)
+        if 'best_asksizeshares' in df.columns:
+            bidsiz = df['best_bidsizeshares'].values[keep]
+            asksiz = df['best_asksizeshares'].values[keep]
+            measures['best_ofr_depth_dollar'] = self.to_dollars(best_ask * asksiz)
+            measures['best_bid_depth_dollar'] = self.to_dollars(best_bid * bidsiz)
+            measures['best_ofr_depth_share'] = asksiz
+            measures['best_bid_depth_share'] = bidsiz
+
+        # Split each interval across the bucket boundaries it spans: one
+        # piece per (quote, bucket) pair, weighted by the overlap.
+        first_bucket = begin // bucket_ns
+        n_pieces = (finish - 1) // bucket_ns - first_bucket + 1
+        quote_idx = np.repeat(np.arange(len(begin)), n_pieces)
+        piece_start = np.cumsum(n_pieces) - n_pieces
+        bucket = (first_bucket[quote_idx] +
+                  np.arange(len(quote_idx)) - piece_start[quote_idx])
+        inforce = (np.minimum(finish[quote_idx], (bucket + 1) * bucket_ns) -
+                   np.maximum(begin[quote_idx], bucket * bucket_ns)) / 1e9
+
+        key = sym_codes[quote_idx] * n_buckets + bucket
+        n_keys = len(sym_names) * n_buckets
+        total = np.bincount(key, weights=inforce, minlength=n_keys)
+        out = {}
+        for m, values in measures.items():
+            v = values[quote_idx]
+            valid = ~np.isnan(v)
+            w = np.where(valid, inforce, 0)
+            num = np.bincount(key, weights=np.where(valid, v * w, 0),
+                              minlength=n_keys)
+            den = np.bincount(key, weights=w, minlength=n_keys)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                out[m] = np.where(den > 0, num / den, np.nan)
+
+        sel = total > 0
+        keys = np.nonzero(sel)[0]
+        index = pd.MultiIndex.from_arrays(
+            [sym_names[keys // n_buckets],
+             taq_time.to_datetime64(day_start + (keys % n_buckets) * bucket_ns)],
+            names=['symbol', 'bucket'])
+        spreads_df = pd.DataFrame({m: v[sel] for m, v in out.items()},
+                                  index=index)
+        return spreads_df
+
+    #%%% On-disk output of the trade-level stages
+
+    def input_columns(self, df, nbbo_columns):
+        # Columns of the inputs (kept as float64 with float32=True)
+        nbbo_columns = [c for c in nbbo_columns
+                        if c not in ['timestamp', 'symbol']]
+        return (list(df.columns) + nbbo_columns +
+                [c + '_quote' for c in nbbo_columns] +
+                [c + '_next' for c in ['best_bid', 'best_ask']])
+
+    def write_output(self, df, date, output_path, row_group_size=2**20,
+                     float32=False, keep_columns=()):
+        # Writes a computed output (pandas or polars) by row groups, see
+        # taq_output.TradeWriter
+        from pytaq.taq_output import TradeWriter, output_date
+        writer = TradeWriter(output_path, output_date(date, df),
+                             row_group_size, float32, keep_columns)
+        try:
+            for i in range(0, len(df), row_group_size):
+                writer.write(df[i:i + row_group_size])
+            return writer.close()
+        finally:
+            writer.abort()
+
     #%%% Merge trades and NBBO
     # We merge the quote in effect at trade time
     
-    def merge_trades_nbbo(self, date=None, symbols=None, trade_df=None, off_nbbo_df=None, track_retail=None):
+    # Note: output_path is listed with the frames so that on-disk outputs
+    # are never memoized.
+    @cached_stage('merge_trades_nbbo', merge_attributes,
+                  frames=('trade_df', 'off_nbbo_df', 'nbbo_index', 'output_path'))
+    def merge_trades_nbbo(self, date=None, symbols=None, trade_df=None, off_nbbo_df=None, track_retail=None,
+                          nbbo_index=None, output_path=None, row_group_size=2**20,
+                          float32=False):
         if track_retail is None:
             track_retail = self.track_retail
 
         if trade_df is None:
             trade_df = self.get_trade_table(date=date, symbols=symbols)
-        if off_nbbo_df is None:
+        if (off_nbbo_df is None) and ((nbbo_index is None) or
+                                      (self.engine == 'polars')):
             off_nbbo_df = self.get_official_complete_nbbo(date=date, symbols=symbols)
 
-        trade_df = trade_df.sort_values(['timestamp', 'symbol'])
-        off_nbbo_df = off_nbbo_df.sort_values(['timestamp', 'symbol'])
-        
-        # Note: could use dask dataframe dd.merge_asof
-        df = pd.merge_asof(trade_df, off_nbbo_df, on='timestamp',
-                           by='symbol', allow_exact_matches=False,
-                           suffixes=('','_quote'))
+        if self.engine == 'polars':
+            taq_polars = backends.get_engine('polars')
+            df = taq_polars.collect(
+                taq_polars.merge_trades_nbbo(self, trade_df, off_nbbo_df,
+                                             track_retail=track_retail),
+                to_pandas=(not self.polars_output) and (output_path is None))
+            if output_path is None:
+                return df
+            return self.write_output(df, date, output_path, row_group_size,
+                                     float32, self.input_columns(
+                                         trade_df, off_nbbo_df.columns))
+
+        # Note: sort_values() copies the frame even if it is already sorted
+        if not is_sorted(trade_df, ['timestamp', 'symbol']):
+            trade_df = trade_df.sort_values(['timestamp', 'symbol'])
+        if nbbo_index is None:
+            nbbo_index = NbboIndex(off_nbbo_df)
+
+        if output_path is None:
+            return self.merge_trades_nbbo_chunk(trade_df, nbbo_index,
+                                                track_retail)
+
+        # Chunks of whole symbols, written as soon as they are merged
+        from pytaq.taq_output import TradeWriter, output_date, symbol_chunks
+        writer = TradeWriter(output_path, output_date(date, trade_df),
+                             row_group_size, float32,
+                             self.input_columns(trade_df, nbbo_index.columns))
+        try:
+            for rows in symbol_chunks(trade_df['symbol'].values, row_group_size):
+                writer.write(self.merge_trades_nbbo_chunk(
+                    take_rows(trade_df, rows), nbbo_index, track_retail))
+            return writer.close()
+        finally:
+            writer.abort()
+
+    def merge_trades_nbbo_chunk(self, trade_df, nbbo_index, track_retail):
+        # Trades (sorted by timestamp and symbol, all the trades of each of
+        # their symbols) merged with the NBBO of nbbo_index
+        
+        # Quote in effect at trade time (strictly before the trade), same
+        # output as pd.merge_asof(trade_df, off_nbbo_df, on='timestamp',
+        # by='symbol', allow_exact_matches=False, suffixes=('','_quote'))
+        quotes = nbbo_index.lookup(trade_df['symbol'], trade_df['timestamp'],
+                                   strict=True)
+        df = take_rows(trade_df, copy=not self.zero_copy)
+        df.index = quotes.index
+        for c in quotes.columns:
+            df[c + '_quote' if c in df.columns else c] = quotes[c].values
         
         # Note: H&J code is wrong I think, 
         # df = pd.merge_asof(trade_df, off_nbbo_df, on='timestamp',
@@ -693,7 +1264,8 @@ class TaqDaily():
         df.loc[sel, 'cross'] = 1
         
         # Trade direction (tick test)
-        df = df.sort_values(['timestamp', 'symbol'])
+        # Note: the lookup keeps the order of trade_df, so df is already
+        # sorted by timestamp and symbol.
         # Note: could use dask array da.sign
         df['dir'] = np.sign(df.groupby(['symbol'])['price'].diff())
         df.loc[df['dir'] == 0, 'dir'] = np.nan
@@ -714,15 +1286,21 @@ class TaqDaily():
         df.loc[sel_not_lc & (df['price'] == df['best_ask']), 'BuySellEMO'] = 1
         df.loc[sel_not_lc & (df['price'] == df['best_bid']), 'BuySellEMO'] = -1
         
-        df['ofr30'] = df['best_ask'] - 0.3 * (df['best_ask'] - df['best_bid'])
-        df['bid30'] = df['best_bid'] + 0.3 * (df['best_ask'] - df['best_bid'])
-        sel =  (df['price'] >= df['ofr30']) & (df['price'] <= df['best_ask'])
+        if self.price_scale is None:
+            ofr30 = df['best_ask'] - 0.3 * (df['best_ask'] - df['best_bid'])
+            bid30 = df['best_bid'] + 0.3 * (df['best_ask'] - df['best_bid'])
+            above_ofr30 = df['price'] >= ofr30
+            below_bid30 = df['price'] <= bid30
+        else:
+            # Exact in ticks: 10 * ofr30 = 7 * ask + 3 * bid
+            above_ofr30 = 10 * df['price'] >= 7 * df['best_ask'] + 3 * df['best_bid']
+            below_bid30 = 10 * df['price'] <= 7 * df['best_bid'] + 3 * df['best_ask']
+        sel =  above_ofr30 & (df['price'] <= df['best_ask'])
         df.loc[sel_not_lc & sel, 'BuySellCLNV'] = 1
-        sel =  (df['price'] <= df['bid30']) & (df['price'] >= df['best_bid'])
+        sel =  below_bid30 & (df['price'] >= df['best_bid'])
         df.loc[sel_not_lc & sel, 'BuySellCLNV'] = -1
         
-        for x in ['dir', 'ofr30', 'bid30']:
-            del df[x]
+        del df['dir']
         
         if track_retail:
             # Compute retail sign following "TRACKING RETAIL INVESTOR ACTIVITY"
@@ -736,10 +1314,22 @@ class TaqDaily():
                     if ((z >= 0.6) & (z < (1-1e-4))):
                         out[i] = 1.0
                 return out
+            def compute_retail_sign_ticks(s):
+                # Fraction of a cent, in ticks
+                cent = self.price_scale // 100
+                z = np.mod(s, cent)
+                return np.where((z > 0) & (10 * z < 4 * cent), -1.0,
+                                np.where(10 * z >= 6 * cent, 1.0, np.nan))
+            if (self.price_scale is not None) and (self.price_scale % 100 != 0):
+                raise Exception('price_scale must be a multiple of 100 for track_retail')
             sel = (df['ex'] == 'D')
             df['BuySellBJZ'] = np.nan
-            df.loc[sel, 'BuySellBJZ'] = \
-                compute_retail_sign(df.loc[sel,'price'].values)
+            if self.price_scale is None:
+                df.loc[sel, 'BuySellBJZ'] = \
+                    compute_retail_sign(df.loc[sel,'price'].values)
+            else:
+                df.loc[sel, 'BuySellBJZ'] = \
+                    compute_retail_sign_ticks(df.loc[sel,'price'].values)
             
             sel = df['BuySellBJZ'].isnull()
             for x in ['LR', 'EMO', 'CLNV']:
@@ -748,7 +1338,7 @@ class TaqDaily():
                                                                'BuySell' + x ]
                 
             
-        df['dollar'] = df['price'] * df['size']
+        df['dollar'] = self.to_dollars(df['price'] * df['size'])
         
         return df
     
@@ -756,59 +1346,140 @@ class TaqDaily():
     
     def compute_effective_spreads(self, date=None, symbols=None, trade_and_nbbo_df=None):
         if trade_and_nbbo_df is None:
-            df = self.merge_trades_nbbo(date=date, symbols=symbols)
-        else:
-            df = trade_and_nbbo_df.copy()
+            trade_and_nbbo_df = self.merge_trades_nbbo(date=date, symbols=symbols)
+        check_pandas(trade_and_nbbo_df, 'compute_effective_spreads')
     
-        sel = ((df.cross == 1) | (df.lock == 1))
-        df = df[~sel]
+        sel = ((trade_and_nbbo_df.cross == 1) | (trade_and_nbbo_df.lock == 1))
+        if self.zero_copy:
+            # Views of the input columns, measures are missing for locked and
+            # crossed quotes
+            df = take_rows(trade_and_nbbo_df, copy=False)
+            midpoint = df['midpoint'].where(~sel)
+        else:
+            df = take_rows(trade_and_nbbo_df, ~sel.values)
+            midpoint = df['midpoint']
         
-        df['DollarEffectiveSpread'] = np.abs(df['price'] - df['midpoint']) * 2
+        df['DollarEffectiveSpread'] = self.to_dollars(np.abs(df['price'] - midpoint) * 2)
         df['PercentEffectiveSpread'] = (np.abs(np.log(df['price']) - 
-                                                np.log(df['midpoint'])) * 2)
+                                                np.log(midpoint)) * 2)
         return df
             
     #%%%% Realized spread and price impact
     
     def compute_rs_and_pi(self, date=None, symbols=None, trade_and_nbbo_df=None, off_nbbo_df=None,
-                          delay=timedelta(minutes=5), suffix='5min', track_retail=None):
-        if off_nbbo_df is None:
-            off_nbbo_df = self.get_official_complete_nbbo(date=date, symbols=symbols)
-        if trade_and_nbbo_df is None:
-            trade_and_nbbo_df = self.merge_trades_nbbo(date=date,symbols=symbols,off_nbbo_df=off_nbbo_df)
-            
+                          delay=timedelta(minutes=5), suffix='5min', track_retail=None,
+                          nbbo_index=None, output_path=None, row_group_size=2**20,
+                          float32=False):
+        # With output_path (and the pandas engine), trades are merged with
+        # the NBBO by chunks of symbols as well, unless trade_and_nbbo_df is
+        # given.
         if track_retail is None:
             track_retail = self.track_retail
-        next_df = off_nbbo_df[['timestamp', 'symbol',
-                               'best_bid', 'best_ask']].copy()
+        chunked = (output_path is not None) and (self.engine != 'polars')
+        if ((trade_and_nbbo_df is None) & (off_nbbo_df is None) &
+                (nbbo_index is None) & (self.cache is not None) & (not chunked)):
+            # Fetch the merged trades on their own so that they can be
+            # memoized (both stages then come from the cache). The default
+            # track_retail is left as None so that the key is the same as a
+            # plain merge_trades_nbbo(date) call.
+            trade_and_nbbo_df = self.merge_trades_nbbo(
+                date=date, symbols=symbols,
+                track_retail=(None if track_retail == self.track_retail
+                              else track_retail))
+        if (off_nbbo_df is None) and ((nbbo_index is None) or
+                                      (self.engine == 'polars')):
+            off_nbbo_df = self.get_official_complete_nbbo(date=date, symbols=symbols)
+        if (nbbo_index is None) and (self.engine != 'polars'):
+            # Built once, for both the merge and the quotes after the delay
+            nbbo_index = NbboIndex(off_nbbo_df, columns=(
+                None if trade_and_nbbo_df is None else ['best_bid', 'best_ask']))
+        merge = chunked and (trade_and_nbbo_df is None)
+        if merge:
+            trade_and_nbbo_df = self.get_trade_table(date=date, symbols=symbols)
+        elif trade_and_nbbo_df is None:
+            trade_and_nbbo_df = self.merge_trades_nbbo(date=date,symbols=symbols,off_nbbo_df=off_nbbo_df,
+                                                       nbbo_index=nbbo_index,
+                                                       track_retail=track_retail)
+
+        if self.engine == 'polars':
+            taq_polars = backends.get_engine('polars')
+            df = taq_polars.collect(
+                taq_polars.compute_rs_and_pi(self, trade_and_nbbo_df,
+                                             off_nbbo_df, delay, suffix,
+                                             track_retail=track_retail),
+                to_pandas=(not self.polars_output) and (output_path is None))
+            if output_path is None:
+                return df
+            return self.write_output(df, date, output_path, row_group_size,
+                                     float32, self.input_columns(
+                                         trade_and_nbbo_df, off_nbbo_df.columns))
+
+        if not is_sorted(trade_and_nbbo_df, ['timestamp', 'symbol']):
+            trade_and_nbbo_df = trade_and_nbbo_df.sort_values(['timestamp',
+                                                               'symbol'])
+        if output_path is None:
+            return self.compute_rs_and_pi_chunk(trade_and_nbbo_df, nbbo_index,
+                                                delay, suffix, track_retail)
+
+        # Chunks of whole symbols, written as soon as they are computed
+        from pytaq.taq_output import TradeWriter, output_date, symbol_chunks
+        keep_columns = self.input_columns(trade_and_nbbo_df, nbbo_index.columns)
+        writer = TradeWriter(output_path, output_date(date, trade_and_nbbo_df),
+                             row_group_size, float32, keep_columns)
+        try:
+            for rows in symbol_chunks(trade_and_nbbo_df['symbol'].values,
+                                      row_group_size):
+                df = take_rows(trade_and_nbbo_df, rows)
+                if merge:
+                    df = self.merge_trades_nbbo_chunk(df, nbbo_index,
+                                                      track_retail)
+                writer.write(self.compute_rs_and_pi_chunk(df, nbbo_index,
+                                                          delay, suffix,
+                                                          track_retail))
+            return writer.close()
+        finally:
+            writer.abort()
+
+    def compute_rs_and_pi_chunk(self, trade_and_nbbo_df, nbbo_index, delay,
+                                suffix, track_retail):
+        # Last quote strictly before trade time + delay (i.e. the quote
+        # timestamp - delay is before the trade), looked up in the index
+        # without merging or sorting the trades and quotes.
+        next_df = nbbo_index.lookup(trade_and_nbbo_df['symbol'],
+                                    trade_and_nbbo_df['timestamp'],
+                                    offset=delay, strict=True,
+                                    columns=['best_bid', 'best_ask'])
         next_df['midpoint'] = (next_df['best_bid'] + next_df['best_ask']) / 2
-        next_df['timestamp'] = next_df['timestamp'] - delay
     
-        trade_and_nbbo_df = trade_and_nbbo_df.sort_values(['timestamp',
-                                                           'symbol'])
-        next_df = next_df.sort_values(['timestamp', 'symbol'])
-        # Note: could use dask dataframe dd.merge_asof
-        df = pd.merge_asof(trade_and_nbbo_df, next_df, on='timestamp',
-                              by='symbol', allow_exact_matches=False,
-                              suffixes=('','_next'))
-    
-        sel = ((df.best_bid_next == df.best_ask_next) |
-                (df.best_bid_next > df.best_ask_next))
-        df = df[~sel]
+        sel = ((next_df.best_bid == next_df.best_ask) |
+                (next_df.best_bid > next_df.best_ask)).values
+        if self.zero_copy:
+            # Views of the input columns, measures are missing for locked and
+            # crossed quotes
+            df = take_rows(trade_and_nbbo_df, copy=False)
+            rows = slice(None)
+            next_df.loc[sel, 'midpoint'] = np.nan
+        else:
+            rows = np.flatnonzero(~sel)
+            df = take_rows(trade_and_nbbo_df, rows)
+            # Same index as the merged trades
+            df.index = rows
+        for x in ['best_bid', 'best_ask', 'midpoint']:
+            df[x + '_next'] = next_df[x].values[rows]
         
         signs = ['LR', 'EMO', 'CLNV']
         if track_retail:
             signs += ['BJZ'] + [x + 'notBJZ' for x in signs]
     
         for sign in signs:
-            df['DollarRealizedSpread_' + sign + suffix] = \
-                df['BuySell' + sign] * (df['price'] - df['midpoint_next']) * 2
+            df['DollarRealizedSpread_' + sign + suffix] = self.to_dollars(
+                df['BuySell' + sign] * (df['price'] - df['midpoint_next']) * 2)
             df['PercentRealizedSpread_' + sign + suffix] = \
                 (df['BuySell' + sign] * (np.log(df['price']) -
                                          np.log(df['midpoint_next'])) * 2)
-            df['DollarPriceImpact_' + sign + suffix] = \
-                (df['BuySell' + sign] * (df['midpoint_next'] -
-                                         df['midpoint']) * 2)
+            df['DollarPriceImpact_' + sign + suffix] = self.to_dollars(
+                df['BuySell' + sign] * (df['midpoint_next'] -
+                                        df['midpoint']) * 2)
             df['PercentPriceImpact_' + sign + suffix] = \
                 (df['BuySell' + sign] * (np.log(df['midpoint_next']) -
                                          np.log(df['midpoint'])) * 2)
@@ -820,6 +1491,7 @@ class TaqDaily():
     
     def compute_averages_ave_sw_dw(self, df, measures, simple=True,
                                    dollar_weighted=True, share_weighted=True):
+        check_pandas(df, 'compute_averages_ave_sw_dw')
         weights = []
         if dollar_weighted: weights.append('dollar')
         if share_weighted: weights.append('size')
@@ -848,5 +1520,156 @@ class TaqDaily():
             return pd.Series(out)
         
         out_df = df.groupby('symbol')[measures + weights].apply(compute_wavg)
-        
+
         return out_df
+
+    #%%%% Intraday averages (time buckets)
+
+    def compute_intraday_averages_ave_sw_dw(self, df, measures, freq='5min',
+                                            start_time=None, end_time=None,
+                                            simple=True, dollar_weighted=True,
+                                            share_weighted=True, volume=True):
+        check_pandas(df, 'compute_intraday_averages_ave_sw_dw')
+        if start_time is None:
+            start_time = self.start_time_trades
+        if end_time is None:
+            end_time = self.end_time_trades
+
+        bucket = taq_time.to_ns_delta(freq)
+        start = taq_time.time_to_ns(start_time)
+
+        t = taq_time.to_ns(df['timestamp'].values)
+        time_of_day = np.mod(t, taq_time.ns_per_day)
+        sel = taq_time.in_window(time_of_day, start_time, end_time)
+        df = df[sel]
+        t, time_of_day = t[sel], time_of_day[sel]
+        bucket_start = pd.Series(taq_time.to_datetime64(
+            t - time_of_day + start + ((time_of_day - start) // bucket) * bucket),
+            index=df.index)
+
+        out_df = self.aggregate_ave_sw_dw(
+            df, measures, [df['symbol'], bucket_start.rename('bucket')],
+            simple=simple, dollar_weighted=dollar_weighted,
+            share_weighted=share_weighted)
+
+        if volume:
+            grp = df.groupby([df['symbol'], bucket_start.rename('bucket')])
+            out_df['n_trades'] = grp['price'].count()
+            out_df['volume_share'] = grp['size'].sum()
+            out_df['volume_dollar'] = grp['dollar'].sum()
+
+        return out_df
+
+    # Vectorized equivalent of compute_averages_ave_sw_dw for arbitrary
+    # grouping keys: sums of measures and weights are computed in one groupby
+    # and divided afterwards, instead of calling np.average on each group.
+    def aggregate_ave_sw_dw(self, df, measures, by, simple=True,
+                            dollar_weighted=True, share_weighted=True):
+        sums = self.sum_ave_sw_dw(df, measures, by, simple=simple,
+                                  dollar_weighted=dollar_weighted,
+                                  share_weighted=share_weighted)
+        return self.finalize_ave_sw_dw(sums, measures, simple=simple,
+                                       dollar_weighted=dollar_weighted,
+                                       share_weighted=share_weighted)
+
+    # Partial sums of aggregate_ave_sw_dw for each group. Sums of groups can
+    # be added up to get the sums of coarser groups (see aggregate_cube).
+    def sum_ave_sw_dw(self, df, measures, by, simple=True,
+                      dollar_weighted=True, share_weighted=True,
+                      volume=False, dropna=True):
+        check_pandas(df, 'sum_ave_sw_dw')
+        weights = []
+        if dollar_weighted: weights.append('dollar')
+        if share_weighted: weights.append('size')
+
+        if isinstance(by, str):
+            by = [by]
+        by = [df[k] if isinstance(k, str) else k for k in by]
+
+        sums = {}
+        for m in measures:
+            # Same rows as the dropna() in compute_averages_ave_sw_dw
+            valid = df[m].notnull()
+            for w in weights:
+                valid &= df[w].notnull()
+            v = df[m].where(valid, 0)
+            if simple:
+                sums[m + '_n'] = valid.astype(float)
+                sums[m + '_sum'] = v
+            for w in weights:
+                x = df[w].where(valid, 0)
+                sums[m + '_' + w] = x
+                sums[m + '_' + w + '_sum'] = v * x
+        if volume:
+            sums['n_trades'] = df['price'].notnull().astype('int64')
+            sums['volume_share'] = df['size']
+            sums['volume_dollar'] = df['dollar']
+
+        return pd.DataFrame(sums, index=df.index).groupby(
+            by, dropna=dropna, observed=True).sum()
+
+    def finalize_ave_sw_dw(self, sums, measures, simple=True,
+                           dollar_weighted=True, share_weighted=True):
+        out = {}
+        for m in measures:
+            if simple:
+                out[m + '_Ave'] = (sums[m + '_sum'] /
+                                   sums[m + '_n'].where(sums[m + '_n'] > 0))
+            if dollar_weighted:
+                out[m + '_DW'] = (sums[m + '_dollar_sum'] /
+                                  sums[m + '_dollar'].where(sums[m + '_dollar'] != 0))
+            if share_weighted:
+                out[m + '_SW'] = (sums[m + '_size_sum'] /
+                                  sums[m + '_size'].where(sums[m + '_size'] != 0))
+        return pd.DataFrame(out, index=sums.index)
+
+    # Averages (as in aggregate_ave_sw_dw) for several grouping sets at
+    # once, e.g. [['symbol'], ['symbol', 'ex'], ['symbol', retail]]. Keys are
+    # column names or Series (e.g. size_buckets(), or
+    # df['BuySellBJZ'].notnull().rename('retail')), and an empty set gives
+    # the totals. Partial sums are computed in one groupby by all the keys,
+    # and added up for each grouping set. Rows with missing keys are kept in
+    # their own groups.
+    def aggregate_cube(self, df, measures, grouping_sets, simple=True,
+                       dollar_weighted=True, share_weighted=True, volume=True):
+        names = []
+        by = []
+        for keys in grouping_sets:
+            for k in keys:
+                name = k if isinstance(k, str) else k.name
+                if name is None:
+                    raise Exception('Grouping keys of aggregate_cube must be named')
+                if name not in names:
+                    names.append(name)
+                    by.append(df[k] if isinstance(k, str) else k.rename(name))
+
+        sums = self.sum_ave_sw_dw(df, measures, by, simple=simple,
+                                  dollar_weighted=dollar_weighted,
+                                  share_weighted=share_weighted,
+                                  volume=volume, dropna=False)
+
+        out = {}
+        for keys in grouping_sets:
+            levels = tuple(k if isinstance(k, str) else k.name for k in keys)
+            if len(levels) == 0:
+                x = sums.sum().to_frame().T
+            elif list(levels) == names:
+                x = sums
+            else:
+                x = sums.groupby(level=list(levels), dropna=False,
+                                 observed=True).sum()
+            out_df = self.finalize_ave_sw_dw(x, measures, simple=simple,
+                                             dollar_weighted=dollar_weighted,
+                                             share_weighted=share_weighted)
+            if volume:
+                for c in ['n_trades', 'volume_share', 'volume_dollar']:
+                    out_df[c] = x[c]
+            out[levels] = out_df
+        return out
+
+    # Trade size buckets [bins[i], bins[i+1]) of column ('size' or 'dollar'),
+    # to be used as a grouping key
+    def size_buckets(self, df, bins=(0, 100, 500, 1000, 5000, 10000, np.inf),
+                     column='size'):
+        return pd.cut(df[column], bins=list(bins), right=False).rename(
+            column + '_bucket')
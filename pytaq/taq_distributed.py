@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Distributed computation of daily measures over many dates.
+
+A TaqDistributed object splits the work in tasks (one per date, or per date
+and shard of symbols) and submits them to an executor: a Dask distributed
+Client (multi-node, or a local multi-process cluster with local_cluster()),
+or any concurrent.futures executor (e.g. ProcessPoolExecutor).
+
+Tasks run compute_measures() (see TaqStore) with a copy of the TaqDaily
+object, without its db and cache: connections are opened on the workers with
+connect() and reused by the tasks of the same process. Intermediate tables
+larger than cache_bytes are spilled to spill_path by the StageCache of the
+task. Failed tasks (including tasks of a worker that died) are submitted
+again, up to retries times. With Dask, placement(date) gives the workers
+holding the local mirror of a date, on which its tasks are preferably run.
+
+Daily results are gathered by the driver, and each date is written to a
+TaqStore if given as soon as all its tasks are done (skipping the dates it
+already holds for the same configuration), so that a task failing after its
+retries does not discard the dates already computed.
+"""
+
+import copy
+import os
+import shutil
+import uuid
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+from pytaq.taq_cache import StageCache
+from pytaq.taq_store import TaqStore, compute_measures, config_hashes
+
+
+# Connections opened by connect() in each worker process
+worker_connections = {}
+
+
+def run_task(taq, connect, key, date, symbols, measures, delay, suffix,
+             cache_bytes, spill_path):
+    taq = copy.copy(taq)
+    if connect is not None:
+        if key not in worker_connections:
+            worker_connections[key] = connect()
+        taq.db = worker_connections[key]
+    cache_path = None
+    if spill_path is not None:
+        cache_path = os.path.join(spill_path, key + '-' + str(os.getpid()))
+        taq.cache = StageCache(cache_bytes, cache_path)
+    try:
+        return compute_measures(taq, date, symbols, measures, delay, suffix)
+    except Exception:
+        # The connection may be broken, open a new one for the next task
+        worker_connections.pop(key, None)
+        raise
+    finally:
+        if cache_path is not None:
+            shutil.rmtree(cache_path, ignore_errors=True)
+
+
+class TaqDistributed():
+    def __init__(self, taq, client, connect=None, store=None, shards=None,
+                 retries=3, placement=None, cache_bytes=2 * 2**30,
+                 spill_path=None):
+        # taq: TaqDaily object with the configuration (its db and cache are
+        # not sent to the workers).
+        # connect: function opening the db on the workers (e.g.
+        # functools.partial(TaqDuckDB, path)), it must be picklable.
+        # shards: number of shards of symbols, or list of lists of symbols.
+        # Without symbols, the symbols of each date are read on the driver
+        # with connect().
+        self.taq = copy.copy(taq)
+        self.taq.db = None
+        self.taq.cache = None
+        self.client = client
+        self.connect = connect
+        self.store = store
+        self.shards = shards
+        self.retries = retries
+        self.placement = placement
+        self.cache_bytes = cache_bytes
+        self.spill_path = spill_path
+        self.key = uuid.uuid4().hex
+        # Connection of the driver, to list the symbols of a date
+        self.db = None
+
+        # Statistics
+        self.tasks = 0
+        self.retried = 0
+
+    @staticmethod
+    def local_cluster(n_workers=4, threads_per_worker=1, memory_limit='4GB',
+                      local_directory=None):
+        # Dask client of a local multi-process cluster. Workers spill to
+        # local_directory beyond their memory_limit.
+        from dask.distributed import Client, LocalCluster
+        cluster = LocalCluster(n_workers=n_workers,
+                               threads_per_worker=threads_per_worker,
+                               processes=True, memory_limit=memory_limit,
+                               local_directory=local_directory)
+        return Client(cluster)
+
+    def is_dask(self):
+        return type(self.client).__module__.startswith('distributed')
+
+    def date_symbols(self, date):
+        if self.connect is None:
+            raise Exception('TaqDistributed needs symbols or connect to ' +
+                            'split the work in shards')
+        if self.db is None:
+            self.db = self.connect()
+        taq = copy.copy(self.taq)
+        taq.db = self.db
+        return sorted(taq.get_nbbo_symbols(date))
+
+    def symbol_shards(self, date, symbols):
+        if self.shards is None:
+            return [symbols]
+        if isinstance(self.shards, int):
+            if symbols is None:
+                # Same symbols as a task of the whole date
+                symbols = self.date_symbols(date)
+            return [list(x) for x in np.array_split(np.asarray(symbols, dtype=object),
+                                                    self.shards) if len(x) > 0]
+        return [list(x) for x in self.shards]
+
+    def submit(self, task):
+        date, symbols = task['date'], task['symbols']
+        args = (run_task, self.taq, self.connect, self.key, date, symbols,
+                task['measures'], task['delay'], task['suffix'],
+                self.cache_bytes, self.spill_path)
+        self.tasks += 1
+        if self.is_dask():
+            workers = None
+            if self.placement is not None:
+                workers = self.placement(date)
+            return self.client.submit(*args, workers=workers,
+                                      allow_other_workers=True, pure=False)
+        return self.client.submit(*args)
+
+    def compute(self, dates, symbols=None, measures=None,
+                delay=timedelta(minutes=5), suffix='5min', overwrite=False):
+        if measures is None:
+            measures = TaqStore.measures
+        hashes, configs = config_hashes(self.taq, measures, delay, suffix,
+                                        symbols)
+
+        tasks = []
+        for date in dates:
+            todo = list(measures)
+            if (self.store is not None) and not overwrite:
+                todo = [m for m in measures
+                        if not self.store.has(m, date, hashes[m])]
+            if len(todo) == 0:
+                continue
+            for shard in self.symbol_shards(date, symbols):
+                tasks.append({'date': date, 'symbols': shard, 'measures': todo,
+                              'delay': delay, 'suffix': suffix, 'attempts': 0})
+
+        futures = [self.submit(t) for t in tasks]
+        shards_left = {}
+        for t in tasks:
+            shards_left[t['date']] = shards_left.get(t['date'], 0) + 1
+        results = {}
+        panels = {}
+        failed = {}
+        i = 0
+        while i < len(tasks):
+            date = tasks[i]['date']
+            try:
+                out = futures[i].result()
+            except Exception as e:
+                tasks[i]['attempts'] += 1
+                if tasks[i]['attempts'] <= self.retries:
+                    self.retried += 1
+                    futures[i] = self.submit(tasks[i])
+                    continue
+                # The other dates are still computed and stored, the error
+                # is raised at the end
+                failed.setdefault(date, e)
+                results.pop(date, None)
+                futures[i] = None
+                i += 1
+                continue
+            futures[i] = None
+            if date not in failed:
+                for m, df in out.items():
+                    results.setdefault(date, {}).setdefault(m, []).append(df)
+            shards_left[date] -= 1
+            if (shards_left[date] == 0) and (date not in failed):
+                # All the shards of the date are done, write it right away
+                self.write_date(date, tasks[i]['measures'],
+                                results.pop(date, {}), hashes, configs, panels)
+            i += 1
+
+        if len(failed) > 0:
+            raise next(iter(failed.values()))
+        return {m: pd.concat(dfs).sort_index() for m, dfs in panels.items()}
+
+    def write_date(self, date, measures, results, hashes, configs, panels):
+        for m in measures:
+            if m not in results:
+                # Same as TaqStore.compute, dates without results are recorded
+                if self.store is not None:
+                    self.store.write_empty(m, date, hashes[m],
+                                           config=configs[m])
+                continue
+            df = pd.concat(results[m])
+            if self.store is not None:
+                self.store.write(m, date, df, hashes[m], config=configs[m])
+            panels.setdefault(m, []).append(
+                pd.concat({pd.Timestamp(date): df}, names=['date']))
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DuckDB engine over a local Parquet mirror of the TAQ tables.
+
+Files are read from <path>/<table>/date=<YYYYMMDD>/*.parquet, where <table>
+is nbbom, cqm, ctm or complete_nbbo. A TaqDuckDB object can be used as the
+db of TaqDaily(method='DuckDB', db=...), in which case the get_* methods
+read the files instead of querying WRDS. The compute_* methods of TaqDuckDB
+run the whole pipeline (H&J cleaning, complete NBBO, trade-NBBO as-of join
+and daily measures) as SQL, so that DuckDB can use all cores and spill to
+disk instead of loading the day in pandas.
+
+The compute_* SQL pipeline reads the full column lists of TaqDaily and
+ignores TaqDaily.measures, and does not support TaqDaily.price_scale.
+"""
+
+import os
+
+import duckdb
+
+from pytaq.backends import PostgreSQLBackend
+
+
+# TaqDaily(method='DuckDB') backend: the PostgreSQL queries, run by the
+# TaqDuckDB object (db) on the local files.
+class DuckDBBackend(PostgreSQLBackend):
+    def table_source(self, taq, table):
+        return taq.db.source(table)
+
+    def get_nbbo_symbols(self, taq, date):
+        nbbo_table = 'nbbom_' + date.strftime('%Y%m%d')
+        df = taq.db.raw_sql('SELECT DISTINCT sym_root AS symbol FROM ' +
+                            self.table_source(taq, nbbo_table))
+        return [x for x in df.symbol.unique()]
+
+
+class TaqDuckDB():
+    def __init__(self, path, database=':memory:', temp_directory=None,
+                 memory_limit=None, threads=None):
+        self.path = path
+        self.con = duckdb.connect(database)
+        # Intermediate tables larger than memory_limit are spilled to
+        # temp_directory
+        if temp_directory is not None:
+            self.con.execute("SET temp_directory = '" + temp_directory + "'")
+        if memory_limit is not None:
+            self.con.execute("SET memory_limit = '" + memory_limit + "'")
+        if threads is not None:
+            self.con.execute('SET threads = ' + str(int(threads)))
+
+    def source(self, table):
+        # e.g. 'nbbom_20161207'
+        prefix, date = table.rsplit('_', 1)
+        files = os.path.join(self.path, prefix, 'date=' + date, '*.parquet')
+        # Parquet files written by pyarrow flag times as UTC-adjusted, which
+        # DuckDB reads as TIME WITH TIME ZONE. The date=<YYYYMMDD> directory
+        # must not replace the date column of the files.
+        return ("(SELECT * REPLACE (CAST(time_m AS TIME) AS time_m) " +
+                "FROM read_parquet('" + files + "', hive_partitioning = false))")
+
+    # Same interface as wrds.Connection
+    def raw_sql(self, sql):
+        return self.con.execute(sql).df()
+
+    def check_taq(self, taq):
+        if (taq.method != 'DuckDB') or (taq.db is not self):
+            raise Exception('TaqDuckDB needs TaqDaily(method=\'DuckDB\', ' +
+                            'db=<this TaqDuckDB>)')
+        if taq.price_scale is not None:
+            # The SQL pipeline works in dollars
+            raise Exception('price_scale is not supported by the TaqDuckDB ' +
+                            'compute_* methods')
+
+    #%% Cleaning (same steps as TaqDaily.clean_nbbo_table and
+    #   clean_quote_table). Note that comparisons with NULL are never true,
+    #   as with NaN in pandas.
+
+    def symbol_sql(self):
+        return ("CASE WHEN sym_suffix IS NULL THEN sym_root " +
+                "ELSE sym_root || ' ' || sym_suffix END")
+
+    def cond_sql(self, taq):
+        conds = []
+        if taq.keep_qu_cond is not None:
+            conds.append("qu_cond IN ('" + "','".join(taq.keep_qu_cond) + "')")
+        if taq.delete_canceled_quotes:
+            conds.append("qu_cancel IS DISTINCT FROM 'B'")
+        return conds
+
+    def nbbo_sql(self, taq, date, symbols=None):
+        conds = self.cond_sql(taq)
+        if taq.delete_empty_quotes:
+            conds.append(
+                'NOT (coalesce(best_ask <= 0 AND best_bid <= 0, false) OR ' +
+                'coalesce(best_asksiz <= 0 AND best_bidsiz <= 0, false) OR ' +
+                '(best_ask IS NULL AND best_bid IS NULL) OR ' +
+                '(best_asksiz IS NULL AND best_bidsiz IS NULL))')
+        where = (' WHERE ' + ' AND '.join(conds)) if len(conds) > 0 else ''
+
+        ask_bad = ('(best_ask <= 0 OR best_ask IS NULL OR best_asksiz <= 0 ' +
+                   'OR best_asksiz IS NULL)')
+        bid_bad = ('(best_bid <= 0 OR best_bid IS NULL OR best_bidsiz <= 0 ' +
+                   'OR best_bidsiz IS NULL)')
+        sql = ('SELECT date + time_m AS timestamp, ' + self.symbol_sql() +
+               ' AS symbol, qu_seqnum, best_bidex, best_askex, ' +
+               'best_ask - best_bid AS spread, ' +
+               '(best_ask + best_bid) / 2 AS midpoint, ' +
+               'CASE WHEN ' + bid_bad + ' THEN NULL ELSE best_bid END AS best_bid, ' +
+               'CASE WHEN ' + bid_bad + ' THEN NULL ELSE best_bidsiz * 100 END AS best_bidsizeshares, ' +
+               'CASE WHEN ' + ask_bad + ' THEN NULL ELSE best_ask END AS best_ask, ' +
+               'CASE WHEN ' + ask_bad + ' THEN NULL ELSE best_asksiz * 100 END AS best_asksizeshares' +
+               ' FROM (' +
+               taq.get_nbbo_table_sql(date, symbols, taq.nbbo_columns) +
+               ')' + where)
+
+        window = ' OVER (PARTITION BY symbol ORDER BY timestamp, qu_seqnum)'
+        if taq.delete_abnormal_spreads:
+            bid_sel = ('spread > ' + str(taq.max_spread) +
+                       ' AND best_bid < lmid - ' + str(taq.max_quote_change))
+            ask_sel = ('spread > ' + str(taq.max_spread) +
+                       ' AND best_ask > lmid + ' + str(taq.max_quote_change))
+            sql = ('SELECT timestamp, symbol, qu_seqnum, best_bidex, best_askex, ' +
+                   'CASE WHEN ' + bid_sel + ' THEN NULL ELSE best_bid END AS best_bid, ' +
+                   'CASE WHEN ' + bid_sel + ' THEN NULL ELSE best_bidsizeshares END AS best_bidsizeshares, ' +
+                   'CASE WHEN ' + ask_sel + ' THEN NULL ELSE best_ask END AS best_ask, ' +
+                   'CASE WHEN ' + ask_sel + ' THEN NULL ELSE best_asksizeshares END AS best_asksizeshares' +
+                   ' FROM (SELECT *, lag(midpoint)' + window + ' AS lmid FROM (' +
+                   sql + '))')
+
+        if taq.keep_changes_only:
+            changed = ' OR '.join('coalesce(' + c + ' <> lag(' + c + ')' +
+                                  window + ', true)'
+                                  for c in ['best_ask', 'best_bid',
+                                            'best_bidsizeshares',
+                                            'best_asksizeshares'])
+            sql = ('SELECT * EXCLUDE (changed) FROM (SELECT *, ' + changed +
+                   ' AS changed FROM (' + sql + ')) WHERE changed')
+
+        return ('SELECT timestamp, symbol, best_bid, best_bidsizeshares, ' +
+                'best_bidex, best_ask, best_asksizeshares, best_askex, ' +
+                'qu_seqnum FROM (' + sql + ')')
+
+    def quote_sql(self, taq, date, symbols=None):
+        conds = self.cond_sql(taq)
+        if taq.delete_crossed_markets:
+            conds.append('bid <= ask')
+        if taq.delete_abnormal_spreads:
+            conds.append('ask - bid <= ' + str(taq.max_spread))
+        if taq.delete_withdrawned_quotes:
+            conds.append('ask > 0 AND asksiz > 0 AND bid > 0 AND bidsiz > 0')
+        # Keep only those to be merged with NBBO file
+        conds.append("((qu_source = 'C' AND natbbo_ind = '1') OR " +
+                     "(qu_source = 'N' AND natbbo_ind = '4'))")
+
+        return ('SELECT date + time_m AS timestamp, ' + self.symbol_sql() +
+                ' AS symbol, bid AS best_bid, bidsiz * 100 AS best_bidsizeshares, ' +
+                'ex AS best_bidex, ask AS best_ask, asksiz * 100 AS best_asksizeshares, ' +
+                'ex AS best_askex, qu_seqnum FROM (' +
+                taq.get_quote_table_sql(date, symbols, taq.quote_columns) +
+                ') WHERE ' +
+                ' AND '.join(conds))
+
+    #%% Complete NBBO
+
+    def complete_nbbo_sql(self, taq, date, symbols=None):
+        sql = (self.nbbo_sql(taq, date, symbols) + ' UNION ALL ' +
+               self.quote_sql(taq, date, symbols))
+        if not taq.keep_changes_only:
+            return sql
+        # Same as groupby().last() in pandas: last non-missing value of each
+        # column at a given microsecond, ordered by sequence number.
+        cols = ['best_bid', 'best_bidsizeshares', 'best_bidex', 'best_ask',
+                'best_asksizeshares', 'best_askex', 'qu_seqnum']
+        return ('SELECT symbol, timestamp, ' +
+                ', '.join('arg_max(' + c + ', qu_seqnum) FILTER (WHERE ' + c +
+                          ' IS NOT NULL) AS ' + c for c in cols) +
+                ' FROM (' + sql + ') GROUP BY symbol, timestamp')
+
+    #%% Trades merged with NBBO
+
+    def merge_trades_nbbo_sql(self, taq, date, symbols=None,
+                              nbbo_table='complete_nbbo', track_retail=None):
+        if track_retail is None:
+            track_retail = taq.track_retail
+
+        trades = ('SELECT date + time_m AS timestamp, ' + self.symbol_sql() +
+                  ' AS symbol, ex, size, price, tr_seqnum FROM (' +
+                  taq.get_trade_table_sql(date, symbols,
+                                          columns=taq.trade_columns) + ')')
+        merged = ('SELECT t.*, q.best_bid, q.best_bidsizeshares, q.best_bidex, ' +
+                  'q.best_ask, q.best_asksizeshares, q.best_askex, q.qu_seqnum, ' +
+                  '(q.best_bid + q.best_ask) / 2 AS midpoint, ' +
+                  'CASE WHEN q.best_bid = q.best_ask THEN 1 ELSE 0 END AS "lock", ' +
+                  'CASE WHEN q.best_bid > q.best_ask THEN 1 ELSE 0 END AS "cross" ' +
+                  'FROM (' + trades + ') t ASOF LEFT JOIN ' + nbbo_table + ' q ' +
+                  'ON t.symbol = q.symbol AND t.timestamp > q.timestamp')
+
+        # Trade direction (tick test)
+        window = 'PARTITION BY symbol ORDER BY timestamp, tr_seqnum'
+        tick = ('SELECT *, nullif(sign(price - lag(price) OVER (' + window +
+                ')), 0) AS tick FROM (' + merged + ')')
+        direction = ('SELECT * EXCLUDE (tick), last_value(tick IGNORE NULLS) ' +
+                     'OVER (' + window + ' ROWS BETWEEN UNBOUNDED PRECEDING ' +
+                     'AND CURRENT ROW) AS dir FROM (' + tick + ')')
+
+        not_lc = '"lock" = 0 AND "cross" = 0 AND '
+        ofr30 = '(best_ask - 0.3 * (best_ask - best_bid))'
+        bid30 = '(best_bid + 0.3 * (best_ask - best_bid))'
+        signs = ('CASE WHEN ' + not_lc + 'price > midpoint THEN 1 ' +
+                 'WHEN ' + not_lc + 'price < midpoint THEN -1 ' +
+                 'ELSE dir END AS BuySellLR, ' +
+                 'CASE WHEN ' + not_lc + 'price = best_bid THEN -1 ' +
+                 'WHEN ' + not_lc + 'price = best_ask THEN 1 ' +
+                 'ELSE dir END AS BuySellEMO, ' +
+                 'CASE WHEN ' + not_lc + 'price <= ' + bid30 + ' AND price >= best_bid THEN -1 ' +
+                 'WHEN ' + not_lc + 'price >= ' + ofr30 + ' AND price <= best_ask THEN 1 ' +
+                 'ELSE dir END AS BuySellCLNV')
+        sql = ('SELECT * EXCLUDE (dir), ' + signs + ', price * size AS dollar ' +
+               'FROM (' + direction + ')')
+
+        if track_retail:
+            # Retail sign following Boehmer, Jones, and Zhang
+            z = '100 * fmod(price, 0.01)'
+            sql = ('SELECT *, CASE WHEN ex = \'D\' AND ' + z + ' >= 0.6 AND ' +
+                   z + ' < 1 - 1e-4 THEN 1 WHEN ex = \'D\' AND ' + z +
+                   ' >= 1e-4 AND ' + z + ' < 0.4 THEN -1 END AS BuySellBJZ ' +
+                   'FROM (' + sql + ')')
+            sql = ('SELECT *, ' + ', '.join(
+                'CASE WHEN BuySellBJZ IS NULL THEN BuySell' + x +
+                ' END AS BuySell' + x + 'notBJZ' for x in ['LR', 'EMO', 'CLNV']) +
+                ' FROM (' + sql + ')')
+        return sql
+
+    #%% Daily measures
+
+    def spreads_sql(self, taq, date, nbbo_table='complete_nbbo',
+                    start_time_spreads=None, end_time_spreads=None):
+        if start_time_spreads is None:
+            start_time_spreads = taq.start_time_trades
+        if end_time_spreads is None:
+            end_time_spreads = taq.end_time_trades
+        end = ("TIMESTAMP '" + date.strftime('%Y-%m-%d') + ' ' +
+               taq.time_to_sql(end_time_spreads, '') + "'")
+
+        inforce = ('coalesce(epoch_us(lead(timestamp) OVER (PARTITION BY ' +
+                   'symbol ORDER BY timestamp)) - epoch_us(timestamp), ' +
+                   'abs(epoch_us(' + end + ') - epoch_us(timestamp))) / 1e6')
+        sql = ('SELECT *, ' + inforce + ' AS inforce FROM ' + nbbo_table +
+               ' WHERE CAST(timestamp AS TIME) >= ' +
+               taq.time_to_sql(start_time_spreads, "'") +
+               ' AND CAST(timestamp AS TIME) < ' +
+               taq.time_to_sql(end_time_spreads, "'"))
+
+        measures = {
+            'quoted_spread_dollar': 'best_ask - best_bid',
+            'quoted_spread_percent': 'ln(best_ask) - ln(best_bid)',
+            'best_ofr_depth_dollar': 'best_ask * best_asksizeshares',
+            'best_bid_depth_dollar': 'best_bid * best_bidsizeshares',
+            'best_ofr_depth_share': 'best_asksizeshares',
+            'best_bid_depth_share': 'best_bidsizeshares'}
+        sql = ('SELECT symbol, inforce, ' +
+               ', '.join(e + ' AS ' + m for m, e in measures.items()) +
+               ' FROM (' + sql + ') WHERE NOT coalesce(best_bid >= best_ask, false)')
+        # Time-weighted averages
+        return ('SELECT symbol, ' + ', '.join(
+                    'sum(' + m + ' * inforce) / nullif(sum(inforce) FILTER ' +
+                    '(WHERE ' + m + ' IS NOT NULL), 0) AS ' + m
+                    for m in measures) +
+                ' FROM (' + sql + ') GROUP BY symbol ORDER BY symbol')
+
+    def averages_sql(self, sql, measures):
+        # Same as TaqDaily.compute_averages_ave_sw_dw
+        out = []
+        for m in measures:
+            valid = (' FILTER (WHERE ' + m + ' IS NOT NULL AND dollar IS NOT ' +
+                     'NULL AND size IS NOT NULL)')
+            out += ['avg(' + m + ')' + valid + ' AS ' + m + '_Ave',
+                    'sum(' + m + ' * dollar)' + valid + ' / nullif(sum(dollar)' +
+                    valid + ', 0) AS ' + m + '_DW',
+                    'sum(' + m + ' * size)' + valid + ' / nullif(sum(size)' +
+                    valid + ', 0) AS ' + m + '_SW']
+        return ('SELECT symbol, ' + ', '.join(out) + ' FROM (' + sql +
+                ') GROUP BY symbol ORDER BY symbol')
+
+    def effective_spreads_sql(self, merged_table='trade_and_nbbo'):
+        sql = ('SELECT *, abs(price - midpoint) * 2 AS DollarEffectiveSpread, ' +
+               'abs(ln(price) - ln(midpoint)) * 2 AS PercentEffectiveSpread ' +
+               'FROM ' + merged_table + ' WHERE "lock" = 0 AND "cross" = 0')
+        return self.averages_sql(sql, ['DollarEffectiveSpread',
+                                       'PercentEffectiveSpread'])
+
+    def rs_and_pi_sql(self, taq, delay, suffix, merged_table='trade_and_nbbo',
+                      nbbo_table='complete_nbbo', track_retail=None):
+        if track_retail is None:
+            track_retail = taq.track_retail
+        delay_us = int(delay.total_seconds() * 1e6)
+
+        next_nbbo = ('SELECT symbol, timestamp - to_microseconds(' +
+                     str(delay_us) + ') AS timestamp, ' +
+                     'best_bid AS best_bid_next, best_ask AS best_ask_next, ' +
+                     '(best_bid + best_ask) / 2 AS midpoint_next FROM ' +
+                     nbbo_table)
+        sql = ('SELECT t.*, n.best_bid_next, n.best_ask_next, n.midpoint_next ' +
+               'FROM ' + merged_table + ' t ASOF LEFT JOIN (' + next_nbbo +
+               ') n ON t.symbol = n.symbol AND t.timestamp > n.timestamp')
+        sql = ('SELECT * FROM (' + sql + ') WHERE NOT ' +
+               'coalesce(best_bid_next >= best_ask_next, false)')
+
+        signs = ['LR', 'EMO', 'CLNV']
+        if track_retail:
+            signs += ['BJZ'] + [x + 'notBJZ' for x in signs]
+        cols = []
+        for sign in signs:
+            s = 'BuySell' + sign
+            cols += [s + ' * (price - midpoint_next) * 2 AS DollarRealizedSpread_' + sign + suffix,
+                     s + ' * (ln(price) - ln(midpoint_next)) * 2 AS PercentRealizedSpread_' + sign + suffix,
+                     s + ' * (midpoint_next - midpoint) * 2 AS DollarPriceImpact_' + sign + suffix,
+                     s + ' * (ln(midpoint_next) - ln(midpoint)) * 2 AS PercentPriceImpact_' + sign + suffix]
+        sql = 'SELECT symbol, size, dollar, ' + ', '.join(cols) + ' FROM (' + sql + ')'
+        return self.averages_sql(sql, [c.split(' AS ')[1] for c in cols])
+
+    #%% Run the pipeline for one day
+
+    def compute_daily(self, taq, date, symbols=None, delay=None,
+                      suffix='5min'):
+        self.check_taq(taq)
+        # Materialize the complete NBBO and merged trades once, DuckDB keeps
+        # them on disk if they do not fit in memory_limit.
+        self.con.execute('CREATE OR REPLACE TEMP TABLE complete_nbbo AS ' +
+                         self.complete_nbbo_sql(taq, date, symbols))
+        self.con.execute('CREATE OR REPLACE TEMP TABLE trade_and_nbbo AS ' +
+                         self.merge_trades_nbbo_sql(taq, date, symbols))
+
+        out = {}
+        out['spreads'] = self.raw_sql(self.spreads_sql(taq, date)).set_index('symbol')
+        out['effective_spreads'] = self.raw_sql(
+            self.effective_spreads_sql()).set_index('symbol')
+        if delay is not None:
+            out['rs_pi'] = self.raw_sql(
+                self.rs_and_pi_sql(taq, delay, suffix)).set_index('symbol')
+
+        self.con.execute('DROP TABLE complete_nbbo')
+        self.con.execute('DROP TABLE trade_and_nbbo')
+        return out
+
+    def get_official_complete_nbbo(self, taq, date, symbols=None):
+        self.check_taq(taq)
+        return self.raw_sql(self.complete_nbbo_sql(taq, date, symbols) +
+                            ' ORDER BY symbol, timestamp')
+
+    def merge_trades_nbbo(self, taq, date, symbols=None, track_retail=None):
+        self.check_taq(taq)
+        sql = self.merge_trades_nbbo_sql(
+            taq, date, symbols,
+            nbbo_table='(' + self.complete_nbbo_sql(taq, date, symbols) + ')',
+            track_retail=track_retail)
+        return self.raw_sql(sql + ' ORDER BY timestamp, symbol, tr_seqnum')
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk mirror of the TAQ tables to a local Parquet lake.
+
+A TaqMirror copies the nbbom, cqm, ctm and complete_nbbo tables of a range
+of dates from the database of a TaqDaily object (method='PostgreSQL', or
+'SASPy') to <path>/<table>/date=<YYYYMMDD>/part-0.parquet, the layout read
+by TaqDuckDB. Tables are pulled with the get_*_sql query builders of
+TaqDaily (all columns of the table lists, common stocks, time windows of
+the TaqDaily object), sorted by sym_root and time_m, and written with date
+as date32, time_m as time64 and strings as string columns (zstd compressed).
+
+A table and day is pulled by ranges of sym_root, in order (chunks), so that
+it is never held in memory at once: each range is written to a temporary
+file as soon as it is pulled, and the files are then concatenated by row
+groups in part-0.parquet (with the same types across ranges).
+
+Several tables and days are pulled concurrently by max_workers threads (by
+default, the size of the db if it is a TaqConnectionPool, otherwise 1 as a
+single connection cannot run concurrent queries). The number of open
+connections is bounded by the db: use a TaqConnectionPool of the wanted
+size (its own chunking is not used). The rows written are checked against a
+COUNT(*) of the same query, and each table and day is then recorded in the
+manifest (<path>/_manifest/<table>_<YYYYMMDD>.json, with its rows, bytes
+and timings), so that an interrupted sync only pulls the missing ones when
+run again.
+"""
+
+import copy
+import json
+import os
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from pytaq import taq_time
+from pytaq.taq_connection import (TaqConnectionPool, chunk_conditions,
+                                  sym_root_chunks)
+
+# Table prefix and TaqDaily table
+mirror_tables = {'nbbom': 'nbbo', 'cqm': 'quote', 'ctm': 'trade',
+                 'complete_nbbo': 'complete_nbbo'}
+
+
+def to_arrow_table(df):
+    # Arrow table with the types of the lake: date32, time64 and string
+    arrays = []
+    for c in df.columns:
+        x = df[c]
+        # Note: datetime.date and datetime.time objects are converted by
+        # Arrow (without a Python loop)
+        if c == 'date':
+            if x.dtype.kind == 'M':
+                arrays.append(pa.array(x.values.astype('datetime64[D]'),
+                                       type=pa.date32()))
+            else:
+                arrays.append(pa.array(x.values, type=pa.date32()))
+        elif c == 'time_m':
+            if x.dtype.kind in 'mM':
+                ns = (x.values.astype('timedelta64[ns]').view('i8')
+                      if x.dtype.kind == 'm' else taq_time.ns_of_day(x.values))
+                arrays.append(pa.array(ns, type=pa.int64()).cast(pa.time64('ns')))
+            else:
+                arrays.append(pa.array(x.values, type=pa.time64('us')).cast(
+                    pa.time64('ns')))
+        elif x.dtype == object:
+            arrays.append(pa.array(x.values, type=pa.string(), from_pandas=True))
+        else:
+            # Note: missing values (NULL in the database) stay missing
+            arrays.append(pa.array(x.values, from_pandas=True))
+    return pa.Table.from_arrays(arrays, names=[str(c) for c in df.columns])
+
+
+class TaqMirror():
+    def __init__(self, taq, path, tables=None, max_workers=None,
+                 row_group_size=2**20, compression='zstd', chunks=26):
+        # taq: TaqDaily object with the source db. Full column lists are
+        # mirrored, whatever its measures.
+        # chunks: number of ranges of sym_root (on the first letter), or
+        # list of sym_root boundaries (e.g. ['AAPL', 'B', ...]), pulled one
+        # at a time.
+        self.taq = copy.copy(taq)
+        self.taq.measures = None
+        self.path = path
+        self.tables = list(mirror_tables) if tables is None else list(tables)
+        for t in self.tables:
+            if t not in mirror_tables:
+                raise Exception('Unknown table for TaqMirror: ' + str(t))
+        if max_workers is None:
+            # One connection unless the db is a pool
+            max_workers = (taq.db.size if isinstance(taq.db, TaqConnectionPool)
+                           else 1)
+        self.max_workers = max_workers
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.chunks = chunks
+        self.last_sync = None
+
+    def partition_path(self, table, date):
+        return os.path.join(self.path, table, 'date=' + date.strftime('%Y%m%d'))
+
+    def manifest_path(self, table, date):
+        return os.path.join(self.path, '_manifest',
+                            table + '_' + date.strftime('%Y%m%d') + '.json')
+
+    def has(self, table, date):
+        return (os.path.exists(self.manifest_path(table, date)) and
+                os.path.exists(os.path.join(self.partition_path(table, date),
+                                            'part-0.parquet')))
+
+    def columns(self, table):
+        cols = list(getattr(self.taq, mirror_tables[table] + '_columns'))
+        if table == 'ctm':
+            # Filtered on by the trade queries
+            cols += [c for c in ['tr_scond', 'tr_corr'] if c not in cols]
+        return cols
+
+    def query(self, table, date):
+        taq = self.taq
+        cols = self.columns(table)
+        if table == 'nbbom':
+            sql = taq.get_nbbo_table_sql(date, columns=cols)
+        elif table == 'cqm':
+            sql = taq.get_quote_table_sql(date, columns=cols)
+        elif table == 'ctm':
+            sql = taq.get_trade_table_sql(date, columns=cols)
+        else:
+            sql = taq.get_official_complete_nbbo_sql(date, columns=cols)
+        return sql
+
+    def order_by(self, table):
+        seqnum = [c for c in ['qu_seqnum', 'tr_seqnum'] if c in self.columns(table)]
+        return ['sym_root', 'time_m'] + seqnum
+
+    def raw_sql(self, sql):
+        # Note: the queries of a pool are not chunked by the pool (the chunk
+        # condition cannot be added after ORDER BY), see fetch()
+        db = self.taq.db
+        return db.query(sql) if isinstance(db, TaqConnectionPool) else \
+            db.raw_sql(sql)
+
+    def source_rows(self, table, date):
+        # Number of rows of the source (None with SASPy)
+        if self.taq.method == 'SASPy':
+            return None
+        n = self.raw_sql('SELECT COUNT(*) AS n FROM (' +
+                         self.query(table, date) + ') AS q')
+        return int(n['n'].iloc[0])
+
+    def fetch(self, table, date):
+        # Rows of the table sorted by symbol and time, by ranges of sym_root
+        # (in order), so that a day is never held in memory at once
+        taq = self.taq
+        if taq.method == 'SASPy':
+            symbols = taq.get_nbbo_symbols(date)
+            if table == 'nbbom':
+                df = taq.get_nbbo_table_saspy(date, symbols)
+            elif table == 'cqm':
+                df = taq.get_quote_table_saspy(date, symbols)
+            elif table == 'ctm':
+                df = taq.get_trade_table_saspy(date, symbols, get_cond=True)
+            else:
+                df = taq.get_official_complete_nbbo_saspy(date, symbols)
+            yield df.sort_values(self.order_by(table), kind='stable',
+                                 ignore_index=True)
+            return
+
+        sql = self.query(table, date)
+        chunks = self.chunks
+        if isinstance(chunks, int):
+            chunks = sym_root_chunks(chunks)
+        for cond in chunk_conditions('sym_root', chunks):
+            yield self.raw_sql(sql + ' AND ' + cond + ' ORDER BY ' +
+                               ', '.join(self.order_by(table)))
+
+    def write_chunks(self, files, tmp_file):
+        # Concatenates the chunk files in one file, with the types of all
+        # the chunks (a column without values in a chunk, or with missing
+        # values in some chunks only, has different types). Returns the rows
+        # written.
+        schema = pa.unify_schemas([pq.read_schema(f) for f in files],
+                                  promote_options='permissive')
+        # Columns without any value are strings, as in to_arrow_table
+        schema = pa.schema([f.with_type(pa.string())
+                            if pa.types.is_null(f.type) else f
+                            for f in schema])
+        rows = 0
+        with pq.ParquetWriter(tmp_file, schema,
+                              compression=self.compression) as writer:
+            for f in files:
+                for batch in pq.ParquetFile(f).iter_batches(
+                        batch_size=self.row_group_size):
+                    table = pa.Table.from_batches([batch])
+                    writer.write_table(table.select(schema.names).cast(schema),
+                                       row_group_size=self.row_group_size)
+                    rows += table.num_rows
+        return rows
+
+    def sync_table(self, table, date):
+        path = self.partition_path(table, date)
+        os.makedirs(path, exist_ok=True)
+        file = os.path.join(path, 'part-0.parquet')
+        # Write then rename, so that an interrupted sync never leaves a
+        # partial file behind
+        tmp_file = os.path.join(path, '.part-0.parquet.tmp')
+
+        # Each chunk is written to its own file as soon as it is pulled
+        fetch_seconds, t0 = 0, time_module.time()
+        source_rows = self.source_rows(table, date)
+        files = []
+        try:
+            chunks = self.fetch(table, date)
+            while True:
+                t = time_module.time()
+                df = next(chunks, None)
+                fetch_seconds += time_module.time() - t
+                if df is None:
+                    break
+                if (len(df) == 0) and (len(files) > 0):
+                    continue
+                files.append(os.path.join(path, '.chunk-' +
+                                          str(len(files)).zfill(4) + '.tmp'))
+                arrow_table = to_arrow_table(df)
+                arrow_table = pa.table(
+                    [pa.nulls(len(x)) if (len(x) > 0) and
+                     (x.null_count == len(x)) else x
+                     for x in arrow_table.columns], names=arrow_table.column_names)
+                pq.write_table(arrow_table, files[-1],
+                               row_group_size=self.row_group_size,
+                               compression=self.compression)
+                del df, arrow_table
+            rows = self.write_chunks(files, tmp_file)
+        finally:
+            for f in files:
+                if os.path.exists(f):
+                    os.remove(f)
+        if source_rows is None:
+            source_rows = rows
+        if rows != source_rows:
+            os.remove(tmp_file)
+            raise Exception('Row count mismatch for ' + table + ' ' +
+                            date.strftime('%Y%m%d') + ': ' + str(rows) +
+                            ' written, ' + str(source_rows) + ' in source')
+        os.replace(tmp_file, file)
+        t2 = time_module.time()
+
+        entry = {'table': table, 'date': date.strftime('%Y%m%d'),
+                 'rows': rows, 'bytes': os.path.getsize(file),
+                 'fetch_seconds': fetch_seconds,
+                 'write_seconds': t2 - t0 - fetch_seconds}
+        manifest = self.manifest_path(table, date)
+        os.makedirs(os.path.dirname(manifest), exist_ok=True)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump(entry, f, indent=1)
+        os.replace(manifest + '.tmp', manifest)
+        return entry
+
+    def sync(self, dates, tables=None, overwrite=False):
+        # Tables and days of the manifest are skipped unless overwrite.
+        # Returns the manifest entries of the tables and days synced.
+        if tables is None:
+            tables = self.tables
+        todo = [(t, d) for d in dates for t in tables
+                if overwrite or not self.has(t, d)]
+
+        t0 = time_module.time()
+        entries = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.sync_table, t, d) for t, d in todo]
+            for f in futures:
+                try:
+                    entries.append(f.result())
+                except Exception as e:
+                    errors.append(e)
+        seconds = time_module.time() - t0
+
+        out = pd.DataFrame(entries, columns=['table', 'date', 'rows', 'bytes',
+                                             'fetch_seconds', 'write_seconds'])
+        self.last_sync = {'tables': len(out), 'rows': int(out['rows'].sum()),
+                          'bytes': int(out['bytes'].sum()), 'seconds': seconds,
+                          'rows_per_second': out['rows'].sum() / seconds
+                          if seconds > 0 else np.nan,
+                          'errors': len(errors)}
+        # Synced tables are kept in the manifest, running sync() again
+        # resumes with the failed ones
+        if len(errors) > 0:
+            raise errors[0]
+        return out
+
+    def manifest(self):
+        path = os.path.join(self.path, '_manifest')
+        if not os.path.isdir(path):
+            return pd.DataFrame(columns=['table', 'date', 'rows', 'bytes',
+                                         'fetch_seconds', 'write_seconds'])
+        entries = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.json'):
+                with open(os.path.join(path, name)) as f:
+                    entries.append(json.load(f))
+        return pd.DataFrame(entries)
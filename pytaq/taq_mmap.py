@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped store of cleaned days.
+
+Layout: <path>/<YYYYMMDD>/<table>/
+    meta.json     columns and their dtypes
+    symbols.npy   sorted symbols (bytes)
+    offsets.npy   row offsets, rows of symbols[i] are offsets[i]:offsets[i+1]
+    <column>.npy  one array per column, rows sorted by symbol, timestamp
+
+Columns are opened with np.load(mmap_mode='r'), so reading one symbol is a
+slice of the mapped arrays and the pages are shared by all processes reading
+the same day. String columns are stored as fixed-width bytes, with missing
+values stored as b''.
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+class TaqMmapStore():
+    def __init__(self, path):
+        self.path = path
+        self.opened = {}
+
+    def table_path(self, date, table):
+        return os.path.join(self.path, date.strftime('%Y%m%d'), table)
+
+    def has(self, date, table):
+        return os.path.exists(os.path.join(self.table_path(date, table),
+                                           'meta.json'))
+
+    #%% Write
+
+    def write(self, date, table, df):
+        df = df.sort_values(['symbol', 'timestamp'], kind='mergesort')
+        path = self.table_path(date, table)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        symbols = df['symbol'].values.astype('S')
+        if len(df) == 0:
+            # Day without rows: no symbols, offsets [0]
+            starts = np.zeros(0, dtype='i8')
+        else:
+            starts = np.flatnonzero(np.r_[True, symbols[1:] != symbols[:-1]])
+        offsets = np.r_[starts, len(df)].astype('i8')
+        np.save(os.path.join(tmp_path, 'symbols.npy'), symbols[starts])
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+
+        meta = {'columns': [], 'strings': []}
+        for c in df.columns:
+            if c == 'symbol':
+                continue
+            values = df[c].values
+            if values.dtype == object:
+                values = df[c].fillna('').values.astype('S')
+                meta['strings'].append(c)
+            np.save(os.path.join(tmp_path, c + '.npy'), values)
+            meta['columns'].append(c)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        self.opened.pop((date.strftime('%Y%m%d'), table), None)
+
+    #%% Read
+
+    def open(self, date, table):
+        key = (date.strftime('%Y%m%d'), table)
+        if key not in self.opened:
+            path = self.table_path(date, table)
+            if not self.has(date, table):
+                raise Exception('No ' + table + ' table stored for ' + key[0])
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            symbols = np.load(os.path.join(path, 'symbols.npy'))
+            self.opened[key] = {
+                'meta': meta,
+                'index': {s.decode(): i for i, s in enumerate(symbols)},
+                'offsets': np.load(os.path.join(path, 'offsets.npy')),
+                'columns': {c: np.load(os.path.join(path, c + '.npy'),
+                                       mmap_mode='r')
+                            for c in meta['columns']}}
+        return self.opened[key]
+
+    def symbols(self, date, table):
+        return list(self.open(date, table)['index'])
+
+    def rows(self, date, table, symbol):
+        t = self.open(date, table)
+        i = t['index'].get(symbol)
+        if i is None:
+            return 0, 0
+        return t['offsets'][i], t['offsets'][i + 1]
+
+    # Zero-copy access: read-only views of the mapped arrays
+    def get_arrays(self, date, table, symbol=None, columns=None):
+        t = self.open(date, table)
+        if columns is None:
+            columns = t['meta']['columns']
+        if symbol is None:
+            start, end = 0, t['offsets'][-1]
+        else:
+            start, end = self.rows(date, table, symbol)
+        return {c: t['columns'][c][start:end] for c in columns}
+
+    def get_table(self, date, table, symbols=None, columns=None):
+        t = self.open(date, table)
+        if columns is None:
+            columns = t['meta']['columns']
+        names = np.array(list(t['index']), dtype=object)
+        offsets = t['offsets']
+        counts = np.diff(offsets)
+
+        if symbols is None:
+            # Whole columns, one slice each
+            rows = slice(None)
+            symbol = np.repeat(names, counts)
+        else:
+            # Rows of each symbol, in the order of symbols
+            idx = np.array([t['index'][s] for s in symbols if s in t['index']],
+                           dtype='i8')
+            n = counts[idx]
+            first = np.cumsum(n) - n
+            rows = np.repeat(offsets[idx] - first, n) + np.arange(n.sum())
+            symbol = np.repeat(names[idx], n)
+
+        df = pd.DataFrame({'symbol': symbol})
+        for c in columns:
+            values = t['columns'][c][rows]
+            if c in t['meta']['strings']:
+                values = np.char.decode(values).astype(object)
+                values[values == ''] = None
+            df[c] = values
+        # Keep the column order of the cleaned tables
+        cols = list(columns)
+        if 'timestamp' in cols:
+            cols.insert(cols.index('timestamp') + 1, 'symbol')
+        else:
+            cols.insert(0, 'symbol')
+        return df[cols]
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NBBO reconstruction from exchange-level quotes (cqm_).
+
+Each quote updates the current bid and ask of its exchange for the symbol (a
+side with a missing or non-positive price or size removes the exchange from
+that side). After each update, the best bid (ask) is the highest bid
+(lowest ask) across the exchanges; among exchanges at the best price, the
+one with the largest size is chosen, then the one with the oldest latest
+update (any update of the side, including a size refresh at the same price,
+resets its time). Its size and exchange are reported with the price.
+
+Two implementations give the same output:
+- a Numba kernel, keeping the quotes of each exchange in small arrays while
+  walking the quotes of each symbol (used if numba is installed);
+- a vectorized one, where the last update of each exchange at each row is a
+  running maximum (np.maximum.accumulate) of update positions, computed by
+  chunks of rows (the last row of a chunk seeds the running maximum of the
+  next one, so that a symbol can span several chunks).
+"""
+
+import numpy as np
+import pandas as pd
+
+from pytaq import taq_time
+from pytaq.taq_daily import is_sorted
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+output_columns = ['best_bid', 'best_bidsizeshares', 'best_bidex', 'best_ask',
+                  'best_asksizeshares', 'best_askex']
+
+
+#%% Numba kernel
+
+def nbbo_kernel(starts, ex, t, bid, bidsize, ask, asksize, n_ex,
+                out_bid, out_bidsize, out_bidex, out_ask, out_asksize,
+                out_askex):
+    ex_bid = np.empty(n_ex)
+    ex_bidsize = np.empty(n_ex)
+    ex_bidtime = np.empty(n_ex, dtype=np.int64)
+    ex_ask = np.empty(n_ex)
+    ex_asksize = np.empty(n_ex)
+    ex_asktime = np.empty(n_ex, dtype=np.int64)
+    for s in range(len(starts) - 1):
+        ex_bid[:] = np.nan
+        ex_ask[:] = np.nan
+        for i in range(starts[s], starts[s + 1]):
+            e = ex[i]
+            # Update of the quote of the exchange
+            if (bid[i] > 0) and (bidsize[i] > 0):
+                ex_bid[e] = bid[i]
+                ex_bidsize[e] = bidsize[i]
+                ex_bidtime[e] = t[i]
+            else:
+                ex_bid[e] = np.nan
+            if (ask[i] > 0) and (asksize[i] > 0):
+                ex_ask[e] = ask[i]
+                ex_asksize[e] = asksize[i]
+                ex_asktime[e] = t[i]
+            else:
+                ex_ask[e] = np.nan
+
+            # Best quotes across exchanges
+            best_bid, best_ask = -1, -1
+            for k in range(n_ex):
+                if ex_bid[k] == ex_bid[k]:
+                    if ((best_bid < 0) or (ex_bid[k] > ex_bid[best_bid]) or
+                            ((ex_bid[k] == ex_bid[best_bid]) and
+                             ((ex_bidsize[k] > ex_bidsize[best_bid]) or
+                              ((ex_bidsize[k] == ex_bidsize[best_bid]) and
+                               (ex_bidtime[k] < ex_bidtime[best_bid]))))):
+                        best_bid = k
+                if ex_ask[k] == ex_ask[k]:
+                    if ((best_ask < 0) or (ex_ask[k] < ex_ask[best_ask]) or
+                            ((ex_ask[k] == ex_ask[best_ask]) and
+                             ((ex_asksize[k] > ex_asksize[best_ask]) or
+                              ((ex_asksize[k] == ex_asksize[best_ask]) and
+                               (ex_asktime[k] < ex_asktime[best_ask]))))):
+                        best_ask = k
+            out_bidex[i] = best_bid
+            out_askex[i] = best_ask
+            if best_bid >= 0:
+                out_bid[i] = ex_bid[best_bid]
+                out_bidsize[i] = ex_bidsize[best_bid]
+            else:
+                out_bid[i] = np.nan
+                out_bidsize[i] = np.nan
+            if best_ask >= 0:
+                out_ask[i] = ex_ask[best_ask]
+                out_asksize[i] = ex_asksize[best_ask]
+            else:
+                out_ask[i] = np.nan
+                out_asksize[i] = np.nan
+
+
+if njit is not None:
+    nbbo_kernel = njit(nbbo_kernel)
+
+
+#%% Vectorized
+
+def best_side(last, valid, price, size, t, higher):
+    # Best exchange (or -1) of each row, from the position of the last
+    # update of each exchange (last, rows x exchanges)
+    rows = np.arange(last.shape[0])
+    p = np.where(valid, price[last], np.nan)
+    ok = valid & (p > 0) & (size[last] > 0)
+    key = np.where(ok, p if higher else -p, -np.inf)
+    best = key.max(axis=1)
+    cand = ok & (key == best[:, None])
+    sz = np.where(cand, size[last], -np.inf)
+    cand &= sz == sz.max(axis=1)[:, None]
+    tt = np.where(cand, t[last], np.iinfo(np.int64).max)
+    k = tt.argmin(axis=1)
+    k = np.where(cand.any(axis=1), k, -1)
+    pos = last[rows, np.maximum(k, 0)]
+    out_price = np.where(k >= 0, price[pos], np.nan)
+    out_size = np.where(k >= 0, size[pos], np.nan)
+    return out_price, out_size, k
+
+
+def nbbo_vectorized(starts, ex, t, bid, bidsize, ask, asksize, n_ex,
+                    chunk_rows=2**18):
+    n = len(ex)
+    out = [np.empty(n), np.empty(n), np.empty(n, dtype='i8'),
+           np.empty(n), np.empty(n), np.empty(n, dtype='i8')]
+    # Chunks of chunk_rows rows. seed: position of the last update of each
+    # exchange before the chunk.
+    chunk_rows = max(int(chunk_rows), 1)
+    seed = np.full((1, n_ex), -1, dtype='i8')
+    for lo in range(0, n, chunk_rows):
+        hi = min(lo + chunk_rows, n)
+        rows = np.arange(lo, hi)
+        last = np.where(ex[lo:hi, None] == np.arange(n_ex)[None, :],
+                        rows[:, None], -1)
+        last = np.maximum.accumulate(np.concatenate([seed, last]), axis=0)
+        seed, last = last[-1:], last[1:]
+        # Updates of the previous symbols are left out
+        first = starts[np.searchsorted(starts, rows, side='right') - 1]
+        valid = last >= first[:, None]
+        last = np.where(valid, last, 0)
+        for x, side in [(0, (bid, bidsize, True)), (3, (ask, asksize, False))]:
+            price, size, higher = side
+            p, sz, k = best_side(last, valid, price, size, t, higher)
+            out[x][lo:hi], out[x + 1][lo:hi], out[x + 2][lo:hi] = p, sz, k
+    return out
+
+
+#%% Build
+
+def build_nbbo(quote_df, exchanges=None, changes_only=True, use_numba=None,
+               chunk_rows=2**18):
+    # quote_df: exchange quotes as returned by clean_quote_table (columns
+    # timestamp, symbol, best_bid, best_bidsizeshares, best_ask,
+    # best_asksizeshares, best_bidex and qu_seqnum).
+    # exchanges: subset of exchanges of the BBO (all if None).
+    # changes_only: only keep the rows where the NBBO changes.
+    if use_numba is None:
+        use_numba = njit is not None
+    if use_numba and (njit is None):
+        raise Exception('numba is needed for build_nbbo(use_numba=True)')
+
+    if exchanges is not None:
+        quote_df = quote_df[quote_df['best_bidex'].isin(list(exchanges)).values]
+
+    t = taq_time.to_ns(quote_df['timestamp'].values)
+    codes, symbols = pd.factorize(quote_df['symbol'], sort=True)
+    ex_codes, ex_labels = pd.factorize(quote_df['best_bidex'], sort=True)
+    keys = {'symbol': codes, 'timestamp': t}
+    if 'qu_seqnum' in quote_df.columns:
+        keys['qu_seqnum'] = quote_df['qu_seqnum'].values
+    # Sort by symbol, timestamp and sequence number, unless already sorted
+    # (e.g. tables of a TaqMirror)
+    if is_sorted(pd.DataFrame(keys, copy=False), list(keys)):
+        order = slice(None)
+    else:
+        order = np.arange(len(t))
+        if 'qu_seqnum' in keys:
+            order = np.argsort(keys['qu_seqnum'], kind='stable')
+        # Note: one stable sort on a composite key instead of np.lexsort
+        t0 = t.min()
+        key = codes[order] * (t.max() - t0 + 1) + (t[order] - t0)
+        order = order[np.argsort(key, kind='stable')]
+    codes = codes[order]
+    starts = np.searchsorted(codes, np.arange(len(symbols) + 1))
+    t = t[order]
+    ex = ex_codes[order]
+    values = [np.ascontiguousarray(quote_df[c].values[order], dtype='f8')
+              for c in ['best_bid', 'best_bidsizeshares', 'best_ask',
+                        'best_asksizeshares']]
+
+    if use_numba:
+        n = len(t)
+        out = [np.empty(n), np.empty(n), np.empty(n, dtype='i8'),
+               np.empty(n), np.empty(n), np.empty(n, dtype='i8')]
+        nbbo_kernel(starts, ex, t, *values, len(ex_labels), *out)
+    else:
+        out = nbbo_vectorized(starts, ex, t, *values, len(ex_labels),
+                              chunk_rows=chunk_rows)
+
+    rows = slice(None)
+    if changes_only and (len(t) > 0):
+        same = np.ones(len(t) - 1, dtype=bool)
+        for x in out:
+            a, b = x[1:], x[:-1]
+            same &= (a == b) | ((a != a) & (b != b))
+        changed = np.ones(len(t), dtype=bool)
+        changed[1:] = ~same
+        changed[starts[:-1][np.diff(starts) > 0]] = True
+        rows = np.flatnonzero(changed)
+
+    df = pd.DataFrame({'timestamp': taq_time.to_datetime64(t[rows]),
+                       'symbol': np.asarray(symbols, dtype=object)[codes[rows]]})
+    # Exchange code -1 (no quote) is mapped to None
+    ex_labels = np.append(np.asarray(ex_labels, dtype=object), None)
+    for c, x in zip(output_columns, out):
+        df[c] = ex_labels[x[rows]] if c.endswith('ex') else x[rows]
+    return df
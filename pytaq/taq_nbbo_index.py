@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+As-of lookup index on the official complete NBBO.
+
+The NBBO is sorted once by symbol and timestamp, and each quote is given the
+key symbol_code * span + (timestamp - t0) (int64 nanoseconds), so that the
+keys of all symbols form a single sorted array. The quote in force for a
+batch of (symbol, timestamp) queries is then found with one searchsorted
+call, without sorting the NBBO or the queries again.
+"""
+
+import numpy as np
+import pandas as pd
+
+from pytaq.taq_time import to_ns, to_ns_delta
+
+
+class NbboIndex():
+    def __init__(self, off_nbbo_df, columns=None):
+        if columns is None:
+            columns = [c for c in off_nbbo_df.columns
+                       if c not in ['timestamp', 'symbol']]
+
+        t = to_ns(off_nbbo_df['timestamp'].values)
+        codes, symbols = pd.factorize(off_nbbo_df['symbol'], sort=True)
+        self.symbols = pd.Index(symbols)
+
+        # Stable sort, rows with the same symbol and timestamp keep their
+        # order (as with sort_values)
+        order = np.lexsort((t, codes))
+        t, codes = t[order], codes[order]
+
+        self.t0 = t.min() if len(t) > 0 else 0
+        self.span = (t.max() - self.t0 + 2) if len(t) > 0 else 2
+        if len(self.symbols) * self.span >= 2**62:
+            raise Exception('Time span too large for NbboIndex')
+        self.keys = codes * self.span + (t - self.t0)
+        self.starts = np.searchsorted(codes, np.arange(len(self.symbols)))
+        self.timestamps = t
+        self.columns = {c: off_nbbo_df[c].values[order] for c in columns}
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Position (in the sorted NBBO) of the last quote before timestamp +
+    # offset for the same symbol, strictly before if strict, or -1 if there
+    # is none.
+    def positions(self, symbols, timestamps, offset=None, strict=True):
+        codes = self.symbols.get_indexer(np.asarray(symbols, dtype=object))
+        if len(self) == 0:
+            return np.full(len(codes), -1, dtype='i8')
+        t = to_ns(timestamps)
+        if offset is not None:
+            t = t + to_ns_delta(offset)
+        # Times outside of the index are clipped, so that keys stay within
+        # the range of the symbol.
+        rel = np.clip(t - self.t0, -1, self.span - 1)
+        pos = np.searchsorted(self.keys, codes * self.span + rel,
+                              side='left' if strict else 'right') - 1
+        valid = (codes >= 0) & (pos >= self.starts[codes])
+        pos[~valid] = -1
+        return pos
+
+    # NBBO columns at the given positions, missing where positions is -1
+    # (same dtypes as the output of pd.merge_asof).
+    def take(self, pos, columns=None):
+        if columns is None:
+            columns = list(self.columns)
+        missing = pos < 0
+        out = {}
+        for c in columns:
+            values = self.columns[c][np.where(missing, 0, pos)] if len(self) > 0 \
+                else np.full(len(pos), np.nan)
+            if missing.any():
+                values = pd.Series(values).where(~missing).values
+            out[c] = values
+        return pd.DataFrame(out)
+
+    def lookup(self, symbols, timestamps, offset=None, strict=True,
+               columns=None):
+        pos = self.positions(symbols, timestamps, offset=offset, strict=strict)
+        return self.take(pos, columns)
+
+    # NBBO in force at each of the times, for all symbols
+    def snapshots(self, times, strict=False, columns=None):
+        times = to_ns(times)
+        symbols = np.repeat(np.asarray(self.symbols, dtype=object), len(times))
+        timestamps = np.tile(times, len(self.symbols)).view('datetime64[ns]')
+        df = self.lookup(symbols, timestamps, strict=strict, columns=columns)
+        df.insert(0, 'symbol', symbols)
+        df.insert(0, 'timestamp', timestamps)
+        return df
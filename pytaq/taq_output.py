@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chunked on-disk output of the trade-level stages (merge_trades_nbbo,
+compute_rs_and_pi with output_path).
+
+The trades of a day are processed by chunks of whole symbols, and each chunk
+is appended to <output_path>/date=<YYYYMMDD>/part-0.parquet as soon as it is
+computed, so that the merged frame of the day is never held in memory.
+Chunks are buffered until they fill a row group (row_group_size rows), and
+the file is written to a temporary file then renamed once complete. If a
+chunk fails, the temporary file is removed (see TradeWriter.abort).
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from pytaq.taq_mirror import to_arrow_table
+
+
+def symbol_chunks(symbols, chunk_rows):
+    # Positions of the rows of each chunk of whole symbols (of about
+    # chunk_rows rows, in alphabetical order of the symbols). Rows keep their
+    # order within a chunk.
+    codes, uniques = pd.factorize(np.asarray(symbols, dtype=object), sort=True)
+    if len(codes) == 0:
+        return []
+    counts = np.bincount(codes, minlength=len(uniques))
+    first = np.cumsum(counts) - counts
+    chunk = (first // max(int(chunk_rows), 1))[codes]
+    order = np.argsort(chunk, kind='stable')
+    bounds = np.flatnonzero(np.diff(chunk[order])) + 1
+    return np.split(order, bounds)
+
+
+def output_date(date, df):
+    # Date of the partition: date, or the date of the first trade
+    if date is None:
+        if len(df) == 0:
+            raise Exception('date is needed to write an empty output')
+        date = df['timestamp'][0] if hasattr(df, 'to_arrow') else \
+            df['timestamp'].iloc[0]
+    return pd.Timestamp(date)
+
+
+class TradeWriter():
+    def __init__(self, output_path, date, row_group_size=2**20, float32=False,
+                 keep_columns=(), compression='zstd'):
+        # float32: store the float64 columns that are not in keep_columns
+        # (the columns of the inputs) as float32.
+        self.path = os.path.join(output_path,
+                                 'date=' + pd.Timestamp(date).strftime('%Y%m%d'))
+        self.row_group_size = row_group_size
+        self.float32 = float32
+        self.keep_columns = set(keep_columns)
+        self.compression = compression
+        self.schema = None
+        self.writer = None
+        self.buffer = []
+        self.buffer_rows = 0
+        self.rows = 0
+        self.closed = False
+        os.makedirs(self.path, exist_ok=True)
+        self.file = os.path.join(self.path, 'part-0.parquet')
+        self.tmp_file = os.path.join(self.path, '.part-0.parquet.tmp')
+
+    def get_schema(self, table):
+        fields = []
+        for f in table.schema:
+            if pa.types.is_null(f.type):
+                # Column missing in the whole chunk
+                f = f.with_type(pa.string())
+            elif (self.float32 and pa.types.is_float64(f.type) and
+                    (f.name not in self.keep_columns)):
+                f = f.with_type(pa.float32())
+            fields.append(f)
+        return pa.schema(fields)
+
+    def write(self, df):
+        # df: chunk of the output (pandas or polars)
+        if hasattr(df, 'to_arrow'):
+            table = df.to_arrow()
+        else:
+            table = to_arrow_table(df)
+        if self.schema is None:
+            self.schema = self.get_schema(table)
+            self.writer = pq.ParquetWriter(self.tmp_file, self.schema,
+                                           compression=self.compression)
+        self.buffer.append(table.select(self.schema.names).cast(self.schema))
+        self.buffer_rows += len(table)
+        if self.buffer_rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer_rows == 0:
+            return
+        table = pa.concat_tables(self.buffer).combine_chunks()
+        self.buffer, self.buffer_rows = [], 0
+        # Full row groups are written, the rest stays in the buffer
+        n = (len(table) // self.row_group_size) * self.row_group_size
+        if n > 0:
+            self.writer.write_table(table.slice(0, n),
+                                    row_group_size=self.row_group_size)
+        if n < len(table):
+            self.buffer, self.buffer_rows = [table.slice(n)], len(table) - n
+        self.rows += n
+
+    def close(self):
+        # Writes the last row group and returns the dataset of the day
+        if self.writer is None:
+            # No chunk (no trades)
+            self.schema = pa.schema([('timestamp', pa.timestamp('ns')),
+                                     ('symbol', pa.string())])
+            self.writer = pq.ParquetWriter(self.tmp_file, self.schema,
+                                           compression=self.compression)
+        if self.buffer_rows > 0:
+            table = pa.concat_tables(self.buffer)
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+            self.rows += len(table)
+            self.buffer, self.buffer_rows = [], 0
+        self.writer.close()
+        os.replace(self.tmp_file, self.file)
+        self.closed = True
+        return ds.dataset(self.path, format='parquet')
+
+    def abort(self):
+        # Closes the writer and removes the temporary file, after an error
+        # (nothing to do once closed)
+        if self.closed:
+            return
+        self.closed = True
+        self.buffer, self.buffer_rows = [], 0
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
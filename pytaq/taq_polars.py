@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Polars execution engine for TaqDaily (TaqDaily(engine='polars')).
+
+Each function takes the TaqDaily object (for its attributes) and pandas or
+Polars frames, and returns a Polars LazyFrame implementing the same steps as
+the pandas method of the same name. Note that comparisons involving missing
+values are False in pandas but null in Polars, hence the fill_null() calls.
+"""
+
+import pandas as pd
+import polars as pl
+
+
+def to_lazy(df):
+    if isinstance(df, pl.LazyFrame):
+        return df
+    if isinstance(df, pl.DataFrame):
+        return df.lazy()
+    return pl.from_pandas(df).lazy()
+
+
+def collect(lf, to_pandas=True, index=None):
+    df = lf.collect()
+    if not to_pandas:
+        return df
+    df = df.to_pandas()
+    if index is not None:
+        df = df.set_index(index)
+    return df
+
+
+# As-of joins need the same time unit on both sides
+def timestamp_ns(expr=None):
+    if expr is None:
+        expr = pl.col('timestamp')
+    return expr.cast(pl.Datetime('ns')).alias('timestamp')
+
+
+def merge_symbol():
+    return (pl.when(pl.col('sym_suffix').is_not_null())
+            .then(pl.col('sym_root') + ' ' + pl.col('sym_suffix'))
+            .otherwise(pl.col('sym_root'))
+            .alias('symbol'))
+
+
+def true(expr):
+    return expr.fill_null(False)
+
+
+def is_missing(c):
+    return pl.col(c).is_null() | pl.col(c).is_nan()
+
+
+# Columns in cols that lf has (only the columns retrieved are carried, see
+# TaqDaily.plan_columns)
+def present(lf, cols):
+    names = lf.collect_schema().names()
+    return [c for c in cols if c in names]
+
+
+#%% NBBO cleanup
+
+def clean_nbbo_table(taq, df, output_flags=False):
+    lf = to_lazy(df).with_columns(merge_symbol())
+
+    if taq.keep_qu_cond is not None:
+        lf = lf.filter(true(pl.col('qu_cond').is_in(taq.keep_qu_cond)))
+
+    if taq.delete_canceled_quotes:
+        lf = lf.filter(pl.col('qu_cancel').ne_missing('B'))
+
+    if taq.delete_empty_quotes:
+        del_sel = ((true(pl.col('best_ask') <= 0) & true(pl.col('best_bid') <= 0)) |
+                   (true(pl.col('best_asksiz') <= 0) & true(pl.col('best_bidsiz') <= 0)) |
+                   (is_missing('best_ask') & is_missing('best_bid')) |
+                   (is_missing('best_asksiz') & is_missing('best_bidsiz')))
+        lf = lf.filter(~del_sel)
+
+    lf = lf.with_columns(
+        (pl.col('best_ask') - pl.col('best_bid')).alias('spread'),
+        ((pl.col('best_ask') + pl.col('best_bid')) / 2).alias('midpoint'))
+
+    # If size or price = 0 or null, set price and size to null
+    ask_sel = (true(pl.col('best_ask') <= 0) | is_missing('best_ask') |
+               true(pl.col('best_asksiz') <= 0) | is_missing('best_asksiz'))
+    bid_sel = (true(pl.col('best_bid') <= 0) | is_missing('best_bid') |
+               true(pl.col('best_bidsiz') <= 0) | is_missing('best_bidsiz'))
+    lf = lf.with_columns(
+        pl.when(ask_sel).then(None).otherwise(pl.col('best_ask')).alias('best_ask'),
+        pl.when(ask_sel).then(None).otherwise(pl.col('best_asksiz') * 100)
+        .cast(pl.Float64).alias('best_asksizeshares'),
+        pl.when(bid_sel).then(None).otherwise(pl.col('best_bid')).alias('best_bid'),
+        pl.when(bid_sel).then(None).otherwise(pl.col('best_bidsiz') * 100)
+        .cast(pl.Float64).alias('best_bidsizeshares'))
+
+    if taq.delete_abnormal_spreads:
+        lf = lf.sort(['symbol', 'timestamp'], maintain_order=True)
+        lmid = pl.col('midpoint').shift().over('symbol')
+        bid_sel = true((pl.col('spread') > taq.max_spread) &
+                       (pl.col('best_bid') < lmid - taq.max_quote_change))
+        ask_sel = true((pl.col('spread') > taq.max_spread) &
+                       (pl.col('best_ask') > lmid + taq.max_quote_change))
+        lf = lf.with_columns(
+            pl.when(bid_sel).then(None).otherwise(pl.col(c)).alias(c)
+            for c in ['best_bid', 'best_bidsizeshares']
+        ).with_columns(
+            pl.when(ask_sel).then(None).otherwise(pl.col(c)).alias(c)
+            for c in ['best_ask', 'best_asksizeshares'])
+
+    if taq.keep_changes_only:
+        # Missing values never compare equal, as in pandas
+        sel = pl.lit(False)
+        for c in ['best_ask', 'best_bid', 'best_bidsizeshares',
+                  'best_asksizeshares']:
+            sel = sel | (pl.col(c) != pl.col(c).shift().over('symbol')).fill_null(True)
+        lf = lf.filter(sel)
+
+    nbbo_out_cols = ['timestamp', 'symbol', 'best_bid',
+                     'best_bidsizeshares', 'best_bidex', 'best_ask',
+                     'best_asksizeshares', 'best_askex', 'qu_seqnum']
+    if output_flags:
+        nbbo_out_cols += ['qu_cond', 'qu_cancel']
+    return lf.select(present(lf, nbbo_out_cols))
+
+
+#%% Quotes cleanup
+
+def clean_quote_table(taq, df, nbbo_only=True, output_flags=False):
+    lf = to_lazy(df).with_columns(
+        merge_symbol(), (pl.col('ask') - pl.col('bid')).alias('spread'))
+
+    if taq.keep_qu_cond is not None:
+        lf = lf.filter(true(pl.col('qu_cond').is_in(taq.keep_qu_cond)))
+
+    if taq.delete_canceled_quotes:
+        lf = lf.filter(pl.col('qu_cancel').ne_missing('B'))
+
+    if taq.delete_crossed_markets:
+        lf = lf.filter(true(pl.col('bid') <= pl.col('ask')))
+
+    if taq.delete_abnormal_spreads:
+        lf = lf.filter(true(pl.col('spread') <= taq.max_spread))
+
+    if taq.delete_withdrawned_quotes:
+        keep = pl.lit(True)
+        for c in ['ask', 'asksiz', 'bid', 'bidsiz']:
+            keep = keep & ~is_missing(c) & true(pl.col(c) > 0)
+        lf = lf.filter(keep)
+
+    lf = lf.rename({'ask': 'best_ask', 'bid': 'best_bid'})
+    if 'ex' in lf.collect_schema().names():
+        lf = lf.rename({'ex': 'best_bidex'}).with_columns(
+            pl.col('best_bidex').alias('best_askex'))
+    lf = lf.with_columns(
+        (pl.col('bidsiz') * 100).cast(pl.Float64).alias('best_bidsizeshares'),
+        (pl.col('asksiz') * 100).cast(pl.Float64).alias('best_asksizeshares'))
+
+    if nbbo_only:
+        lf = lf.filter(
+            true((pl.col('qu_source') == 'C') & (pl.col('natbbo_ind') == '1')) |
+            true((pl.col('qu_source') == 'N') & (pl.col('natbbo_ind') == '4')))
+
+    quote_out_cols = ['timestamp', 'symbol', 'best_bid',
+                      'best_bidsizeshares', 'best_bidex', 'best_ask',
+                      'best_asksizeshares', 'best_askex', 'qu_seqnum']
+    if output_flags:
+        quote_out_cols += ['qu_cond', 'natbbo_ind', 'qu_source', 'qu_cancel']
+    return lf.select(present(lf, quote_out_cols))
+
+
+#%% Official Complete NBBO
+
+def get_official_complete_nbbo(taq, df=None, nbbo_df=None, quote_df=None):
+    if df is None:
+        lf = pl.concat([to_lazy(nbbo_df), to_lazy(quote_df)],
+                       how='vertical_relaxed')
+        lf = lf.sort(['symbol', 'timestamp', 'qu_seqnum'], maintain_order=True)
+    else:
+        lf = to_lazy(df)
+
+    if taq.keep_changes_only:
+        # Same as groupby().last() in pandas: last non-missing value of each
+        # column at a given microsecond.
+        lf = (lf.group_by(['symbol', 'timestamp'], maintain_order=True)
+              .agg(pl.all().drop_nulls().last())
+              .sort(['symbol', 'timestamp']))
+    return lf
+
+
+#%% Spreads and depths
+
+def compute_spreads(taq, date, off_nbbo_df, start_time_spreads,
+                    end_time_spreads):
+    end = pd.Timestamp.combine(date, end_time_spreads)
+    lf = to_lazy(off_nbbo_df).filter(
+        (pl.col('timestamp').dt.time() >= start_time_spreads) &
+        (pl.col('timestamp').dt.time() < end_time_spreads))
+
+    # Time until next quote, or until the end of the window for the last one
+    inforce = (pl.col('timestamp').diff().over('symbol').dt.total_microseconds()
+               / 1e6).shift(-1).over('symbol')
+    lf = lf.with_columns(inforce.alias('inforce')).with_columns(
+        pl.coalesce(pl.col('inforce'),
+                    (pl.lit(end) - pl.col('timestamp'))
+                    .dt.total_microseconds().abs() / 1e6).alias('inforce'))
+
+    # Delete locked and crossed quotes
+    lf = lf.filter(~true(pl.col('best_bid') >= pl.col('best_ask')))
+
+    measures = {
+        'quoted_spread_dollar': pl.col('best_ask') - pl.col('best_bid'),
+        'quoted_spread_percent': pl.col('best_ask').log() - pl.col('best_bid').log()}
+    if len(present(lf, ['best_asksizeshares'])) > 0:
+        measures.update({
+            'best_ofr_depth_dollar': pl.col('best_ask') * pl.col('best_asksizeshares'),
+            'best_bid_depth_dollar': pl.col('best_bid') * pl.col('best_bidsizeshares'),
+            'best_ofr_depth_share': pl.col('best_asksizeshares'),
+            'best_bid_depth_share': pl.col('best_bidsizeshares')})
+    lf = lf.with_columns(e.fill_nan(None).alias(m) for m, e in measures.items())
+
+    aggs = []
+    for m in measures:
+        w = pl.when(pl.col(m).is_not_null()).then(pl.col('inforce'))
+        num = (pl.col(m) * pl.col('inforce')).sum()
+        den = w.sum()
+        aggs.append(pl.when(den != 0).then(num / den).otherwise(None).alias(m))
+    return lf.group_by('symbol').agg(aggs).sort('symbol')
+
+
+#%% Merge trades and NBBO
+
+def merge_trades_nbbo(taq, trade_df, off_nbbo_df, track_retail=False):
+    trades = (to_lazy(trade_df).with_columns(timestamp_ns())
+              .sort(['symbol', 'timestamp'], maintain_order=True))
+    quotes = (to_lazy(off_nbbo_df).with_columns(timestamp_ns())
+              .sort(['symbol', 'timestamp'], maintain_order=True))
+
+    lf = trades.join_asof(quotes, on='timestamp', by='symbol',
+                          allow_exact_matches=False, suffix='_quote',
+                          check_sortedness=False)
+    lf = lf.sort(['timestamp', 'symbol'], maintain_order=True)
+
+    price, bid, ask = pl.col('price'), pl.col('best_bid'), pl.col('best_ask')
+    lf = lf.with_columns(
+        ((bid + ask) / 2).alias('midpoint'),
+        true(bid == ask).cast(pl.Int64).alias('lock'),
+        true(bid > ask).cast(pl.Int64).alias('cross'))
+
+    # Trade direction (tick test)
+    tick = price.diff().sign().over('symbol')
+    tick = pl.when(tick == 0).then(None).otherwise(tick)
+    lf = lf.with_columns(tick.cast(pl.Float64).alias('dir')).with_columns(
+        pl.col('dir').forward_fill().over('symbol'))
+
+    not_lc = (pl.col('lock') == 0) & (pl.col('cross') == 0)
+    mid = pl.col('midpoint')
+    ofr30 = ask - 0.3 * (ask - bid)
+    bid30 = bid + 0.3 * (ask - bid)
+    lf = lf.with_columns(
+        pl.when(not_lc & true(price > mid)).then(1.0)
+        .when(not_lc & true(price < mid)).then(-1.0)
+        .otherwise(pl.col('dir')).alias('BuySellLR'),
+        pl.when(not_lc & true(price == bid)).then(-1.0)
+        .when(not_lc & true(price == ask)).then(1.0)
+        .otherwise(pl.col('dir')).alias('BuySellEMO'),
+        pl.when(not_lc & true((price <= bid30) & (price >= bid))).then(-1.0)
+        .when(not_lc & true((price >= ofr30) & (price <= ask))).then(1.0)
+        .otherwise(pl.col('dir')).alias('BuySellCLNV')).drop('dir')
+
+    if track_retail:
+        # Retail sign following Boehmer, Jones, and Zhang
+        z = 100 * (price % 0.01)
+        lf = lf.with_columns(
+            pl.when((pl.col('ex') == 'D') & (z >= 0.6) & (z < (1 - 1e-4))).then(1.0)
+            .when((pl.col('ex') == 'D') & (z >= 1e-4) & (z < .4)).then(-1.0)
+            .otherwise(None).alias('BuySellBJZ'))
+        lf = lf.with_columns(
+            pl.when(pl.col('BuySellBJZ').is_null())
+            .then(pl.col('BuySell' + x)).otherwise(None)
+            .alias('BuySell' + x + 'notBJZ') for x in ['LR', 'EMO', 'CLNV'])
+
+    return lf.with_columns((price * pl.col('size')).alias('dollar'))
+
+
+#%% Realized spread and price impact
+
+def compute_rs_and_pi(taq, trade_and_nbbo_df, off_nbbo_df, delay, suffix,
+                      track_retail=False):
+    next_lf = (to_lazy(off_nbbo_df)
+               .select('timestamp', 'symbol', 'best_bid', 'best_ask')
+               .with_columns(((pl.col('best_bid') + pl.col('best_ask')) / 2)
+                             .alias('midpoint'),
+                             timestamp_ns(pl.col('timestamp') - delay))
+               .sort(['symbol', 'timestamp'], maintain_order=True))
+    lf = (to_lazy(trade_and_nbbo_df)
+          .with_row_index('_order')
+          .with_columns(timestamp_ns())
+          .sort(['symbol', 'timestamp'], maintain_order=True)
+          .join_asof(next_lf, on='timestamp', by='symbol',
+                     allow_exact_matches=False, suffix='_next',
+                     check_sortedness=False)
+          .sort(['timestamp', 'symbol', '_order']).drop('_order'))
+
+    lf = lf.filter(~true(pl.col('best_bid_next') >= pl.col('best_ask_next')))
+
+    signs = ['LR', 'EMO', 'CLNV']
+    if track_retail:
+        signs += ['BJZ'] + [x + 'notBJZ' for x in signs]
+
+    price, mid = pl.col('price'), pl.col('midpoint')
+    mid_next = pl.col('midpoint_next')
+    cols = []
+    for sign in signs:
+        s = pl.col('BuySell' + sign)
+        cols += [(s * (price - mid_next) * 2).alias('DollarRealizedSpread_' + sign + suffix),
+                 (s * (price.log() - mid_next.log()) * 2).alias('PercentRealizedSpread_' + sign + suffix),
+                 (s * (mid_next - mid) * 2).alias('DollarPriceImpact_' + sign + suffix),
+                 (s * (mid_next.log() - mid.log()) * 2).alias('PercentPriceImpact_' + sign + suffix)]
+    return lf.with_columns(cols)
@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event replay of the official complete NBBO and trades, with compiled
+callbacks.
+
+replay() walks the quotes and trades of each symbol in timestamp order and
+calls the Numba-compiled (@numba.njit) callbacks of a ReplayPlugin:
+
+    on_quote(state, out, b, t, bid, ask, bidsize, asksize, ctx, params)
+    on_trade(state, trade_state, out, b, t, price, size, ctx, params)
+    on_delayed_trade(state, trade_state, out, b, t, price, size, ctx, params)
+    on_end(state, out, ctx, params)
+
+- state: float64 array of n_state values, one per symbol (init_state at the
+  start of the symbol).
+- trade_state: float64 array of n_trade_state values for the trade, shared
+  by its on_trade and on_delayed_trade calls.
+- out: float64 array (n_buckets, len(outputs)) of the symbol, zeros at the
+  start. Results are accumulated in out[b].
+- b: time bucket of the event, -1 if outside of [start_time, end_time).
+- t: int64 nanoseconds since midnight.
+- ctx: int64 array [start, end, bucket length, n_buckets, delay]
+  (nanoseconds since midnight, see ctx_* below).
+- params: float64 array of parameters of the plugin (by default, the price
+  scale and whether prices are fixed-point, see get_params).
+
+A trade at time t is replayed before the quotes at time t, so that the quote
+in force is the last quote strictly before the trade (as in
+merge_trades_nbbo). With a delay, on_delayed_trade is called at t + delay,
+before the quotes at t + delay (the quote after the delay is as in
+compute_rs_and_pi), with b the bucket of the trade.
+
+The built-in plugins spreads_plugin(), effective_spreads_plugin() and
+rs_and_pi_plugin() compute the daily (or bucketed) outputs of
+compute_spreads, and of compute_averages_ave_sw_dw on the outputs of
+compute_effective_spreads and compute_rs_and_pi.
+"""
+
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from numba import njit
+
+from pytaq import taq_time
+
+ctx_start = 0
+ctx_end = 1
+ctx_bucket = 2
+ctx_n_buckets = 3
+ctx_delay = 4
+
+
+#%% Engine
+
+@njit
+def no_quote(state, out, b, t, bid, ask, bidsize, asksize, ctx, params):
+    pass
+
+
+@njit
+def no_trade(state, trade_state, out, b, t, price, size, ctx, params):
+    pass
+
+
+@njit
+def no_end(state, out, ctx, params):
+    pass
+
+
+class ReplayPlugin():
+    def __init__(self, outputs, on_quote=None, on_trade=None,
+                 on_delayed_trade=None, on_end=None, n_state=0,
+                 n_trade_state=0, init_state=None, params=None, delay=None,
+                 finalize=None):
+        # finalize(taq, out_df): DataFrame of the outputs of the plugin,
+        # from the accumulated out arrays (indexed by symbol, or symbol and
+        # bucket).
+        self.outputs = list(outputs)
+        self.on_quote = no_quote if on_quote is None else on_quote
+        self.on_trade = no_trade if on_trade is None else on_trade
+        self.on_delayed_trade = (no_trade if on_delayed_trade is None
+                                 else on_delayed_trade)
+        self.on_end = no_end if on_end is None else on_end
+        self.n_state = n_state
+        self.n_trade_state = n_trade_state
+        self.init_state = init_state
+        self.params = params
+        self.delay = delay
+        self.finalize = finalize
+
+    def uses_trades(self):
+        return ((self.on_trade is not no_trade) or
+                (self.on_delayed_trade is not no_trade))
+
+    def get_params(self, taq):
+        # Unless given, plugins get the price scale (1 without fixed-point
+        # prices) and whether prices are fixed-point as their parameters
+        if self.params is not None:
+            return np.asarray(self.params, dtype='f8')
+        if taq.price_scale is None:
+            return np.array([1.0, 0.0])
+        return np.array([float(taq.price_scale), 1.0])
+
+
+@njit
+def bucket_of(t, ctx):
+    if (t < ctx[ctx_start]) or (t >= ctx[ctx_end]):
+        return -1
+    return (t - ctx[ctx_start]) // ctx[ctx_bucket]
+
+
+@njit
+def replay_kernel(on_quote, on_trade, on_delayed_trade, on_end,
+                  q_starts, q_t, q_bid, q_ask, q_bidsize, q_asksize,
+                  t_starts, t_t, t_price, t_size, has_delay,
+                  state, trade_state, out, ctx, params):
+    end_of_day = np.iinfo(np.int64).max
+    for s in range(len(q_starts) - 1):
+        i, i_end = q_starts[s], q_starts[s + 1]
+        j, j_end = t_starts[s], t_starts[s + 1]
+        k = j
+        while True:
+            tq = q_t[i] if i < i_end else end_of_day
+            tt = t_t[j] if j < j_end else end_of_day
+            # The delayed event of a trade comes after the trade
+            td = end_of_day
+            if has_delay and (k < j):
+                td = t_t[k] + ctx[ctx_delay]
+            if (tq == end_of_day) and (tt == end_of_day) and (td == end_of_day):
+                break
+            if (td <= tt) and (td <= tq):
+                on_delayed_trade(state[s], trade_state[k], out[s],
+                                 bucket_of(t_t[k], ctx), td, t_price[k],
+                                 t_size[k], ctx, params)
+                k += 1
+            elif tt <= tq:
+                on_trade(state[s], trade_state[j], out[s], bucket_of(tt, ctx),
+                         tt, t_price[j], t_size[j], ctx, params)
+                j += 1
+            else:
+                on_quote(state[s], out[s], bucket_of(tq, ctx), tq, q_bid[i],
+                         q_ask[i], q_bidsize[i], q_asksize[i], ctx, params)
+                i += 1
+        on_end(state[s], out[s], ctx, params)
+
+
+def sort_events(df, symbols, columns):
+    # Times (ns since midnight), first row of each symbol and columns
+    # (float64) sorted by symbol and timestamp, ties keep their order
+    t = taq_time.ns_of_day(df['timestamp'].values)
+    codes = symbols.get_indexer(np.asarray(df['symbol'], dtype=object))
+    order = np.lexsort((t, codes))
+    starts = np.searchsorted(codes[order], np.arange(len(symbols) + 1))
+    values = []
+    for c in columns:
+        if c in df.columns:
+            values.append(np.ascontiguousarray(df[c].values[order], dtype='f8'))
+        else:
+            values.append(np.full(len(df), np.nan))
+    return [starts, np.ascontiguousarray(t[order])] + values
+
+
+def replay(taq, date, plugin, symbols=None, off_nbbo_df=None, trade_df=None,
+           freq=None, start_time=None, end_time=None):
+    # Daily outputs (one bucket from start_time to end_time) if freq is
+    # None, otherwise outputs for each bucket of length freq.
+    if start_time is None:
+        start_time = taq.start_time_trades
+    if end_time is None:
+        end_time = taq.end_time_trades
+
+    if off_nbbo_df is None:
+        off_nbbo_df = taq.get_official_complete_nbbo(date=date, symbols=symbols)
+    if (trade_df is None) and plugin.uses_trades():
+        trade_df = taq.get_trade_table(date=date, symbols=symbols)
+    if trade_df is None:
+        trade_df = pd.DataFrame({'timestamp': np.array([], dtype='datetime64[ns]'),
+                                 'symbol': np.array([], dtype=object)})
+    # Note: polars frames are converted (the replay only uses NumPy arrays)
+    if not isinstance(off_nbbo_df, pd.DataFrame):
+        off_nbbo_df = off_nbbo_df.to_pandas()
+    if not isinstance(trade_df, pd.DataFrame):
+        trade_df = trade_df.to_pandas()
+
+    all_symbols = pd.Index(np.union1d(
+        np.asarray(off_nbbo_df['symbol'].unique(), dtype=object),
+        np.asarray(trade_df['symbol'].unique(), dtype=object)), name='symbol')
+    quotes = sort_events(off_nbbo_df, all_symbols,
+                         ['best_bid', 'best_ask', 'best_bidsizeshares',
+                          'best_asksizeshares'])
+    trades = sort_events(trade_df, all_symbols, ['price', 'size'])
+
+    start = taq_time.time_to_ns(start_time)
+    end = taq_time.time_to_ns(end_time)
+    bucket = end - start if freq is None else taq_time.to_ns_delta(freq)
+    n_buckets = max(-(-(end - start) // bucket), 1)
+    delay = 0 if plugin.delay is None else taq_time.to_ns_delta(plugin.delay)
+    ctx = np.array([start, end, bucket, n_buckets, delay], dtype='i8')
+
+    n = len(all_symbols)
+    state = np.zeros((n, plugin.n_state))
+    if plugin.init_state is not None:
+        state[:] = plugin.init_state
+    trade_state = np.zeros((len(trades[1]), plugin.n_trade_state))
+    out = np.zeros((n, n_buckets, len(plugin.outputs)))
+
+    replay_kernel(plugin.on_quote, plugin.on_trade, plugin.on_delayed_trade,
+                  plugin.on_end, *quotes, *trades, plugin.delay is not None,
+                  state, trade_state, out, ctx, plugin.get_params(taq))
+
+    if freq is None:
+        index = all_symbols
+    else:
+        buckets = taq_time.to_datetime64(taq_time.day_ns(date) + start +
+                                         np.arange(n_buckets) * bucket)
+        index = pd.MultiIndex.from_product([all_symbols, buckets],
+                                           names=['symbol', 'bucket'])
+    out_df = pd.DataFrame(out.reshape(n * n_buckets, len(plugin.outputs)),
+                          index=index, columns=plugin.outputs)
+    if plugin.finalize is not None:
+        out_df = plugin.finalize(taq, out_df)
+    return out_df
+
+
+#%% Built-in plugins
+
+# Sums of a measure for the simple, dollar-weighted and share-weighted
+# averages, in the columns j to j + 5 of out (same sums as
+# TaqDaily.aggregate_ave_sw_dw).
+def ave_sw_dw_outputs(measures):
+    return [m + x for m in measures
+            for x in ['_n', '_sum', '_dollar', '_dollar_sum', '_size', '_size_sum']]
+
+
+@njit
+def add_ave_sw_dw(out, j, v, dollar, size):
+    if (v == v) and (dollar == dollar) and (size == size):
+        out[j] += 1
+        out[j + 1] += v
+        out[j + 2] += dollar
+        out[j + 3] += v * dollar
+        out[j + 4] += size
+        out[j + 5] += v * size
+
+
+def finalize_ave_sw_dw(measures):
+    # Symbols (or buckets) without trades are left out, as in
+    # compute_averages_ave_sw_dw
+    def finalize(taq, out_df):
+        out_df = out_df[out_df['n_trades'] > 0]
+        return taq.finalize_ave_sw_dw(out_df, measures)
+    return finalize
+
+
+#%%%% Quoted spreads and depths
+
+spread_measures = ['quoted_spread_dollar', 'quoted_spread_percent',
+                   'best_ofr_depth_dollar', 'best_bid_depth_dollar',
+                   'best_ofr_depth_share', 'best_bid_depth_share']
+
+# state: time, bid, ask, bid size, ask size of the last quote in the window,
+# and whether there is one
+
+
+@njit
+def add_quote_in_force(state, out, t_end, ctx, params):
+    # Time-weighted sums of the last quote, in force until t_end (split
+    # across the buckets it overlaps). Locked and crossed quotes are left
+    # out.
+    bid, ask = state[1], state[2]
+    if (bid == ask) or (bid > ask):
+        return
+    scale = params[0]
+    values = np.array([(ask - bid) / scale, np.log(ask) - np.log(bid),
+                       ask * state[4] / scale, bid * state[3] / scale,
+                       state[4], state[3]])
+    t = np.int64(state[0])
+    while t < t_end:
+        b = (t - ctx[ctx_start]) // ctx[ctx_bucket]
+        e = min(t_end, ctx[ctx_start] + (b + 1) * ctx[ctx_bucket])
+        w = (e - t) / 1e9
+        for m in range(len(values)):
+            if values[m] == values[m]:
+                out[b, 2 * m] += values[m] * w
+                out[b, 2 * m + 1] += w
+        t = e
+
+
+@njit
+def spreads_on_quote(state, out, b, t, bid, ask, bidsize, asksize, ctx, params):
+    # Quotes outside of the window are left out
+    if b < 0:
+        return
+    if state[5] == 1:
+        add_quote_in_force(state, out, t, ctx, params)
+    state[0] = t
+    state[1] = bid
+    state[2] = ask
+    state[3] = bidsize
+    state[4] = asksize
+    state[5] = 1
+
+
+@njit
+def spreads_on_end(state, out, ctx, params):
+    # The last quote is in force until the end of the window
+    if state[5] == 1:
+        add_quote_in_force(state, out, ctx[ctx_end], ctx, params)
+
+
+def spreads_plugin(depth=True):
+    # Same outputs as compute_spreads (daily), or time-weighted averages in
+    # each bucket. Unlike compute_intraday_spreads, the quote in force at
+    # the start of the window is not carried in.
+    measures = spread_measures if depth else spread_measures[:2]
+
+    def finalize(taq, out_df):
+        # Symbols (or buckets) without a quote in force are left out, as in
+        # compute_intraday_spreads (a bucket can be covered by a quote of an
+        # earlier bucket)
+        weights = out_df[[m + '_weight' for m in spread_measures]]
+        out_df = out_df[(weights > 0).any(axis=1)]
+        out = {}
+        for m in measures:
+            den = out_df[m + '_weight']
+            out[m] = out_df[m + '_sum'] / den.where(den > 0)
+        return pd.DataFrame(out, index=out_df.index)
+
+    return ReplayPlugin([m + x for m in spread_measures
+                         for x in ['_sum', '_weight']],
+                        on_quote=spreads_on_quote, on_end=spreads_on_end,
+                        n_state=6, finalize=finalize)
+
+
+#%%%% Effective spreads
+
+effective_spread_measures = ['DollarEffectiveSpread', 'PercentEffectiveSpread']
+
+# state: bid and ask in force
+
+
+@njit
+def nbbo_on_quote(state, out, b, t, bid, ask, bidsize, asksize, ctx, params):
+    state[0] = bid
+    state[1] = ask
+
+
+@njit
+def effective_spreads_on_trade(state, trade_state, out, b, t, price, size,
+                               ctx, params):
+    bid, ask = state[0], state[1]
+    # Trades outside of the window, or at locked and crossed quotes, are
+    # left out
+    if (b < 0) or (bid == ask) or (bid > ask):
+        return
+    scale = params[0]
+    midpoint = (bid + ask) / 2
+    dollar = price * size / scale
+    o = out[b]
+    o[-1] += 1
+    add_ave_sw_dw(o, 0, np.abs(price - midpoint) * 2 / scale, dollar, size)
+    add_ave_sw_dw(o, 6, np.abs(np.log(price) - np.log(midpoint)) * 2, dollar,
+                  size)
+
+
+def effective_spreads_plugin():
+    # Same outputs as compute_averages_ave_sw_dw(compute_effective_spreads())
+    return ReplayPlugin(ave_sw_dw_outputs(effective_spread_measures) + ['n_trades'],
+                        on_quote=nbbo_on_quote,
+                        on_trade=effective_spreads_on_trade, n_state=2,
+                        init_state=np.full(2, np.nan),
+                        finalize=finalize_ave_sw_dw(effective_spread_measures))
+
+
+#%%%% Realized spreads and price impact
+
+# state: bid and ask in force, last price and direction (tick test), and
+# whether there is a last price
+# trade_state: midpoint at the trade, and its LR, EMO and CLNV signs
+
+
+@njit
+def rs_and_pi_on_trade(state, trade_state, out, b, t, price, size, ctx,
+                       params):
+    # Tick test, zero ticks keep the last direction
+    if state[4] == 1:
+        d = np.sign(price - state[2])
+        if d != 0:
+            state[3] = d
+    state[2] = price
+    state[4] = 1
+    direction = state[3]
+
+    bid, ask = state[0], state[1]
+    midpoint = (bid + ask) / 2
+    lr, emo, clnv = direction, direction, direction
+    if not ((bid == ask) or (bid > ask)):
+        if price > midpoint:
+            lr = 1.0
+        elif price < midpoint:
+            lr = -1.0
+        if price == ask:
+            emo = 1.0
+        if price == bid:
+            emo = -1.0
+        if params[1] == 1:
+            # Fixed-point prices, exact in ticks
+            above_ofr30 = 10 * price >= 7 * ask + 3 * bid
+            below_bid30 = 10 * price <= 7 * bid + 3 * ask
+        else:
+            above_ofr30 = price >= ask - 0.3 * (ask - bid)
+            below_bid30 = price <= bid + 0.3 * (ask - bid)
+        if above_ofr30 and (price <= ask):
+            clnv = 1.0
+        if below_bid30 and (price >= bid):
+            clnv = -1.0
+    trade_state[0] = midpoint
+    trade_state[1] = lr
+    trade_state[2] = emo
+    trade_state[3] = clnv
+
+
+@njit
+def rs_and_pi_on_delayed_trade(state, trade_state, out, b, t, price, size,
+                               ctx, params):
+    bid, ask = state[0], state[1]
+    # Trades with locked or crossed quotes after the delay are left out
+    if (b < 0) or (bid == ask) or (bid > ask):
+        return
+    scale = params[0]
+    midpoint = trade_state[0]
+    midpoint_next = (bid + ask) / 2
+    dollar = price * size / scale
+    o = out[b]
+    o[-1] += 1
+    for i in range(3):
+        s = trade_state[1 + i]
+        j = 24 * i
+        add_ave_sw_dw(o, j, s * (price - midpoint_next) * 2 / scale, dollar, size)
+        add_ave_sw_dw(o, j + 6, s * (np.log(price) - np.log(midpoint_next)) * 2,
+                      dollar, size)
+        add_ave_sw_dw(o, j + 12, s * (midpoint_next - midpoint) * 2 / scale,
+                      dollar, size)
+        add_ave_sw_dw(o, j + 18, s * (np.log(midpoint_next) - np.log(midpoint)) * 2,
+                      dollar, size)
+
+
+def rs_and_pi_plugin(delay=timedelta(minutes=5), suffix='5min'):
+    # Same outputs as compute_averages_ave_sw_dw(compute_rs_and_pi()) for
+    # the LR, EMO and CLNV signs (without track_retail)
+    measures = [x + '_' + sign + suffix for sign in ['LR', 'EMO', 'CLNV']
+                for x in ['DollarRealizedSpread', 'PercentRealizedSpread',
+                          'DollarPriceImpact', 'PercentPriceImpact']]
+    return ReplayPlugin(ave_sw_dw_outputs(measures) + ['n_trades'],
+                        on_quote=nbbo_on_quote, on_trade=rs_and_pi_on_trade,
+                        on_delayed_trade=rs_and_pi_on_delayed_trade,
+                        n_state=5, n_trade_state=4,
+                        init_state=np.array([np.nan, np.nan, np.nan, np.nan, 0]),
+                        delay=delay, finalize=finalize_ave_sw_dw(measures))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local server sharing cleaned TAQ days between research processes.
+
+A TaqServer wraps a TaqDaily object (with a database backend) and answers
+requests on a Unix socket. Each day is fetched and cleaned once, kept in the
+StageCache of the TaqDaily object (LRU eviction by memory budget), and
+served to any number of clients as Arrow IPC streams. Requests are handled
+in parallel threads; concurrent requests for the same output wait for the
+first one instead of loading it again.
+
+Clients use TaqDaily(method='Server', db=TaqServerClient(path)): the get_*
+stages and merge_trades_nbbo then return the cleaned tables of the server,
+computed with the configuration of the client TaqDaily object. The compute_*
+measures can also be computed by the server with TaqServerClient.compute().
+
+Protocol: a request is a JSON object, and the response a JSON header
+followed (if ok) by an Arrow IPC stream. Both JSON messages are prefixed by
+their length (4 bytes, big-endian).
+"""
+
+import copy
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+from concurrent.futures import Future
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from pytaq.taq_cache import StageCache
+from pytaq.taq_time import ns_of_day, time_to_ns
+
+
+# Outputs that can be requested, the stages are memoized by the server
+stage_methods = ['get_nbbo_table', 'get_quote_table', 'get_trade_table',
+                 'get_official_complete_nbbo', 'merge_trades_nbbo']
+compute_methods = ['compute_spreads', 'compute_intraday_spreads',
+                   'compute_effective_spreads', 'compute_rs_and_pi']
+
+
+#%% Messages
+
+def encode_value(x):
+    # JSON encoding of configuration values and parameters
+    if isinstance(x, datetime):
+        return {'datetime': x.isoformat()}
+    if isinstance(x, date):
+        return {'date': x.isoformat()}
+    if isinstance(x, time):
+        return {'time': x.isoformat()}
+    if isinstance(x, timedelta):
+        return {'timedelta': x.total_seconds()}
+    if isinstance(x, (list, tuple)):
+        return [encode_value(y) for y in x]
+    return x
+
+
+def decode_value(x):
+    if isinstance(x, dict) and (len(x) == 1):
+        kind, value = list(x.items())[0]
+        if kind == 'datetime':
+            return datetime.fromisoformat(value)
+        if kind == 'date':
+            return date.fromisoformat(value)
+        if kind == 'time':
+            return time.fromisoformat(value)
+        if kind == 'timedelta':
+            return timedelta(seconds=value)
+    if isinstance(x, list):
+        return [decode_value(y) for y in x]
+    return x
+
+
+def send_message(f, message):
+    data = json.dumps(message).encode('utf-8')
+    f.write(struct.pack('>I', len(data)) + data)
+    f.flush()
+
+
+def recv_message(f):
+    header = f.read(4)
+    if len(header) < 4:
+        return None
+    (n,) = struct.unpack('>I', header)
+    return json.loads(f.read(n).decode('utf-8'))
+
+
+def slice_frame(df, symbols=None, start=None, end=None):
+    # Rows of the symbols, with timestamp (time of day) in [start, end)
+    sel = None
+    if symbols is not None:
+        if 'symbol' in df.columns:
+            sel = df['symbol'].isin(symbols).values
+        elif 'symbol' in df.index.names:
+            sel = df.index.get_level_values('symbol').isin(symbols)
+    if ((start is not None) or (end is not None)) and ('timestamp' in df.columns):
+        t = ns_of_day(df['timestamp'].values)
+        s = np.ones(len(df), dtype=bool)
+        if start is not None:
+            s &= t >= time_to_ns(start)
+        if end is not None:
+            s &= t < time_to_ns(end)
+        sel = s if sel is None else (sel & s)
+    if sel is None:
+        return df
+    return df[sel]
+
+
+#%% Server
+
+class TaqServer():
+    def __init__(self, taq, path, max_bytes=4 * 2**30, full_days=False):
+        # taq: TaqDaily object used to load the days. Its db is shared by
+        # the request threads (use e.g. a TaqConnectionPool).
+        # With full_days, stages are loaded for all symbols and the
+        # requested symbols are sliced from them, so that requests for
+        # different symbols share the same day.
+        self.taq = taq
+        if taq.cache is None:
+            taq.cache = StageCache(max_bytes)
+        self.path = path
+        self.full_days = full_days
+
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.requests = 0
+        self.server = None
+        self.thread = None
+
+    def session(self, config):
+        # TaqDaily with the configuration of the client, sharing the db and
+        # cache of the server
+        taq = copy.copy(self.taq)
+        for a, value in config.items():
+            if (a in taq.config_attributes) or (a in ['measures', 'price_scale']):
+                setattr(taq, a, decode_value(value))
+        return taq
+
+    def run(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return None
+        if op == 'stats':
+            cache = self.taq.cache
+            return pd.DataFrame({'requests': [self.requests],
+                                 'entries': [len(cache.entries)],
+                                 'nbytes': [cache.nbytes],
+                                 'max_bytes': [cache.max_bytes],
+                                 'hits': [cache.hits],
+                                 'misses': [cache.misses]})
+
+        taq = self.session(request.get('config', {}))
+        date = decode_value(request['date'])
+        if op == 'symbols':
+            return pd.DataFrame({'symbol': taq.get_nbbo_symbols(date)})
+
+        method = request.get('method')
+        if ((op == 'stage') and (method in stage_methods)) or \
+                ((op == 'compute') and (method in compute_methods)):
+            pass
+        else:
+            raise Exception('Unknown request for TaqServer: ' + str(op) + ' ' +
+                            str(method))
+        params = {k: decode_value(v) for k, v in request.get('params', {}).items()}
+        symbols = request.get('symbols')
+        load_symbols = None if self.full_days else symbols
+
+        # Concurrent requests for the same output are loaded once
+        key = json.dumps([op, method, request['date'], load_symbols, params,
+                          request.get('config', {})], sort_keys=True,
+                         default=str)
+        # (the first request loads it, the others wait for its Future)
+        with self.lock:
+            future = self.loading.get(key)
+            first = future is None
+            if first:
+                future = self.loading[key] = Future()
+        if first:
+            try:
+                future.set_result(getattr(taq, method)(date=date,
+                                                       symbols=load_symbols,
+                                                       **params))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+        df = future.result()
+
+        return slice_frame(df, symbols if self.full_days else None,
+                           decode_value(request.get('start')),
+                           decode_value(request.get('end')))
+
+    def handle(self, rfile, wfile):
+        request = recv_message(rfile)
+        if request is None:
+            return
+        with self.lock:
+            self.requests += 1
+        try:
+            df = self.run(request)
+            table = None if df is None else pa.Table.from_pandas(df)
+        except Exception as e:
+            send_message(wfile, {'ok': False, 'error': str(e)})
+            return
+        if table is None:
+            send_message(wfile, {'ok': True})
+        else:
+            send_message(wfile, {'ok': True, 'rows': table.num_rows})
+            with pa.ipc.new_stream(wfile, table.schema) as writer:
+                writer.write_table(table)
+        wfile.flush()
+
+    def start(self, background=True):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.handle(self.rfile, self.wfile)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self.server.daemon_threads = True
+        if background:
+            self.thread = threading.Thread(target=self.server.serve_forever,
+                                           daemon=True)
+            self.thread.start()
+        else:
+            self.server.serve_forever()
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+#%% Client
+
+class TaqServerClient():
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+
+    def request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            with sock.makefile('wb') as wfile:
+                send_message(wfile, request)
+            with sock.makefile('rb') as rfile:
+                response = recv_message(rfile)
+                if response is None:
+                    raise Exception('No response from TaqServer at ' + self.path)
+                if not response['ok']:
+                    raise Exception('TaqServer error: ' + response['error'])
+                if 'rows' not in response:
+                    return None
+                table = pa.ipc.open_stream(rfile).read_all()
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def ping(self):
+        self.request({'op': 'ping'})
+        return True
+
+    def stats(self):
+        return self.request({'op': 'stats'}).iloc[0].to_dict()
+
+    def config(self, taq):
+        if taq is None:
+            return {}
+        config = {a: getattr(taq, a) for a in taq.config_attributes}
+        config['measures'] = taq.measures
+        config['price_scale'] = taq.price_scale
+        return {a: encode_value(x) for a, x in config.items()}
+
+    def get_stage(self, method, date, symbols=None, taq=None, start=None,
+                  end=None, **params):
+        return self.request({'op': 'stage', 'method': method,
+                             'date': encode_value(date),
+                             'symbols': None if symbols is None else list(symbols),
+                             'params': {k: encode_value(v) for k, v in params.items()},
+                             'config': self.config(taq),
+                             'start': encode_value(start),
+                             'end': encode_value(end)})
+
+    # Measures computed by the server (e.g. compute('compute_spreads', date,
+    # symbols, taq))
+    def compute(self, method, date, symbols=None, taq=None, start=None,
+                end=None, **params):
+        return self.request({'op': 'compute', 'method': method,
+                             'date': encode_value(date),
+                             'symbols': None if symbols is None else list(symbols),
+                             'params': {k: encode_value(v) for k, v in params.items()},
+                             'config': self.config(taq),
+                             'start': encode_value(start),
+                             'end': encode_value(end)})
+
+    def get_nbbo_symbols(self, date, taq=None):
+        return list(self.request({'op': 'symbols', 'date': encode_value(date),
+                                  'config': self.config(taq)})['symbol'])
+
+
+# TaqDaily(method='Server', db=TaqServerClient(path)) backend: stages are
+# served already cleaned (see cached_stage), there are no raw tables.
+class ServerBackend():
+    def table_source(self, taq, table):
+        raise Exception('Method Server does not run SQL queries')
+
+    def get_stage(self, taq, method, date, symbols, params):
+        df = taq.db.get_stage(method, date, symbols, taq=taq, **params)
+        if (taq.engine == 'polars') and taq.polars_output:
+            import polars as pl
+            df = pl.from_pandas(df)
+        return df
+
+    def get_nbbo_symbols(self, taq, date):
+        return taq.db.get_nbbo_symbols(date, taq=taq)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Daily results store: partitioned Parquet files by measure, configuration
+hash and date.
+
+Layout: <path>/<measure>/config_hash=<hash>/date=<YYYYMMDD>/part-0.parquet
+"""
+
+import json
+import os
+from datetime import timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+class TaqStore():
+    # Daily measures computed by compute()
+    measures = ['spreads', 'effective_spreads', 'rs_pi']
+
+    def __init__(self, path):
+        self.path = path
+        self.partitioning = ds.partitioning(
+            pa.schema([('config_hash', pa.string()), ('date', pa.string())]),
+            flavor='hive')
+
+    def partition_path(self, measure, date, config_hash):
+        return os.path.join(self.path, measure, 'config_hash=' + config_hash,
+                            'date=' + date.strftime('%Y%m%d'))
+
+    def has(self, measure, date, config_hash):
+        # Dates with no results (e.g. no quotes) are recorded by an _empty
+        # marker, ignored when reading the dataset
+        path = self.partition_path(measure, date, config_hash)
+        return (os.path.exists(os.path.join(path, 'part-0.parquet')) or
+                os.path.exists(os.path.join(path, '_empty')))
+
+    def dates(self, measure, config_hash):
+        path = os.path.join(self.path, measure, 'config_hash=' + config_hash)
+        if not os.path.isdir(path):
+            return []
+        return sorted(pd.to_datetime(d[len('date='):], format='%Y%m%d')
+                      for d in os.listdir(path) if d.startswith('date='))
+
+    def get_config(self, measure, config_hash):
+        path = os.path.join(self.path, measure, 'config_hash=' + config_hash,
+                            '_config.json')
+        with open(path) as f:
+            return json.load(f)
+
+    #%% Write
+
+    def write_config(self, path, config):
+        if config is not None:
+            config_path = os.path.join(os.path.dirname(path), '_config.json')
+            if not os.path.exists(config_path):
+                with open(config_path, 'w') as f:
+                    json.dump(config, f, sort_keys=True, indent=1, default=str)
+
+    def write(self, measure, date, df, config_hash, config=None):
+        # Results are indexed by symbol; store them sorted by symbol so that
+        # time-series reads of a few symbols can skip most of each file.
+        df = df.reset_index().sort_values('symbol')
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        path = self.partition_path(measure, date, config_hash)
+        os.makedirs(path, exist_ok=True)
+        self.write_config(path, config)
+
+        # Write then rename, so that rewriting a date replaces it atomically
+        # and an interrupted run never leaves a partial file behind.
+        tmp_file = os.path.join(path, '.part-0.parquet.tmp')
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, os.path.join(path, 'part-0.parquet'))
+
+    def write_empty(self, measure, date, config_hash, config=None):
+        # Records a date without results, so that it is not computed again
+        path = self.partition_path(measure, date, config_hash)
+        os.makedirs(path, exist_ok=True)
+        self.write_config(path, config)
+        open(os.path.join(path, '_empty'), 'w').close()
+
+    #%% Read
+
+    def read(self, measure, config_hash=None, start_date=None, end_date=None,
+             symbols=None, columns=None):
+        path = os.path.join(self.path, measure)
+        if config_hash is None:
+            hashes = []
+            if os.path.isdir(path):
+                hashes = [d[len('config_hash='):] for d in os.listdir(path)
+                          if d.startswith('config_hash=')]
+            if len(hashes) > 1:
+                raise Exception('Multiple configurations stored for ' +
+                                measure + ', config_hash needed for read()')
+            config_hash = hashes[0] if len(hashes) == 1 else None
+
+        empty = pd.DataFrame(index=pd.MultiIndex.from_arrays(
+            [pd.DatetimeIndex([]), pd.Index([], dtype=object)],
+            names=['date', 'symbol']))
+        if (config_hash is None) or not os.path.isdir(
+                os.path.join(path, 'config_hash=' + config_hash)):
+            # Nothing stored for the measure (and configuration)
+            return empty
+        dataset = ds.dataset(os.path.join(path, 'config_hash=' + config_hash),
+                             format='parquet',
+                             partitioning=ds.partitioning(
+                                 pa.schema([('date', pa.string())]),
+                                 flavor='hive'))
+
+        filt = None
+        conds = []
+        if start_date is not None:
+            conds.append(ds.field('date') >= start_date.strftime('%Y%m%d'))
+        if end_date is not None:
+            conds.append(ds.field('date') <= end_date.strftime('%Y%m%d'))
+        if symbols is not None:
+            conds.append(ds.field('symbol').isin(list(symbols)))
+        for c in conds:
+            filt = c if filt is None else filt & c
+
+        if columns is not None:
+            columns = ['date', 'symbol'] + [c for c in columns
+                                            if c not in ('date', 'symbol')]
+        if len(dataset.files) == 0:
+            # Only dates without results
+            return empty
+        df = dataset.to_table(columns=columns, filter=filt).to_pandas()
+        df['date'] = pd.to_datetime(df['date'], format='%Y%m%d')
+        return df.set_index(['date', 'symbol']).sort_index()
+
+    #%% Compute and store
+
+    def compute(self, taq, dates, symbols=None, measures=None,
+                delay=timedelta(minutes=5), suffix='5min', overwrite=False):
+        if measures is None:
+            measures = self.measures
+        hashes, configs = config_hashes(taq, measures, delay, suffix, symbols)
+
+        for date in dates:
+            todo = [m for m in measures
+                    if overwrite or not self.has(m, date, hashes[m])]
+            if len(todo) == 0:
+                continue
+
+            out = compute_measures(taq, date, symbols, todo, delay, suffix)
+            for m in todo:
+                if m in out:
+                    self.write(m, date, out[m], hashes[m], config=configs[m])
+                else:
+                    self.write_empty(m, date, hashes[m], config=configs[m])
+
+
+# Configuration hash and configuration of each measure. Results for a subset
+# of symbols are stored under their own configuration.
+def config_hashes(taq, measures, delay=timedelta(minutes=5), suffix='5min',
+                  symbols=None):
+    for m in measures:
+        if m not in TaqStore.measures:
+            raise Exception('Unknown measure for TaqStore: ' + str(m))
+    extra = {} if symbols is None else {'symbols': sorted(symbols)}
+    hashes = {m: taq.config_hash(**extra) for m in measures}
+    configs = {m: taq.get_config(**extra) for m in measures}
+    if 'rs_pi' in measures:
+        hashes['rs_pi'] = taq.config_hash(delay=delay, suffix=suffix, **extra)
+        configs['rs_pi'] = taq.get_config(delay=delay, suffix=suffix, **extra)
+    return hashes, configs
+
+
+# Daily measures of one date (measure: DataFrame indexed by symbol), measures
+# with no output (e.g. no quotes) are left out.
+def compute_measures(taq, date, symbols=None, measures=None,
+                     delay=timedelta(minutes=5), suffix='5min'):
+    if measures is None:
+        measures = TaqStore.measures
+
+    # Share the complete NBBO and merged trades across measures
+    off_nbbo_df = taq.get_official_complete_nbbo(date=date, symbols=symbols)
+    if ('effective_spreads' in measures) or ('rs_pi' in measures):
+        trade_and_nbbo_df = taq.merge_trades_nbbo(
+            date=date, symbols=symbols, off_nbbo_df=off_nbbo_df)
+
+    out = {}
+    for m in measures:
+        if m == 'spreads':
+            df = taq.compute_spreads(date, symbols=symbols,
+                                     off_nbbo_df=off_nbbo_df)
+        elif m == 'effective_spreads':
+            df = taq.compute_effective_spreads(
+                trade_and_nbbo_df=trade_and_nbbo_df)
+            df = taq.compute_averages_ave_sw_dw(
+                df, ['DollarEffectiveSpread', 'PercentEffectiveSpread'])
+        elif m == 'rs_pi':
+            df = taq.compute_rs_and_pi(
+                trade_and_nbbo_df=trade_and_nbbo_df,
+                off_nbbo_df=off_nbbo_df, delay=delay, suffix=suffix)
+            rs_pi_cols = [c for c in df.columns
+                          if c.startswith(('DollarRealizedSpread_',
+                                           'PercentRealizedSpread_',
+                                           'DollarPriceImpact_',
+                                           'PercentPriceImpact_'))]
+            df = taq.compute_averages_ave_sw_dw(df, rs_pi_cols)
+        else:
+            raise Exception('Unknown measure for TaqStore: ' + str(m))
+
+        # compute_spreads returns None when there are no quotes
+        if df is not None:
+            out[m] = df
+    return out
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Integer time axis: int64 nanoseconds since midnight.
+
+Time windows, durations, delays and buckets are computed on int64 arrays of
+nanoseconds (since midnight, or since the epoch for full timestamps), and
+converted back to datetime64 only for the outputs.
+"""
+
+import numpy as np
+import pandas as pd
+
+ns_per_second = 10**9
+ns_per_day = 86400 * ns_per_second
+
+
+def time_to_ns(t):
+    # datetime.time to nanoseconds since midnight
+    return (((t.hour * 60 + t.minute) * 60 + t.second) * 10**6 +
+            t.microsecond) * 1000
+
+
+def to_ns(timestamps):
+    # datetime64 values (array or Series) to int64 nanoseconds since the epoch
+    return np.asarray(timestamps, dtype='datetime64[ns]').view('i8')
+
+
+def to_ns_delta(offset):
+    # timedelta (scalar or array) to int64 nanoseconds
+    if np.ndim(offset) == 0:
+        return pd.Timedelta(offset).value
+    return np.asarray(offset, dtype='timedelta64[ns]').view('i8')
+
+
+def ns_of_day(timestamps):
+    return np.mod(to_ns(timestamps), ns_per_day)
+
+
+def day_ns(date):
+    # Midnight of date, in nanoseconds since the epoch
+    return np.datetime64(pd.Timestamp(date).normalize(), 'ns').view('i8')
+
+
+def to_datetime64(ns):
+    return np.asarray(ns, dtype='i8').view('datetime64[ns]')
+
+
+def in_window(ns, start, end):
+    # Nanoseconds of day in [start, end) (datetime.time)
+    return (ns >= time_to_ns(start)) & (ns < time_to_ns(end))
+
+
+def combine_date_time(date, time_m):
+    # Timestamps (datetime64[ns] Series) from the date and time_m columns of
+    # the TAQ tables. time_m can hold datetime.time objects, timedeltas or
+    # datetimes (time of day).
+    day = pd.to_datetime(date).values.astype('datetime64[ns]').view('i8')
+    if time_m.dtype.kind == 'm':
+        ns = time_m.values.astype('timedelta64[ns]').view('i8')
+    elif time_m.dtype.kind == 'M':
+        ns = ns_of_day(time_m.values)
+    else:
+        ns = np.fromiter((time_to_ns(t) for t in time_m.values), dtype='i8',
+                         count=len(time_m))
+    return pd.Series(to_datetime64(day + ns), index=time_m.index)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic raw TAQ tables (same columns as the nbbom_, cqm_ and ctm_ tables
+returned by the queries of TaqDaily), for the tests.
+"""
+
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+DATE = datetime(2016, 12, 7)
+SYMBOLS = ('AAA', 'BBB', 'CCC')
+
+
+def random_times(rng, n, start, end):
+    s = datetime.combine(DATE, start)
+    e = datetime.combine(DATE, end)
+    us = np.sort(rng.integers(0, int((e - s).total_seconds() * 1e6), n))
+    return [(s + timedelta(microseconds=int(u))).time() for u in us]
+
+
+def add_timestamp(df):
+    df['timestamp'] = [datetime.combine(d, t) for d, t in
+                       zip(df['date'], df['time_m'])]
+    return df
+
+
+def raw_nbbo(symbols=SYMBOLS, n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    out = []
+    for k, sym in enumerate(symbols):
+        mid = 20 + 10 * k + np.cumsum(rng.choice([-0.01, 0, 0.01], n))
+        half = rng.choice([0.005, 0.01, 0.02], n)
+        out.append(pd.DataFrame({
+            'date': DATE.date(), 'time_m': random_times(rng, n, time(9), time(16)),
+            'sym_root': sym, 'sym_suffix': None,
+            'best_bid': np.round(mid - half, 2),
+            'best_bidsiz': rng.integers(0, 5, n).astype(float),
+            'best_ask': np.round(mid + half, 2),
+            'best_asksiz': rng.integers(1, 5, n).astype(float),
+            'qu_cond': rng.choice(['R', 'R', 'R', 'A', 'X'], n),
+            'qu_seqnum': np.arange(n) * 2,
+            'best_askex': rng.choice(['N', 'P', 'Q'], n),
+            'best_bidex': rng.choice(['N', 'P', 'Q'], n),
+            'qu_cancel': rng.choice([None, None, None, 'B'], n)}))
+    return add_timestamp(pd.concat(out, ignore_index=True))
+
+
+def raw_quote(symbols=SYMBOLS, n=400, seed=1):
+    rng = np.random.default_rng(seed)
+    out = []
+    for k, sym in enumerate(symbols):
+        mid = 20 + 10 * k + np.cumsum(rng.choice([-0.01, 0, 0.01], n))
+        half = rng.choice([0.005, 0.01, 0.03], n)
+        out.append(pd.DataFrame({
+            'date': DATE.date(), 'time_m': random_times(rng, n, time(9), time(16)),
+            'ex': rng.choice(['N', 'P', 'Q', 'Z', 'T'], n),
+            'sym_root': sym, 'sym_suffix': None,
+            'bid': np.round(mid - half, 2),
+            'bidsiz': rng.integers(0, 5, n).astype(float),
+            'ask': np.round(mid + half, 2),
+            'asksiz': rng.integers(1, 5, n).astype(float),
+            'qu_cond': rng.choice(['R', 'R', 'R', 'A', 'X'], n),
+            'qu_seqnum': np.arange(n) * 2 + 1,
+            'natbbo_ind': rng.choice(['0', '1', '4', '2'], n),
+            'qu_source': rng.choice(['C', 'N'], n),
+            'qu_cancel': rng.choice([None, None, None, 'B'], n)}))
+    return add_timestamp(pd.concat(out, ignore_index=True))
+
+
+def raw_trade(symbols=SYMBOLS, n=200, seed=2):
+    rng = np.random.default_rng(seed)
+    out = []
+    for k, sym in enumerate(symbols):
+        price = np.round(20 + 10 * k +
+                         np.cumsum(rng.choice([-0.01, 0, 0.01], n)) +
+                         rng.choice([0, 0.0023, 0.0071, 0.005], n), 4)
+        out.append(pd.DataFrame({
+            'date': DATE.date(), 'time_m': random_times(rng, n, time(9, 30), time(16)),
+            'ex': rng.choice(['N', 'D', 'Q'], n),
+            'sym_root': sym, 'sym_suffix': None,
+            'size': rng.integers(1, 10, n) * 100, 'price': price,
+            'tr_seqnum': np.arange(n),
+            'tr_scond': rng.choice(['@', '@F', ' I', '@ TI', 'O', '@6 X', 'B'], n)}))
+    return add_timestamp(pd.concat(out, ignore_index=True))
+
+
+def raw_inputs():
+    # Raw tables with symbol suffixes, locked and crossed quotes, and rows
+    # out of order
+    n, q, t = raw_nbbo(), raw_quote(), raw_trade()
+    n.loc[n.index[::37], 'sym_suffix'] = 'A'
+    q.loc[q.index[::41], 'sym_suffix'] = 'A'
+    n.loc[n.index[::23], 'best_ask'] = n.loc[n.index[::23], 'best_bid']
+    n.loc[n.index[::29], 'best_ask'] = n.loc[n.index[::29], 'best_bid'] - 0.01
+    q.loc[q.index[::31], 'ask'] = q.loc[q.index[::31], 'bid']
+    n = n.sample(frac=1, random_state=0)
+    t = t.sample(frac=1, random_state=1)
+    return n, q, t
+
+
+def raw_off_nbbo(n):
+    # Official complete NBBO columns from the nbbom_ columns
+    return n.rename(columns={'best_bidsiz': 'best_bidsizeshares',
+                             'best_asksiz': 'best_asksizeshares'})
+
+
+def clean_inputs(taq):
+    # Cleaned NBBO, quotes, trades and official complete NBBO
+    n, q, t = raw_inputs()
+    nbbo_df = taq.clean_nbbo_table(n)
+    quote_df = taq.clean_quote_table(q)
+    trade_df = taq.clean_trade_table(t)
+    off_nbbo_df = taq.get_official_complete_nbbo(nbbo_df=nbbo_df,
+                                                 quote_df=quote_df)
+    return nbbo_df, quote_df, trade_df, off_nbbo_df
+
+
+def write_lake(path, dates=(DATE,)):
+    # Local Parquet mirror of the tables (layout of TaqDuckDB and TaqMirror)
+    import os
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    n, q, t = raw_nbbo(), raw_quote(), raw_trade()
+    t['tr_corr'] = '00'
+    tables = {'nbbom': n, 'cqm': q, 'ctm': t, 'complete_nbbo': raw_off_nbbo(n)}
+    for date in dates:
+        for table, df in tables.items():
+            df = df.drop(columns=['timestamp'])
+            df['date'] = date.date()
+            folder = os.path.join(path, table, 'date=' + date.strftime('%Y%m%d'))
+            os.makedirs(folder, exist_ok=True)
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            schema = schema.set(schema.get_field_index('date'),
+                                pa.field('date', pa.date32()))
+            schema = schema.set(schema.get_field_index('sym_suffix'),
+                                pa.field('sym_suffix', pa.string()))
+            pq.write_table(pa.Table.from_pandas(df, schema=schema,
+                                                preserve_index=False),
+                           os.path.join(folder, 'part-0.parquet'))
+    return path
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the default (pandas) pipeline against the outputs of the
+original TaqDaily implementation (row-by-row pd.merge_asof and groupby code),
+stored in tests/data/baseline. The outputs must be identical, not only close.
+
+The reference files were written by the baseline commit of the repository
+on the tables of synthetic.raw_inputs(), with TaqDaily(track_retail=True).
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+from pytaq import TaqDaily
+from synthetic import DATE, raw_inputs, raw_off_nbbo
+
+baseline_path = os.path.join(os.path.dirname(__file__), 'data', 'baseline')
+
+
+def baseline(name):
+    return pd.read_parquet(os.path.join(baseline_path, name + '.parquet'))
+
+
+@pytest.fixture(scope='module')
+def outputs():
+    taq = TaqDaily(track_retail=True)
+    n, q, t = raw_inputs()
+    out = {}
+    out['nbbo'] = nbbo_df = taq.clean_nbbo_table(n.copy())
+    out['quote'] = quote_df = taq.clean_quote_table(q.copy())
+    out['trade'] = trade_df = taq.clean_trade_table(t.copy())
+    out['off_nbbo'] = off_nbbo_df = taq.get_official_complete_nbbo(
+        nbbo_df=nbbo_df, quote_df=quote_df)
+    out['off_nbbo_clean'] = taq.clean_official_complete_nbbo(
+        raw_off_nbbo(n.copy()))
+    out['spreads'] = taq.compute_spreads(DATE, off_nbbo_df=off_nbbo_df)
+    out['merge'] = m = taq.merge_trades_nbbo(trade_df=trade_df,
+                                             off_nbbo_df=off_nbbo_df)
+    out['effective_spreads'] = e = taq.compute_effective_spreads(
+        trade_and_nbbo_df=m)
+    out['effective_spreads_avg'] = taq.compute_averages_ave_sw_dw(
+        e, ['DollarEffectiveSpread', 'PercentEffectiveSpread'])
+    out['rs_pi'] = r = taq.compute_rs_and_pi(trade_and_nbbo_df=m,
+                                             off_nbbo_df=off_nbbo_df)
+    measures = [c for c in r.columns if ('Realized' in c) or ('Impact' in c)]
+    out['rs_pi_avg'] = taq.compute_averages_ave_sw_dw(r, measures)
+    return out
+
+
+@pytest.mark.parametrize('name', ['nbbo', 'quote', 'trade', 'off_nbbo',
+                                  'off_nbbo_clean', 'spreads', 'merge',
+                                  'effective_spreads', 'effective_spreads_avg',
+                                  'rs_pi', 'rs_pi_avg'])
+def test_same_as_baseline(outputs, name):
+    pd.testing.assert_frame_equal(outputs[name], baseline(name),
+                                  check_exact=True, check_names=False)
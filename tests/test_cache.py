@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from datetime import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pytaq.taq_cache import StageCache
+
+
+def frame(value, n=1000):
+    return pd.DataFrame({'x': np.full(n, value, dtype='f8')})
+
+
+def test_spill_on_eviction_after_reload(tmp_path):
+    nbytes = int(frame(0).memory_usage(deep=True).sum())
+    cache = StageCache(max_bytes=nbytes, spill_path=str(tmp_path))
+    cache.put('a', frame(1))
+    cache.put('b', frame(2))
+    # Reloading a from disk evicts b, which must be spilled as well
+    assert cache.get('a')['x'].iloc[0] == 1
+    cache.clear()
+    assert cache.get('b')['x'].iloc[0] == 2
+    assert cache.get('a')['x'].iloc[0] == 1
+    assert cache.hits == 3
+
+
+def test_cached_stage_returns_copy(tmp_path):
+    pytest.importorskip('duckdb')
+    from pytaq import TaqDaily
+    from pytaq.taq_duckdb import TaqDuckDB
+    from synthetic import DATE, write_lake
+
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(write_lake(str(tmp_path))),
+                   cache=StageCache())
+    df = taq.get_trade_table(DATE)
+    expected = df.copy()
+    df['price'] = 0.0
+    df.loc[:, 'size'] = 0
+    pd.testing.assert_frame_equal(taq.get_trade_table(DATE), expected)
+    assert taq.cache.hits == 1
+
+
+@pytest.mark.parametrize('attribute, value', [
+    ('keep_qu_cond', ['R']), ('start_time_quotes', time(hour=12))])
+def test_cached_stage_config_change(tmp_path, attribute, value):
+    pytest.importorskip('duckdb')
+    from pytaq import TaqDaily
+    from pytaq.taq_duckdb import TaqDuckDB
+    from synthetic import DATE, write_lake
+
+    lake = write_lake(str(tmp_path))
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(lake), cache=StageCache())
+    before = taq.get_quote_table(DATE)
+    setattr(taq, attribute, value)
+    df = taq.get_quote_table(DATE)
+    assert (taq.cache.hits, taq.cache.misses) == (0, 2)
+    assert len(df) < len(before)
+
+    fresh = TaqDaily(method='DuckDB', db=TaqDuckDB(lake))
+    setattr(fresh, attribute, value)
+    pd.testing.assert_frame_equal(df, fresh.get_quote_table(DATE))
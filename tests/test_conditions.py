@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+import pytest
+
+from pytaq import TaqDaily
+from pytaq import taq_conditions
+
+qu_cond = pd.Series(['R', 'RL', ' ', 'A', None, 'X', 'R', '', 'O', np.nan],
+                    dtype=object)
+
+
+@pytest.mark.parametrize('keep_qu_cond', [
+    ['A', 'B', 'H', 'O', 'R', 'W'], ['R', ' '], ['RL'], []])
+def test_keep_qu_cond_same_as_isin(keep_qu_cond):
+    taq = TaqDaily()
+    taq.keep_qu_cond = keep_qu_cond
+    df = pd.DataFrame({'qu_cond': qu_cond})
+    np.testing.assert_array_equal(taq.keep_qu_cond_mask(df),
+                                  df['qu_cond'].isin(keep_qu_cond).values)
+
+
+def test_select_conditions():
+    tr_scond = pd.Series(['@', '@F', ' I', '@ TI', 'O', None, 'F  I'])
+    bits = taq_conditions.encode_conditions(tr_scond)
+    np.testing.assert_array_equal(
+        taq_conditions.select(bits, any_of='odd_lot'),
+        [False, False, True, True, False, False, True])
+    np.testing.assert_array_equal(
+        taq_conditions.select(bits, all_of='FI'),
+        [False, False, False, False, False, False, True])
+    np.testing.assert_array_equal(
+        taq_conditions.select(bits, none_of=['regular', 'F']),
+        [False, False, True, False, True, True, False])
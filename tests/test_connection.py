@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import pytest
+
+from pytaq.taq_connection import TaqConnectionPool
+
+
+class Connection():
+    def __init__(self, errors):
+        self.errors = errors
+        self.queries = []
+        self.closed = False
+
+    def raw_sql(self, sql):
+        self.queries.append(sql)
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return pd.DataFrame({'n': [1]})
+
+    def close(self):
+        self.closed = True
+
+
+def pool(errors=(), **kwargs):
+    errors = list(errors)
+    connections = []
+
+    def connect():
+        connections.append(Connection(errors))
+        return connections[-1]
+    return TaqConnectionPool(connect, backoff=0, **kwargs), connections
+
+
+def test_connection_errors_retried():
+    p, connections = pool([ConnectionError('lost')], size=1)
+    assert len(p.query('SELECT 1')) == 1
+    assert p.retried == 1
+    assert connections[0].closed
+
+
+def test_other_errors_not_retried_and_released():
+    p, connections = pool([ValueError('syntax error')] * 3, size=1)
+    for i in range(3):
+        with pytest.raises(ValueError):
+            p.query('SELECT 1')
+    assert p.retried == 0
+    # The slot of the pool was released each time
+    assert p.slots.acquire(timeout=1)
+
+
+def test_single_chunk():
+    p, connections = pool(chunk_by='time_m', chunks=[])
+    p.raw_sql('SELECT * FROM t WHERE x = 1')
+    assert connections[0].queries == ['SELECT * FROM t WHERE x = 1']
+
+    p, connections = pool(chunk_by='sym_root', chunks=1)
+    p.raw_sql('SELECT * FROM t WHERE x = 1')
+    assert connections[0].queries == ['SELECT * FROM t WHERE x = 1']
+
+
+class ChunkConnection():
+    # Returns one row per query, failing queries that contain fail
+    def __init__(self, queries, fail):
+        self.queries = queries
+        self.fail = fail
+
+    def raw_sql(self, sql):
+        self.queries.append(sql)
+        if (self.fail is not None) and (self.fail in sql):
+            raise ValueError('query failed')
+        return pd.DataFrame({'sql': [sql], 'n': [len(sql)]})
+
+    def close(self):
+        pass
+
+
+def chunk_pool(fail=None, **kwargs):
+    queries = []
+    p = TaqConnectionPool(lambda: ChunkConnection(queries, fail), backoff=0,
+                          chunk_by='sym_root', chunks=4, **kwargs)
+    return p, queries
+
+
+def test_checkpoint_resume(tmp_path):
+    sql = 'SELECT * FROM t WHERE x = 1'
+    expected = chunk_pool()[0].raw_sql(sql)
+    assert len(expected) == 4
+    failed = expected['sql'][2]
+
+    # One chunk fails, the others are saved
+    p, queries = chunk_pool(fail=failed, checkpoint_path=str(tmp_path))
+    with pytest.raises(ValueError):
+        p.raw_sql(sql)
+    assert sorted(queries) == sorted(expected['sql'])
+
+    # The rerun only pulls the failed chunk
+    p, queries = chunk_pool(checkpoint_path=str(tmp_path))
+    df = p.raw_sql(sql)
+    assert queries == [failed]
+    pd.testing.assert_frame_equal(df, expected)
+    # Checkpoints are removed once all chunks were pulled
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+aggregate_cube against compute_averages_ave_sw_dw run on the trades of each
+group.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pytaq import TaqDaily
+from synthetic import clean_inputs
+
+measures = ['DollarEffectiveSpread', 'PercentEffectiveSpread']
+
+
+@pytest.fixture(scope='module')
+def trades():
+    taq = TaqDaily(track_retail=True)
+    nbbo_df, quote_df, trade_df, off_nbbo_df = clean_inputs(taq)
+    merged = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df)
+    df = taq.compute_effective_spreads(trade_and_nbbo_df=merged)
+    # Trades without exchange are kept in their own group
+    df.loc[df.index[::17], 'ex'] = np.nan
+    return taq, df
+
+
+def group_mask(keys, names, values):
+    mask = np.ones(len(keys), dtype=bool)
+    for name, value in zip(names, values):
+        if pd.isnull(value):
+            mask &= keys[name].isnull().values
+        else:
+            mask &= (keys[name] == value).values
+    return mask
+
+
+def test_grouping_sets_same_as_slices(trades):
+    taq, df = trades
+    retail = df['BuySellBJZ']
+    buckets = taq.size_buckets(df, bins=(0, 200, 500, np.inf))
+    keys = pd.DataFrame({'symbol': df['symbol'], 'ex': df['ex'],
+                         'BuySellBJZ': retail, 'size_bucket': buckets})
+    grouping_sets = [['symbol'], ['symbol', 'ex'], ['symbol', 'BuySellBJZ'],
+                     ['symbol', buckets], [buckets], []]
+    cube = taq.aggregate_cube(df, measures, grouping_sets)
+    assert set(cube) == {('symbol',), ('symbol', 'ex'),
+                         ('symbol', 'BuySellBJZ'), ('symbol', 'size_bucket'),
+                         ('size_bucket',), ()}
+    assert cube[('symbol', 'ex')].index.get_level_values('ex').isnull().any()
+    assert cube[('symbol', 'BuySellBJZ')].index.get_level_values(
+        'BuySellBJZ').isnull().any()
+    assert len(cube[('size_bucket',)]) == 3
+
+    for levels, out_df in cube.items():
+        n_rows = 0
+        for i in range(len(out_df)):
+            values = out_df.index[i] if len(levels) > 1 else [out_df.index[i]]
+            mask = group_mask(keys, levels, values) if len(levels) > 0 else \
+                np.ones(len(df), dtype=bool)
+            n_rows += mask.sum()
+            # The slice as a single symbol
+            expected = taq.compute_averages_ave_sw_dw(
+                df[mask].assign(symbol='x'), measures).iloc[0]
+            row = out_df.iloc[i]
+            np.testing.assert_allclose(row[expected.index].astype(float),
+                                       expected.astype(float), rtol=1e-9)
+            assert row['n_trades'] == df['price'][mask].notnull().sum()
+            assert row['volume_share'] == df['size'][mask].sum()
+            assert row['volume_dollar'] == pytest.approx(df['dollar'][mask].sum())
+        # Each grouping set covers all the trades once
+        assert n_rows == len(df)
+
+
+def test_symbol_set_same_as_compute_averages(trades):
+    taq, df = trades
+    cube = taq.aggregate_cube(df, measures, [['symbol']], volume=False)
+    pd.testing.assert_frame_equal(cube[('symbol',)],
+                                  taq.compute_averages_ave_sw_dw(df, measures),
+                                  check_exact=False, rtol=1e-9)
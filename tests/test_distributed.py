@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from pytaq import taq_distributed
+from pytaq.taq_distributed import TaqDistributed
+from pytaq.taq_duckdb import TaqDuckDB
+from pytaq.taq_store import TaqStore, config_hashes
+from synthetic import DATE, SYMBOLS, write_lake
+
+DATES = [DATE, DATE + timedelta(days=1), DATE + timedelta(days=2)]
+MEASURES = ['spreads', 'effective_spreads']
+
+
+@pytest.fixture(scope='module')
+def lake(tmp_path_factory):
+    return write_lake(str(tmp_path_factory.mktemp('lake')), DATES)
+
+
+def test_local_cluster_same_as_store(lake, tmp_path):
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(lake))
+    expected = TaqStore(str(tmp_path / 'serial'))
+    expected.compute(taq, DATES, symbols=list(SYMBOLS), measures=MEASURES)
+
+    store = TaqStore(str(tmp_path / 'dist'))
+    with ProcessPoolExecutor(2) as client:
+        dist = TaqDistributed(taq, client, store=store, shards=2,
+                              connect=functools.partial(TaqDuckDB, lake),
+                              spill_path=str(tmp_path / 'spill'))
+        panels = dist.compute(DATES, symbols=list(SYMBOLS), measures=MEASURES)
+    assert dist.tasks == len(DATES) * 2
+
+    hashes, _ = config_hashes(taq, MEASURES, symbols=list(SYMBOLS))
+    for m in MEASURES:
+        df = store.read(m, config_hash=hashes[m])
+        pd.testing.assert_frame_equal(
+            df, expected.read(m, config_hash=hashes[m]))
+        pd.testing.assert_frame_equal(panels[m], df, check_dtype=False)
+
+
+def test_failed_date_keeps_other_dates(lake, tmp_path, monkeypatch):
+    compute_measures = taq_distributed.compute_measures
+
+    def failing(taq, date, *args):
+        if date == DATES[1]:
+            raise Exception('worker lost')
+        return compute_measures(taq, date, *args)
+
+    monkeypatch.setattr(taq_distributed, 'compute_measures', failing)
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(lake))
+    store = TaqStore(str(tmp_path))
+    with ThreadPoolExecutor(1) as client:
+        dist = TaqDistributed(taq, client, store=store, retries=1,
+                              connect=functools.partial(TaqDuckDB, lake))
+        with pytest.raises(Exception, match='worker lost'):
+            dist.compute(DATES, measures=['spreads'])
+    assert dist.retried == 1
+
+    hashes, _ = config_hashes(taq, ['spreads'])
+    assert [store.has('spreads', d, hashes['spreads']) for d in DATES] == \
+        [True, False, True]
+
+
+@pytest.mark.parametrize('symbols', [None, list(SYMBOLS)])
+def test_shards_same_as_whole_dates(lake, symbols):
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(lake))
+    connect = functools.partial(TaqDuckDB, lake)
+    # Note: the threads of a process share their connection
+    with ThreadPoolExecutor(1) as client:
+        whole = TaqDistributed(taq, client, connect=connect)
+        expected = whole.compute(DATES, symbols=symbols, measures=MEASURES)
+        dist = TaqDistributed(taq, client, connect=connect, shards=3)
+        panels = dist.compute(DATES, symbols=symbols, measures=MEASURES)
+    assert whole.tasks == len(DATES)
+    assert dist.tasks == len(DATES) * 3
+    for m in MEASURES:
+        pd.testing.assert_frame_equal(panels[m], expected[m])
+
+
+def test_shards_need_symbols_or_connect(lake):
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(lake))
+    with ThreadPoolExecutor(1) as client:
+        dist = TaqDistributed(taq, client, shards=2)
+        with pytest.raises(Exception, match='needs symbols or connect'):
+            dist.compute(DATES, measures=MEASURES)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+SQL pipeline of TaqDuckDB (compute_daily) against the pandas pipeline run on
+the tables of the same lake.
+"""
+
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from pytaq.taq_duckdb import TaqDuckDB
+from synthetic import DATE, write_lake
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    return TaqDuckDB(write_lake(str(tmp_path_factory.mktemp('lake'))))
+
+
+def pandas_daily(taq, symbols):
+    # Complete NBBO built from the NBBO and quote tables, as in the SQL
+    off_nbbo_df = taq.get_official_complete_nbbo(
+        nbbo_df=taq.get_nbbo_table(DATE, symbols),
+        quote_df=taq.get_quote_table(DATE, symbols))
+    merged = taq.merge_trades_nbbo(trade_df=taq.get_trade_table(DATE, symbols),
+                                   off_nbbo_df=off_nbbo_df)
+    out = {'spreads': taq.compute_spreads(DATE, off_nbbo_df=off_nbbo_df)}
+    out['effective_spreads'] = taq.compute_averages_ave_sw_dw(
+        taq.compute_effective_spreads(trade_and_nbbo_df=merged),
+        ['DollarEffectiveSpread', 'PercentEffectiveSpread'])
+    df = taq.compute_rs_and_pi(trade_and_nbbo_df=merged,
+                               off_nbbo_df=off_nbbo_df)
+    measures = [c for c in df.columns if ('Realized' in c) or ('Impact' in c)]
+    out['rs_pi'] = taq.compute_averages_ave_sw_dw(df, measures)
+    return out
+
+
+@pytest.mark.parametrize('track_retail', [False, True])
+@pytest.mark.parametrize('symbols', [None, ['AAA', 'CCC']])
+def test_compute_daily_same_as_pandas(db, track_retail, symbols):
+    taq = TaqDaily(method='DuckDB', db=db, track_retail=track_retail)
+    out = db.compute_daily(taq, DATE, symbols=symbols,
+                           delay=timedelta(minutes=5))
+    expected = pandas_daily(taq, symbols)
+    assert set(out) == set(expected)
+    for m, df in expected.items():
+        pd.testing.assert_frame_equal(out[m], df, check_exact=False,
+                                      rtol=1e-9, check_names=False)
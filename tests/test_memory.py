@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Peak memory of the cleaning and compute stages (traced with tracemalloc):
+besides its output, a stage may not hold more than a quarter of the size of
+its input, i.e. no stage makes a full working copy of its input.
+"""
+
+import tracemalloc
+
+import pytest
+
+from pytaq import TaqDaily
+from synthetic import raw_nbbo, raw_quote, raw_trade
+
+SYMBOLS = ['S%02d' % i for i in range(10)]
+max_working = 0.25
+
+
+def nbytes(*dfs):
+    return sum(int(df.memory_usage(deep=True).sum()) for df in dfs)
+
+
+def peak(func):
+    tracemalloc.start()
+    try:
+        out = func()
+        return out, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture(scope='module')
+def raw():
+    return (raw_nbbo(SYMBOLS, n=4000), raw_quote(SYMBOLS, n=4000),
+            raw_trade(SYMBOLS, n=4000))
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['copy', 'zero_copy'])
+def stages(request, raw):
+    taq = TaqDaily()
+    taq.zero_copy = request.param
+    n, q, t = raw
+    out = {}
+    out['clean_nbbo_table'] = (lambda: taq.clean_nbbo_table(n), [n])
+    out['clean_quote_table'] = (lambda: taq.clean_quote_table(q), [q])
+    out['clean_trade_table'] = (lambda: taq.clean_trade_table(t), [t])
+    nbbo_df = taq.clean_nbbo_table(n)
+    quote_df = taq.clean_quote_table(q)
+    trade_df = taq.clean_trade_table(t)
+    off_nbbo_df = taq.get_official_complete_nbbo(nbbo_df=nbbo_df,
+                                                 quote_df=quote_df)
+    m = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df)
+    out['merge_trades_nbbo'] = (
+        lambda: taq.merge_trades_nbbo(trade_df=trade_df,
+                                      off_nbbo_df=off_nbbo_df),
+        [trade_df, off_nbbo_df])
+    out['compute_effective_spreads'] = (
+        lambda: taq.compute_effective_spreads(trade_and_nbbo_df=m), [m])
+    out['compute_rs_and_pi'] = (
+        lambda: taq.compute_rs_and_pi(trade_and_nbbo_df=m,
+                                      off_nbbo_df=off_nbbo_df),
+        [m, off_nbbo_df])
+    return taq, out
+
+
+@pytest.mark.parametrize('stage', ['clean_nbbo_table', 'clean_quote_table',
+                                   'clean_trade_table', 'merge_trades_nbbo',
+                                   'compute_effective_spreads',
+                                   'compute_rs_and_pi'])
+def test_at_most_one_copy(stages, stage):
+    taq, out = stages
+    func, inputs = out[stage]
+    df, p = peak(func)
+    working = p - nbytes(df)
+    assert working <= max_working * nbytes(*inputs)
+
+
+@pytest.mark.parametrize('stage', ['clean_trade_table',
+                                   'compute_effective_spreads'])
+def test_zero_copy_views(stages, stage):
+    # Output columns of the input are views, not copies
+    taq, out = stages
+    if not taq.zero_copy:
+        pytest.skip('zero_copy only')
+    func, inputs = out[stage]
+    df, p = peak(func)
+    assert p <= max_working * nbytes(*inputs)
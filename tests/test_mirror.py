@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+duckdb = pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from pytaq.taq_connection import TaqConnectionPool
+from pytaq.taq_mirror import TaqMirror, mirror_tables
+from synthetic import DATE, write_lake
+
+
+class Connection():
+    # PostgreSQL tables (taqmsec.<table>_YYYYMMDD) as views of a local lake.
+    # Queries on the tables of fail raise an error once.
+    def __init__(self, lake, fail=(), views=None):
+        self.con = duckdb.connect()
+        self.con.execute('CREATE SCHEMA taqmsec')
+        for table in mirror_tables:
+            sql = ('SELECT * REPLACE (CAST(time_m AS TIME) AS time_m) ' +
+                   "FROM read_parquet('" +
+                   os.path.join(lake, table, '*', '*.parquet') +
+                   "', hive_partitioning = false)")
+            if (views is not None) and (table in views):
+                sql = views[table].format(sql)
+            self.con.execute('CREATE VIEW taqmsec.' + table + '_' +
+                             DATE.strftime('%Y%m%d') + ' AS ' + sql)
+        self.fail = set(fail)
+        self.queries = []
+        self.rows = []
+
+    def raw_sql(self, sql):
+        self.queries.append(sql)
+        for table in list(self.fail):
+            if ('.' + table + '_') in sql:
+                self.fail.remove(table)
+                raise ConnectionError('lost')
+        df = self.con.execute(sql).df()
+        self.rows.append(len(df))
+        return df
+
+    def close(self):
+        self.con.close()
+
+
+@pytest.fixture(scope='module')
+def lake(tmp_path_factory):
+    return write_lake(str(tmp_path_factory.mktemp('lake')))
+
+
+def read_day(mirror, table):
+    return pd.read_parquet(os.path.join(mirror.partition_path(table, DATE),
+                                        'part-0.parquet'))
+
+
+def whole_day(mirror, table, db):
+    return db.raw_sql(mirror.query(table, DATE) + ' ORDER BY ' +
+                      ', '.join(mirror.order_by(table)))
+
+
+def test_sync_by_chunks(lake, tmp_path):
+    connections = []
+
+    def connect():
+        connections.append(Connection(lake))
+        return connections[-1]
+
+    pool = TaqConnectionPool(connect, size=2, chunk_by='sym_root', chunks=4)
+    mirror = TaqMirror(TaqDaily(method='PostgreSQL', db=pool), str(tmp_path),
+                       chunks=['B', 'C'])
+    assert mirror.max_workers == 2
+    out = mirror.sync([DATE], tables=['nbbom', 'ctm'])
+    assert mirror.last_sync['errors'] == 0
+
+    db = Connection(lake)
+    for table in ['nbbom', 'ctm']:
+        df = read_day(mirror, table)
+        expected = whole_day(mirror, table, db)
+        assert out.set_index('table').loc[table, 'rows'] == len(expected)
+        assert list(df['sym_root']) == list(expected['sym_root'])
+        pd.testing.assert_series_equal(df['time_m'], expected['time_m'],
+                                       check_dtype=False)
+        # One row group per symbol range (one symbol each)
+        file = os.path.join(mirror.partition_path(table, DATE), 'part-0.parquet')
+        assert pq.ParquetFile(file).metadata.num_row_groups == 3
+    # Each query pulled a single range of symbols
+    rows = [n for c in connections for n in c.rows]
+    assert max(rows) < len(expected)
+    assert os.listdir(mirror.partition_path('ctm', DATE)) == ['part-0.parquet']
+
+
+def test_types_across_chunks(lake, tmp_path):
+    # No bid for AAA, and missing sequence numbers for CCC only
+    views = {'nbbom': 'SELECT * REPLACE (' +
+             "CASE WHEN sym_root = 'AAA' THEN NULL ELSE best_bid END AS best_bid, " +
+             "CASE WHEN sym_root = 'CCC' AND qu_seqnum % 3 = 0 THEN NULL " +
+             'ELSE qu_seqnum END AS qu_seqnum) FROM ({})'}
+    db = Connection(lake, views=views)
+    mirror = TaqMirror(TaqDaily(method='PostgreSQL', db=db), str(tmp_path),
+                       chunks=['B', 'C'])
+    mirror.sync([DATE], tables=['nbbom'])
+    df = read_day(mirror, 'nbbom')
+    expected = whole_day(mirror, 'nbbom', db)
+    assert df['best_bid'].dtype == 'f8'
+    assert df['best_bid'][df['sym_root'] == 'AAA'].isnull().all()
+    for c in ['best_bid', 'qu_seqnum', 'best_ask']:
+        pd.testing.assert_series_equal(df[c], expected[c], check_dtype=False)
+
+
+def test_resume_after_failed_table(lake, tmp_path):
+    db = Connection(lake, fail=['ctm'])
+    mirror = TaqMirror(TaqDaily(method='PostgreSQL', db=db), str(tmp_path))
+    with pytest.raises(ConnectionError):
+        mirror.sync([DATE], tables=['nbbom', 'cqm', 'ctm'])
+    assert mirror.last_sync['errors'] == 1
+    assert mirror.last_sync['tables'] == 2
+    assert [mirror.has(t, DATE) for t in ['nbbom', 'cqm', 'ctm']] == \
+        [True, True, False]
+    assert os.listdir(mirror.partition_path('ctm', DATE)) == []
+
+    db.queries = []
+    out = mirror.sync([DATE], tables=['nbbom', 'cqm', 'ctm'])
+    assert list(out['table']) == ['ctm']
+    assert all('.ctm_' in q for q in db.queries)
+    assert set(mirror.manifest()['table']) == {'nbbom', 'cqm', 'ctm'}
+    assert mirror.sync([DATE], tables=['ctm']).empty
+
+
+def test_row_count_mismatch(lake, tmp_path, monkeypatch):
+    mirror = TaqMirror(TaqDaily(method='PostgreSQL', db=Connection(lake)),
+                       str(tmp_path))
+    source_rows = mirror.source_rows
+    monkeypatch.setattr(mirror, 'source_rows',
+                        lambda table, date: source_rows(table, date) + 1)
+    with pytest.raises(Exception, match='Row count mismatch'):
+        mirror.sync([DATE], tables=['cqm'])
+    assert not mirror.has('cqm', DATE)
+    assert os.listdir(mirror.partition_path('cqm', DATE)) == []
+    assert len(mirror.manifest()) == 0
+
+
+def test_last_sync(lake, tmp_path):
+    mirror = TaqMirror(TaqDaily(method='PostgreSQL', db=Connection(lake)),
+                       str(tmp_path))
+    assert mirror.max_workers == 1
+    out = mirror.sync([DATE])
+    stats = mirror.last_sync
+    assert stats['tables'] == len(mirror_tables)
+    assert stats['rows'] == out['rows'].sum()
+    assert stats['bytes'] == out['bytes'].sum() > 0
+    assert stats['rows_per_second'] == pytest.approx(stats['rows'] /
+                                                     stats['seconds'])
+    assert stats['errors'] == 0
+    assert (out[['fetch_seconds', 'write_seconds']] >= 0).all().all()
+    pd.testing.assert_frame_equal(
+        mirror.manifest().sort_values(['table']).reset_index(drop=True),
+        out.sort_values(['table']).reset_index(drop=True), check_dtype=False)
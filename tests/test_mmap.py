@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+from pytaq import TaqDaily
+from pytaq.taq_mmap import TaqMmapStore
+from synthetic import DATE, clean_inputs
+
+
+def by_symbol(df):
+    return df.sort_values(['symbol', 'timestamp'],
+                          kind='mergesort').reset_index(drop=True)
+
+
+def test_round_trip(tmp_path):
+    nbbo_df, _, trade_df, off_nbbo_df = clean_inputs(TaqDaily())
+    store = TaqMmapStore(str(tmp_path))
+    store.write(DATE, 'complete_nbbo', off_nbbo_df)
+    store.write(DATE, 'trades', trade_df)
+
+    df = TaqMmapStore(str(tmp_path)).get_table(DATE, 'complete_nbbo')
+    pd.testing.assert_frame_equal(df, by_symbol(off_nbbo_df)[df.columns])
+
+    symbols = ['CCC', 'AAA A', 'ZZZ', 'AAA']
+    df = store.get_table(DATE, 'trades', symbols=symbols)
+    expected = pd.concat([by_symbol(trade_df[trade_df['symbol'] == s])
+                          for s in symbols], ignore_index=True)
+    pd.testing.assert_frame_equal(df, expected[df.columns])
+
+    arrays = store.get_arrays(DATE, 'complete_nbbo', 'BBB')
+    assert np.shares_memory(
+        arrays['best_bid'],
+        store.open(DATE, 'complete_nbbo')['columns']['best_bid'])
+
+
+def test_empty_day(tmp_path):
+    _, _, trade_df, _ = clean_inputs(TaqDaily())
+    store = TaqMmapStore(str(tmp_path))
+    store.write(DATE, 'trades', trade_df.iloc[:0])
+    assert store.symbols(DATE, 'trades') == []
+    df = store.get_table(DATE, 'trades')
+    assert len(df) == 0
+    assert list(df.columns) == list(trade_df.columns)
+    assert len(store.get_table(DATE, 'trades', symbols=['AAA'])) == 0
+    assert len(store.get_arrays(DATE, 'trades')['price']) == 0
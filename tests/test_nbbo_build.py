@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from pytaq import TaqDaily
+from pytaq.taq_nbbo_build import build_nbbo
+from synthetic import raw_quote
+
+
+@pytest.fixture(scope='module')
+def quote_df():
+    taq = TaqDaily()
+    taq.delete_withdrawned_quotes = False
+    taq.delete_crossed_markets = False
+    taq.delete_abnormal_spreads = False
+    return taq.clean_quote_table(raw_quote())
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 50, 2**18])
+def test_symbols_across_chunks(quote_df, chunk_rows):
+    # Chunks smaller than a symbol give the same NBBO as a single chunk
+    expected = build_nbbo(quote_df, use_numba=False, changes_only=False)
+    df = build_nbbo(quote_df, use_numba=False, changes_only=False,
+                    chunk_rows=chunk_rows)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_chunk_rows_bound(quote_df, monkeypatch):
+    # Symbols larger than chunk_rows are split across chunks
+    from pytaq import taq_nbbo_build
+    best_side = taq_nbbo_build.best_side
+    rows = []
+
+    def recorded(last, *args):
+        rows.append(last.shape[0])
+        return best_side(last, *args)
+
+    monkeypatch.setattr(taq_nbbo_build, 'best_side', recorded)
+    build_nbbo(quote_df, use_numba=False, chunk_rows=20)
+    assert quote_df['symbol'].value_counts().max() > 20
+    assert max(rows) == 20
+
+
+def test_same_as_numba(quote_df):
+    pytest.importorskip('numba')
+    pd.testing.assert_frame_equal(
+        build_nbbo(quote_df, use_numba=False, chunk_rows=13),
+        build_nbbo(quote_df, use_numba=True))
+
+
+@pytest.mark.parametrize('use_numba', [False, True])
+def test_size_refresh_resets_time(use_numba):
+    if use_numba:
+        pytest.importorskip('numba')
+    # P and Q quote the same bid and size, P first; a size refresh of P
+    # makes Q the older quote
+    quote_df = pd.DataFrame({
+        'timestamp': [datetime(2016, 12, 7, 10, 0, s) for s in range(3)],
+        'symbol': 'AAA', 'best_bid': 10.0, 'best_bidsizeshares': 1.0,
+        'best_bidex': ['P', 'Q', 'P'], 'best_ask': 10.01,
+        'best_asksizeshares': 1.0, 'best_askex': ['P', 'Q', 'P'],
+        'qu_seqnum': [1, 2, 3]})
+    df = build_nbbo(quote_df, use_numba=use_numba, changes_only=False,
+                    chunk_rows=2)
+    assert list(df['best_bidex']) == ['P', 'P', 'Q']
+    assert list(df['best_askex']) == ['P', 'P', 'Q']
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+NbboIndex.lookup against pd.merge_asof.
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pytaq.taq_nbbo_index import NbboIndex
+
+T0 = datetime(2016, 12, 7, 9, 30)
+
+
+@pytest.fixture(scope='module')
+def nbbo():
+    rng = np.random.default_rng(0)
+    n = 400
+    # Many quotes share a timestamp (whole seconds)
+    df = pd.DataFrame({
+        'timestamp': pd.to_datetime(T0) + pd.to_timedelta(
+            np.sort(rng.integers(10, 600, n)), unit='s'),
+        'symbol': rng.choice(['AAA', 'BBB', 'CCC'], n),
+        'best_bid': np.round(rng.uniform(10, 11, n), 2),
+        'best_ask': np.round(rng.uniform(11, 12, n), 2),
+        'best_bidsizeshares': rng.integers(1, 10, n) * 100})
+    return df.sort_values('timestamp', kind='stable', ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def trades(nbbo):
+    rng = np.random.default_rng(1)
+    # Times of quotes (exact matches), random times before the first quote
+    # and after the last one, and a symbol without quotes
+    exact = nbbo.sample(100, random_state=0)[['timestamp', 'symbol']]
+    n = 300
+    other = pd.DataFrame({
+        'timestamp': pd.to_datetime(T0) + pd.to_timedelta(
+            rng.integers(0, 700 * 10**6, n), unit='us'),
+        'symbol': rng.choice(['AAA', 'BBB', 'CCC', 'ZZZ'], n)})
+    df = pd.concat([exact, other], ignore_index=True)
+    return df.sort_values('timestamp', kind='stable', ignore_index=True)
+
+
+def merge_asof(trades, nbbo, offset, strict):
+    left = trades.copy()
+    if offset is not None:
+        left['timestamp'] = left['timestamp'] + offset
+    df = pd.merge_asof(left, nbbo, on='timestamp', by='symbol',
+                       allow_exact_matches=not strict)
+    return df[['best_bid', 'best_ask', 'best_bidsizeshares']]
+
+
+@pytest.mark.parametrize('strict', [True, False])
+@pytest.mark.parametrize('offset', [None, timedelta(seconds=5),
+                                    timedelta(seconds=-20)])
+def test_same_as_merge_asof(nbbo, trades, strict, offset):
+    index = NbboIndex(nbbo)
+    df = index.lookup(trades['symbol'], trades['timestamp'], offset=offset,
+                      strict=strict)
+    expected = merge_asof(trades, nbbo, offset, strict)
+    pd.testing.assert_frame_equal(df[expected.columns], expected)
+
+
+def test_exact_matches(nbbo):
+    index = NbboIndex(nbbo)
+    # Last of the quotes at the time (inclusive), or the quote before
+    # (strict)
+    t = nbbo['timestamp'].value_counts().idxmax()
+    same = nbbo[nbbo['timestamp'] == t]
+    symbol = same['symbol'].iloc[-1]
+    rows = nbbo[(nbbo['symbol'] == symbol)]
+    inclusive = index.lookup([symbol], [t], strict=False)
+    assert inclusive['best_bid'].iloc[0] == \
+        rows[rows['timestamp'] <= t]['best_bid'].iloc[-1]
+    strict = index.lookup([symbol], [t], strict=True)
+    before = rows[rows['timestamp'] < t]
+    if len(before) > 0:
+        assert strict['best_bid'].iloc[0] == before['best_bid'].iloc[-1]
+    else:
+        assert np.isnan(strict['best_bid'].iloc[0])
+
+
+def test_missing_symbol_and_before_first_quote(nbbo):
+    index = NbboIndex(nbbo)
+    first = nbbo.groupby('symbol')['timestamp'].min()
+    df = index.lookup(['ZZZ', 'AAA', 'BBB', 'AAA'],
+                      [first['AAA'], first['AAA'] - timedelta(seconds=1),
+                       first['BBB'], first['AAA']], strict=True)
+    assert df['best_bid'].isnull().tolist() == [True, True, True, True]
+    # Integer columns become float, as with merge_asof
+    assert df['best_bidsizeshares'].dtype == 'f8'
+    df = index.lookup(['BBB'], [first['BBB']], strict=False)
+    assert df['best_bidsizeshares'].dtype == nbbo['best_bidsizeshares'].dtype
+
+
+def test_empty_index(trades):
+    index = NbboIndex(pd.DataFrame({
+        'timestamp': np.array([], dtype='datetime64[ns]'),
+        'symbol': np.array([], dtype=object), 'best_bid': np.array([])}))
+    df = index.lookup(trades['symbol'], trades['timestamp'])
+    assert len(df) == len(trades) and df['best_bid'].isnull().all()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk output of the trade-level stages (output_path) against the outputs
+computed in memory.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from synthetic import DATE, clean_inputs
+
+
+@pytest.fixture(scope='module')
+def inputs():
+    taq = TaqDaily(track_retail=True)
+    nbbo_df, quote_df, trade_df, off_nbbo_df = clean_inputs(taq)
+    return taq, trade_df, off_nbbo_df
+
+
+def by_symbol(df):
+    # Chunks are written in the order of the symbols
+    return df.sort_values('symbol', kind='stable', ignore_index=True)
+
+
+def test_merge_chunked(inputs, tmp_path):
+    taq, trade_df, off_nbbo_df = inputs
+    expected = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df)
+    dataset = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df,
+                                    date=DATE, output_path=str(tmp_path),
+                                    row_group_size=50)
+    pd.testing.assert_frame_equal(dataset.to_table().to_pandas(),
+                                  by_symbol(expected), check_exact=True)
+
+
+def test_rs_and_pi_chunked(inputs, tmp_path):
+    taq, trade_df, off_nbbo_df = inputs
+    merged = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df)
+    expected = taq.compute_rs_and_pi(trade_and_nbbo_df=merged,
+                                     off_nbbo_df=off_nbbo_df)
+    dataset = taq.compute_rs_and_pi(trade_and_nbbo_df=merged,
+                                    off_nbbo_df=off_nbbo_df, date=DATE,
+                                    output_path=str(tmp_path),
+                                    row_group_size=50)
+    pd.testing.assert_frame_equal(dataset.to_table().to_pandas(),
+                                  by_symbol(expected), check_exact=True)
+
+
+def test_failed_chunk_leaves_no_file(inputs, tmp_path, monkeypatch):
+    taq, trade_df, off_nbbo_df = inputs
+    merge_chunk = taq.merge_trades_nbbo_chunk
+    calls = []
+
+    def failing(*args):
+        calls.append(1)
+        if len(calls) == 2:
+            raise MemoryError('chunk')
+        return merge_chunk(*args)
+
+    monkeypatch.setattr(taq, 'merge_trades_nbbo_chunk', failing)
+    with pytest.raises(MemoryError):
+        taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df,
+                              date=DATE, output_path=str(tmp_path),
+                              row_group_size=50)
+    path = os.path.join(str(tmp_path), 'date=' + DATE.strftime('%Y%m%d'))
+    assert os.listdir(path) == []
+
+
+def test_rs_and_pi_chunked_merge(tmp_path):
+    # trade_and_nbbo_df=None: trades are merged chunk by chunk, with the
+    # track_retail of the call
+    pytest.importorskip('duckdb')
+    from pytaq.taq_duckdb import TaqDuckDB
+    from synthetic import write_lake
+
+    taq = TaqDaily(method='DuckDB',
+                   db=TaqDuckDB(write_lake(str(tmp_path / 'lake'))))
+    off_nbbo_df = taq.get_official_complete_nbbo(date=DATE)
+    for track_retail in [True, False]:
+        taq.track_retail = not track_retail
+        expected = taq.compute_rs_and_pi(date=DATE, off_nbbo_df=off_nbbo_df,
+                                         track_retail=track_retail)
+        assert ('BuySellBJZ' in expected.columns) == track_retail
+        dataset = taq.compute_rs_and_pi(date=DATE, off_nbbo_df=off_nbbo_df,
+                                        track_retail=track_retail,
+                                        output_path=str(tmp_path / 'out'),
+                                        row_group_size=50)
+        pd.testing.assert_frame_equal(dataset.to_table().to_pandas(),
+                                      by_symbol(expected), check_exact=True)
+
+
+def test_float32_derived_columns(inputs, tmp_path):
+    taq, trade_df, off_nbbo_df = inputs
+    expected = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df)
+    dataset = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df,
+                                    date=DATE, output_path=str(tmp_path),
+                                    row_group_size=50, float32=True)
+    inputs_columns = set(trade_df.columns) | set(off_nbbo_df.columns)
+    df = dataset.to_table().to_pandas()
+    derived = [c for c in expected.columns
+               if (expected[c].dtype == 'f8') and (c not in inputs_columns)]
+    assert 'midpoint' in derived
+    for c in expected.columns:
+        if c in derived:
+            assert df[c].dtype == 'f4', c
+            np.testing.assert_allclose(df[c], by_symbol(expected)[c],
+                                       rtol=1e-6)
+        else:
+            assert df[c].dtype == expected[c].dtype, c
+            pd.testing.assert_series_equal(df[c], by_symbol(expected)[c])
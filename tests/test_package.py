@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+import pytaq
+
+optional = ['duckdb', 'numba', 'polars', 'dask']
+
+
+def run_python(code):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(pytaq.__file__)))
+    out = subprocess.run([sys.executable, '-c', code], check=True, cwd=root,
+                         capture_output=True, text=True)
+    return out.stdout.strip()
+
+
+def test_star_import_loads_no_optional_dependency():
+    code = ('import sys\n'
+            'from pytaq import *\n'
+            'TaqDaily, StageCache, TaqConnectionPool, NbboIndex\n'
+            'print(sorted(m for m in ' + repr(optional) +
+            ' if m in sys.modules))\n')
+    assert run_python(code) == '[]'
+
+
+def test_star_import_without_optional_dependencies():
+    # None in sys.modules makes the import fail as if not installed
+    code = ('import sys\n'
+            'for m in ' + repr(optional) + ':\n'
+            '    sys.modules[m] = None\n'
+            'from pytaq import *\n'
+            'print(TaqDaily().engine)\n')
+    assert run_python(code) == 'pandas'
+
+
+def test_lazy_attributes():
+    for name in pytaq.lazy_attributes:
+        assert name in dir(pytaq)
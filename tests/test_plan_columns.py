@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Column pruning (TaqDaily.measures): outputs computed with the planned
+columns are the same as with all the columns, and the queries only select
+the planned columns.
+"""
+
+import re
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from pytaq.taq_duckdb import TaqDuckDB
+from synthetic import DATE, write_lake
+
+effective = ['DollarEffectiveSpread', 'PercentEffectiveSpread']
+
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    return TaqDuckDB(write_lake(str(tmp_path_factory.mktemp('lake'))))
+
+
+def outputs(taq, measures):
+    out = {}
+    if ('spreads' in measures) or ('depth' in measures) or \
+            ('quoted_spreads' in measures):
+        out['spreads'] = taq.compute_spreads(DATE)
+    if 'effective_spreads' in measures:
+        out['effective_spreads'] = taq.compute_averages_ave_sw_dw(
+            taq.compute_effective_spreads(date=DATE), effective)
+    if 'rs_pi' in measures:
+        df = taq.compute_rs_and_pi(date=DATE)
+        out['rs_pi'] = taq.compute_averages_ave_sw_dw(
+            df, [c for c in df.columns if ('Realized' in c) or ('Impact' in c)])
+    if 'retail_signs' in measures:
+        out['retail_signs'] = taq.merge_trades_nbbo(DATE)[
+            ['timestamp', 'symbol', 'BuySellBJZ']]
+    return out
+
+
+@pytest.mark.parametrize('track_retail', [False, True])
+@pytest.mark.parametrize('measures', [
+    ['quoted_spreads'], ['depth'], ['spreads'], ['effective_spreads'],
+    ['rs_pi'], ['retail_signs'], ['quoted_spreads', 'effective_spreads'],
+    ['spreads', 'effective_spreads', 'rs_pi']])
+def test_same_outputs_as_all_columns(db, measures, track_retail):
+    if ('retail_signs' in measures) and not track_retail:
+        pytest.skip('BJZ signs need track_retail')
+    taq = TaqDaily(method='DuckDB', db=db, track_retail=track_retail)
+    expected = outputs(taq, measures)
+    taq.measures = measures
+    out = outputs(taq, measures)
+    for m, df in out.items():
+        # Only the measures of the retrieved columns (e.g. no depths for
+        # quoted_spreads)
+        pd.testing.assert_frame_equal(df, expected[m][df.columns],
+                                      check_exact=True)
+    if 'quoted_spreads' == measures[0] and 'spreads' in out:
+        assert list(out['spreads'].columns) == ['quoted_spread_dollar',
+                                                'quoted_spread_percent']
+
+
+def selected(sql):
+    return re.match(r'SELECT (.*?) FROM ', sql).group(1).split(', ')
+
+
+@pytest.mark.parametrize('measures', [None, ['quoted_spreads'], ['spreads'],
+                                      ['effective_spreads'], ['rs_pi'],
+                                      ['retail_signs']])
+@pytest.mark.parametrize('track_retail', [False, True])
+def test_sql_selects_planned_columns(measures, track_retail):
+    taq = TaqDaily(method='PostgreSQL', track_retail=track_retail)
+    taq.measures = measures
+    plan = taq.plan_columns()
+    queries = {'nbbo': taq.get_nbbo_table_sql(DATE),
+               'quote': taq.get_quote_table_sql(DATE),
+               'trade': taq.get_trade_table_sql(DATE),
+               'complete_nbbo': taq.get_official_complete_nbbo_sql(DATE)}
+    for table, sql in queries.items():
+        if table in plan:
+            assert selected(sql) == plan[table], table
+        else:
+            # Tables that are not needed are queried with all the columns
+            assert selected(sql) == list(getattr(taq, table + '_columns'))
+    if measures is not None:
+        for table, cols in plan.items():
+            assert set(cols) <= set(getattr(taq, table + '_columns')), table
+        # Exchanges and sequence numbers of the quotes are never needed
+        assert 'ex' not in plan.get('quote', [])
+        assert len(plan.get('trade', [])) < len(taq.trade_columns)
+        assert ('ex' in plan.get('trade', [])) == (
+            ('trade' in plan) and (track_retail or measures == ['retail_signs']))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the Polars engine (TaqDaily(engine='polars')) with the pandas
+engine. Sums are computed in a different order, so floating-point measures
+are compared with a relative tolerance.
+"""
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('polars')
+
+from pytaq import TaqDaily
+from synthetic import DATE, raw_inputs
+
+rtol = 1e-8
+
+
+def run(engine):
+    taq = TaqDaily(engine=engine)
+    n, q, t = raw_inputs()
+    out = {}
+    out['nbbo'] = nbbo_df = taq.clean_nbbo_table(n.copy())
+    out['quote'] = quote_df = taq.clean_quote_table(q.copy())
+    trade_df = taq.clean_trade_table(t.copy())
+    out['off_nbbo'] = off_nbbo_df = taq.get_official_complete_nbbo(
+        nbbo_df=nbbo_df, quote_df=quote_df)
+    out['spreads'] = taq.compute_spreads(DATE, off_nbbo_df=off_nbbo_df)
+    out['merge'] = m = taq.merge_trades_nbbo(trade_df=trade_df,
+                                             off_nbbo_df=off_nbbo_df)
+    out['rs_pi'] = taq.compute_rs_and_pi(trade_and_nbbo_df=m,
+                                         off_nbbo_df=off_nbbo_df)
+    return out
+
+
+@pytest.fixture(scope='module')
+def outputs():
+    return run('pandas'), run('polars')
+
+
+@pytest.mark.parametrize('name', ['nbbo', 'quote', 'off_nbbo', 'spreads',
+                                  'merge', 'rs_pi'])
+def test_polars_parity(outputs, name):
+    a, b = outputs[0][name], outputs[1][name]
+    if name != 'spreads':
+        a = a.reset_index(drop=True)
+        b = b.reset_index(drop=True)
+    pd.testing.assert_frame_equal(b, a, check_dtype=False, rtol=rtol,
+                                  check_names=False)
+
+
+def test_pandas_only_stages():
+    taq = TaqDaily(engine='polars')
+    taq.polars_output = True
+    n, q, t = raw_inputs()
+    off_nbbo_df = taq.get_official_complete_nbbo(
+        nbbo_df=taq.clean_nbbo_table(n), quote_df=taq.clean_quote_table(q))
+    m = taq.merge_trades_nbbo(trade_df=TaqDaily().clean_trade_table(t),
+                              off_nbbo_df=off_nbbo_df)
+    with pytest.raises(Exception, match='no Polars implementation'):
+        taq.compute_effective_spreads(trade_and_nbbo_df=m)
+    with pytest.raises(Exception, match='no Polars implementation'):
+        taq.compute_averages_ave_sw_dw(m, ['price'])
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-point prices (TaqDaily.price_scale): measures computed on int64 ticks
+are the same as the ones computed on float dollars.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pytaq import TaqDaily
+from synthetic import DATE, clean_inputs
+
+PRICE_SCALE = 10000
+signs = ['BuySellLR', 'BuySellEMO', 'BuySellCLNV', 'BuySellBJZ']
+
+
+def run(price_scale):
+    taq = TaqDaily(track_retail=True)
+    taq.price_scale = price_scale
+    nbbo_df, quote_df, trade_df, off_nbbo_df = clean_inputs(taq)
+    out = {'spreads': taq.compute_spreads(DATE, off_nbbo_df=off_nbbo_df),
+           'intraday': taq.compute_intraday_spreads(DATE,
+                                                    off_nbbo_df=off_nbbo_df)}
+    out['merge'] = m = taq.merge_trades_nbbo(trade_df=trade_df,
+                                             off_nbbo_df=off_nbbo_df)
+    e = taq.compute_effective_spreads(trade_and_nbbo_df=m)
+    out['effective_spreads'] = taq.compute_averages_ave_sw_dw(
+        e, ['DollarEffectiveSpread', 'PercentEffectiveSpread'])
+    r = taq.compute_rs_and_pi(trade_and_nbbo_df=m, off_nbbo_df=off_nbbo_df)
+    measures = [c for c in r.columns if ('Realized' in c) or ('Impact' in c)]
+    out['rs_pi'] = taq.compute_averages_ave_sw_dw(r, measures)
+    return out
+
+
+@pytest.fixture(scope='module')
+def outputs():
+    return run(None), run(PRICE_SCALE)
+
+
+@pytest.mark.parametrize('name', ['spreads', 'intraday', 'effective_spreads',
+                                  'rs_pi'])
+def test_same_measures_in_dollars(outputs, name):
+    pd.testing.assert_frame_equal(outputs[1][name], outputs[0][name],
+                                  check_exact=False, rtol=1e-9)
+
+
+def test_same_trade_signs(outputs):
+    dollars, ticks = outputs[0]['merge'], outputs[1]['merge']
+    np.testing.assert_allclose(ticks['price'] / PRICE_SCALE, dollars['price'],
+                               rtol=1e-12)
+    np.testing.assert_allclose(ticks['midpoint'] / PRICE_SCALE,
+                               dollars['midpoint'], rtol=1e-12)
+    np.testing.assert_allclose(ticks['dollar'], dollars['dollar'], rtol=1e-12)
+    for c in signs:
+        pd.testing.assert_series_equal(ticks[c], dollars[c])
+
+
+def test_only_pandas_engine():
+    pytest.importorskip('polars')
+    taq = TaqDaily(engine='polars')
+    with pytest.raises(Exception, match='price_scale'):
+        taq.price_scale = PRICE_SCALE
+    taq = TaqDaily()
+    taq.price_scale = PRICE_SCALE
+    with pytest.raises(Exception, match='price_scale'):
+        taq.engine = 'polars'
+    assert taq.engine == 'pandas'
+
+
+def test_not_supported_by_duckdb_pipeline(tmp_path):
+    pytest.importorskip('duckdb')
+    from pytaq.taq_duckdb import TaqDuckDB
+    from synthetic import write_lake
+    db = TaqDuckDB(write_lake(str(tmp_path)))
+    taq = TaqDaily(method='DuckDB', db=db)
+    taq.price_scale = PRICE_SCALE
+    with pytest.raises(Exception, match='price_scale'):
+        db.compute_daily(taq, DATE)
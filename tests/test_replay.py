@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Built-in replay plugins against the pandas pipeline.
+"""
+
+from datetime import datetime, time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('numba')
+
+from pytaq import TaqDaily, replay, taq_time
+from pytaq.taq_replay import (effective_spreads_plugin, rs_and_pi_plugin,
+                              spreads_plugin)
+from synthetic import DATE, clean_inputs
+
+
+@pytest.fixture(scope='module')
+def inputs():
+    taq = TaqDaily()
+    nbbo_df, quote_df, trade_df, off_nbbo_df = clean_inputs(taq)
+    merged = taq.merge_trades_nbbo(trade_df=trade_df, off_nbbo_df=off_nbbo_df)
+    return taq, trade_df, off_nbbo_df, merged
+
+
+def assert_close(left, right):
+    pd.testing.assert_frame_equal(left, right, check_exact=False, rtol=1e-9,
+                                  check_names=False)
+
+
+def test_spreads(inputs):
+    taq, trade_df, off_nbbo_df, merged = inputs
+    assert_close(replay(taq, DATE, spreads_plugin(), off_nbbo_df=off_nbbo_df),
+                 taq.compute_spreads(DATE, off_nbbo_df=off_nbbo_df))
+
+
+def test_intraday_spreads(inputs):
+    taq, trade_df, off_nbbo_df, merged = inputs
+    # The plugin does not carry in the quote in force at the start of the
+    # window
+    t = np.mod(taq_time.to_ns(off_nbbo_df['timestamp'].values),
+               taq_time.ns_per_day)
+    window_df = off_nbbo_df[taq_time.in_window(t, taq.start_time_trades,
+                                               taq.end_time_trades)]
+    assert_close(replay(taq, DATE, spreads_plugin(), off_nbbo_df=off_nbbo_df,
+                        freq='30min'),
+                 taq.compute_intraday_spreads(DATE, off_nbbo_df=window_df,
+                                              freq='30min'))
+
+
+def test_buckets_covered_by_earlier_quote():
+    taq = TaqDaily()
+    off_nbbo_df = pd.DataFrame({
+        'timestamp': [datetime(2016, 12, 7, 9, 30)] * 2, 'symbol': 'AAA',
+        'best_bid': [10.0, 10.01], 'best_ask': [10.02, 10.03],
+        'best_bidsizeshares': 1.0, 'best_asksizeshares': 2.0})
+    df = replay(taq, DATE, spreads_plugin(), off_nbbo_df=off_nbbo_df,
+                freq='30min')
+    assert len(df) == 13
+    assert df.index.get_level_values('bucket')[-1].time() == time(15, 30)
+    np.testing.assert_allclose(df['quoted_spread_dollar'], 0.02)
+    assert_close(df, taq.compute_intraday_spreads(DATE, off_nbbo_df=off_nbbo_df,
+                                                  freq='30min'))
+
+
+def test_effective_spreads(inputs):
+    taq, trade_df, off_nbbo_df, merged = inputs
+    expected = taq.compute_averages_ave_sw_dw(
+        taq.compute_effective_spreads(trade_and_nbbo_df=merged),
+        ['DollarEffectiveSpread', 'PercentEffectiveSpread'])
+    assert_close(replay(taq, DATE, effective_spreads_plugin(),
+                        off_nbbo_df=off_nbbo_df, trade_df=trade_df), expected)
+
+
+def test_rs_and_pi(inputs):
+    taq, trade_df, off_nbbo_df, merged = inputs
+    df = taq.compute_rs_and_pi(trade_and_nbbo_df=merged,
+                               off_nbbo_df=off_nbbo_df)
+    measures = [c for c in df.columns if ('Realized' in c) or ('Impact' in c)]
+    expected = taq.compute_averages_ave_sw_dw(df, measures)
+    assert_close(replay(taq, DATE, rs_and_pi_plugin(),
+                        off_nbbo_df=off_nbbo_df, trade_df=trade_df), expected)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from pytaq.taq_duckdb import TaqDuckDB
+from pytaq.taq_server import TaqServer, TaqServerClient
+from synthetic import DATE, write_lake
+
+
+@pytest.fixture
+def server(tmp_path):
+    taq = TaqDaily(method='DuckDB', db=TaqDuckDB(write_lake(str(tmp_path))))
+    server = TaqServer(taq, str(tmp_path / 'taq.sock'))
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def assert_same(left, right):
+    # Arrow round trip: same values, index and column types
+    pd.testing.assert_frame_equal(left.reset_index(drop=True),
+                                  right.reset_index(drop=True),
+                                  check_dtype=False)
+
+
+def test_same_as_direct_calls(server):
+    direct = TaqDaily(method='DuckDB', db=server.taq.db)
+    client = TaqServerClient(server.path)
+    taq = TaqDaily(method='Server', db=client)
+    assert client.ping()
+
+    assert_same(taq.get_nbbo_table(DATE), direct.get_nbbo_table(DATE))
+    assert_same(taq.get_nbbo_table(DATE, ['BBB']),
+                direct.get_nbbo_table(DATE, ['BBB']))
+    assert_same(taq.merge_trades_nbbo(DATE), direct.merge_trades_nbbo(DATE))
+    pd.testing.assert_frame_equal(client.compute('compute_spreads', DATE,
+                                                 taq=taq),
+                                  direct.compute_spreads(DATE))
+
+    # The configuration of the client is used by the server
+    taq.start_time_trades = taq.start_time_trades.replace(hour=12)
+    direct.start_time_trades = taq.start_time_trades
+    assert_same(taq.merge_trades_nbbo(DATE), direct.merge_trades_nbbo(DATE))
+    assert server.requests == 6
+
+
+@pytest.mark.parametrize('method', ['compute_spreads', 'get_trade_table'])
+def test_concurrent_clients_load_once(server, monkeypatch, method):
+    calls = []
+    func = getattr(server.taq, method)
+
+    def slow(*args, **kwargs):
+        calls.append(threading.get_ident())
+        time.sleep(0.3)
+        return func(*args, **kwargs)
+
+    monkeypatch.setattr(server.taq, method, slow)
+    client = TaqServerClient(server.path)
+    if method == 'compute_spreads':
+        request = lambda i: client.compute(method, DATE)
+    else:
+        request = lambda i: client.get_stage(method, DATE)
+    with ThreadPoolExecutor(8) as executor:
+        dfs = list(executor.map(request, range(8)))
+    assert len(calls) == 1
+    for df in dfs[1:]:
+        pd.testing.assert_frame_equal(df, dfs[0])
+    assert server.loading == {}
+
+    # Done loading: a later request is run again (stages then come from
+    # the cache)
+    hits = server.taq.cache.hits
+    request(0)
+    assert len(calls) == 2
+    if method == 'get_trade_table':
+        assert server.taq.cache.hits == hits + 1
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+from pytaq import TaqDaily
+from pytaq import taq_store
+from pytaq.taq_duckdb import TaqDuckDB
+from pytaq.taq_store import TaqStore, config_hashes
+from synthetic import DATE, write_lake
+
+DATES = [DATE, DATE + timedelta(days=1)]
+
+
+@pytest.fixture(scope='module')
+def lake(tmp_path_factory):
+    return write_lake(str(tmp_path_factory.mktemp('lake')), DATES)
+
+
+@pytest.fixture
+def taq(lake):
+    return TaqDaily(method='DuckDB', db=TaqDuckDB(lake))
+
+
+def test_symbols_in_configuration(taq, tmp_path):
+    store = TaqStore(str(tmp_path))
+    store.compute(taq, DATES, symbols=['AAA'], measures=['spreads'])
+    store.compute(taq, DATES, symbols=['BBB'], measures=['spreads'])
+
+    hashes, _ = config_hashes(taq, ['spreads'], symbols=['BBB'])
+    df = store.read('spreads', config_hash=hashes['spreads'])
+    assert set(df.index.get_level_values('symbol')) == {'BBB'}
+    assert len(df) == len(DATES)
+    assert store.get_config('spreads', hashes['spreads'])['symbols'] == ['BBB']
+    with pytest.raises(Exception, match='Multiple configurations'):
+        store.read('spreads')
+
+
+def test_config_hash():
+    taq = TaqDaily()
+    h = taq.config_hash()
+    taq.price_scale = 10000
+    assert taq.config_hash() != h
+    taq.price_scale = None
+    taq.measures = ['quoted_spread_dollar']
+    assert taq.config_hash() != h
+
+
+def test_empty_dates_recorded(taq, tmp_path, monkeypatch):
+    store = TaqStore(str(tmp_path))
+    store.compute(taq, DATES, symbols=['ZZZ'], measures=['spreads'])
+    hashes, _ = config_hashes(taq, ['spreads'], symbols=['ZZZ'])
+    assert all(store.has('spreads', d, hashes['spreads']) for d in DATES)
+
+    calls = []
+    monkeypatch.setattr(taq_store, 'compute_measures',
+                        lambda *args: calls.append(args))
+    store.compute(taq, DATES, symbols=['ZZZ'], measures=['spreads'])
+    assert calls == []
+    assert len(store.read('spreads', config_hash=hashes['spreads'])) == 0
+
+
+def test_read_nothing_stored(tmp_path):
+    store = TaqStore(str(tmp_path))
+    df = store.read('spreads')
+    assert len(df) == 0
+    assert list(df.index.names) == ['date', 'symbol']
+    assert len(store.read('spreads', config_hash='0' * 16)) == 0